@@ -1,12 +1,16 @@
 import os
+import sys
+import time
 from houseagent.utils.config import Config
 from houseagent import config_file
 from houseagent.core.coordinator import Coordinator
 from houseagent.core.events import EventHandler
-from houseagent.core.history import HistoryCollector, HistoryAggregator
+from houseagent.core.valuecache import ValueCache
+from houseagent.core.history import HistoryCollector, HistoryAggregator, HistoryRetention, ArchiveService
 from houseagent.core.web import Web
-from houseagent.core.database import Database
+from houseagent.core.database import Database, convert_incremental_vacuum
 from houseagent.core.databaseflash import DatabaseFlash
+from houseagent.core.databasememory import DatabaseMemory
 from twisted.internet import reactor
 from houseagent.plugins import pluginapi
           
@@ -20,8 +24,11 @@ class MainWrapper():
         self.log = pluginapi.Logging("Main")
         
         self.log.debug("Starting HouseAgent database layer...")
-        if config.embedded.enabled:
-            database = DatabaseFlash(self.log, config.general.dbfile, config.embedded.db_save_interval)
+        if config.embedded.enabled and config.embedded.mode == "memory":
+            database = DatabaseMemory(self.log, config.general.dbfile, config.embedded.db_save_interval)
+        elif config.embedded.enabled:
+            database = DatabaseFlash(self.log, config.general.dbfile, config.embedded.db_save_interval,
+                                     config.embedded.journal, config.embedded.journal_sync_interval)
         else:
             database = Database(self.log, config.general.dbfile)
         
@@ -30,18 +37,24 @@ class MainWrapper():
 
         coordinator.init_broker(config.zmq.broker_host, config.zmq.broker_port)
         
+        self.log.debug("Starting HouseAgent value cache...")
+        valuecache = ValueCache(self.log, database, coordinator)
+
         self.log.debug("Starting HouseAgent event handler...")
-        event_handler = EventHandler(self.log, coordinator, database)
+        event_handler = EventHandler(self.log, coordinator, database,
+                                     config.events.plugin_concurrency, config.events.action_timeout)
 
         self.log.debug("Starting Houseagent history aggregator")
-        histagg = HistoryAggregator(database)
+        archive = ArchiveService(config.general.dbpatharchive)
+        HistoryAggregator(database, archive)
 
         self.log.debug("Starting Houseagent history collector")
-        HistoryCollector(database, histagg)
+        HistoryCollector(database)
+        HistoryRetention(database, config.history.retention_days, config.history.incremental_vacuum)
 
         self.log.debug("Starting HouseAgent web server...")
         Web(self.log, config.webserver.host, config.webserver.port,\
-            config.webserver.backlog, coordinator, event_handler, database)
+            config.webserver.backlog, coordinator, event_handler, database, valuecache, archive)
         
         if os.name == 'nt':
             reactor.run(installSignalHandlers=0)
@@ -66,6 +79,17 @@ if __name__ == '__main__':
 
     config = Config(config_file)
 
+    if "--convert-incremental-vacuum" in sys.argv:
+        # Maintenance step, the database is rewritten so HouseAgent must not be running
+        log = pluginapi.Logging("Main")
+        log.info("Converting database %s to incremental vacuum, this may take a while..." % config.general.dbfile)
+        start = time.time()
+        if convert_incremental_vacuum(config.general.dbfile):
+            log.info("Converted database to incremental vacuum in %.1f s" % (time.time() - start))
+        else:
+            log.info("Database already uses incremental vacuum")
+        sys.exit(0)
+
     if os.name == "nt":
         if config.general.runasservice:
             pluginapi.handle_windowsservice(MainService) # We want to start as a Windows service on Windows.
@@ -0,0 +1,115 @@
+'''
+Benchmark of the history_values storage layout.
+
+Fills a history_values table the way the history collector does, one transaction
+per tick with a sample of every value, and then runs per-value range queries and
+bucket aggregates as used by the graphs. The clustered WITHOUT ROWID table keyed
+by (value_id, ts) is compared to the rowid table with separate indexes on ts and
+value_id that was used before.
+
+Usage: python benchmarks/bench_history.py [values] [ticks] [queries]
+'''
+
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+LAYOUTS = (
+    ("rowid + indexes", [
+        "CREATE TABLE history_values (value_id integer, value real, ts integer)",
+        "CREATE INDEX history_values_ts ON history_values (ts)",
+        "CREATE INDEX history_values_value_id ON history_values (value_id)",
+    ]),
+    ("clustered", [
+        "CREATE TABLE history_values (value_id integer NOT NULL, value real, ts integer NOT NULL, " +
+        "PRIMARY KEY (value_id, ts)) WITHOUT ROWID",
+    ]),
+)
+
+## Seconds between two ticks of the collector
+INTERVAL = 60
+
+
+def fill(conn, num_values, num_ticks):
+    '''
+    Insert a sample of every value per tick, one transaction per tick.
+    '''
+    for tick in xrange(num_ticks):
+        ts = tick * INTERVAL
+        conn.executemany("INSERT INTO history_values (value_id, value, ts) VALUES (?, ?, ?)",
+                         [(value_id, float(value_id + tick % 100), ts) for value_id in xrange(1, num_values + 1)])
+        conn.commit()
+
+
+def range_scans(conn, ranges):
+    rows = 0
+    for (value_id, start, end) in ranges:
+        rows += len(conn.execute("SELECT value, ts FROM history_values WHERE value_id=? AND ts >= ? AND ts < ? ORDER BY ts",
+                                 [value_id, start, end]).fetchall())
+    return rows
+
+
+def bucket_scans(conn, ranges, width):
+    rows = 0
+    for (value_id, start, end) in ranges:
+        rows += len(conn.execute("SELECT value_id, ts / ? * ? AS bucket, AVG(value), MAX(value) FROM history_values " +
+                                 "WHERE value_id IN (?, ?) AND ts >= ? AND ts < ? GROUP BY value_id, bucket ORDER BY bucket",
+                                 [width, width, value_id, value_id % 2 + 1, start, end]).fetchall())
+    return rows
+
+
+def main():
+    num_values = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    num_ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+    num_queries = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+
+    random.seed(42)
+
+    # ranges of a day of samples of random values
+    span = 1440 * INTERVAL
+    ranges = []
+    for i in range(num_queries):
+        start = random.randint(0, max(num_ticks * INTERVAL - span, 0))
+        ranges.append((random.randint(1, num_values), start, start + span))
+
+    print "sqlite %s, %d values, %d ticks (%d rows), %d queries" % (sqlite3.sqlite_version, num_values, num_ticks,
+                                                                      num_values * num_ticks, num_queries)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for (i, (name, schema)) in enumerate(LAYOUTS):
+            path = os.path.join(tmpdir, "history_%d.db" % i)
+            conn = sqlite3.connect(path)
+            conn.execute("PRAGMA synchronous = OFF")
+            for sql in schema:
+                conn.execute(sql)
+
+            start = time.time()
+            fill(conn, num_values, num_ticks)
+            inserted = time.time() - start
+
+            start = time.time()
+            scanned = range_scans(conn, ranges)
+            scans = time.time() - start
+
+            start = time.time()
+            bucket_scans(conn, ranges, 3600)
+            buckets = time.time() - start
+
+            conn.close()
+
+            print "%s:" % name
+            print "  insert:      %8.3f s (%6.2f us/row)" % (inserted, inserted * 1e6 / (num_values * num_ticks))
+            print "  range scan:  %8.3f s (%6.2f ms/query, %d rows)" % (scans, scans * 1e3 / num_queries, scanned)
+            print "  buckets:     %8.3f s (%6.2f ms/query)" % (buckets, buckets * 1e3 / num_queries)
+            print "  file size:   %8.1f MB" % (os.path.getsize(path) / 1048576.0)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+'''
+Microbenchmark for the event engine trigger lookup.
+
+Loads 10.000 device value change triggers into an EventHandler and feeds it
+100.000 value updates, compared to the linear scan over all triggers that was
+used before triggers were indexed by value id.
+
+Usage: python benchmarks/bench_triggers.py [triggers] [updates]
+'''
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from houseagent.core.events import EventHandler, Event, Trigger
+
+
+class NullLog(object):
+    def debug(self, msg):
+        pass
+
+    info = warning = error = debug
+
+
+def linear_scan(triggers, value_id):
+    '''
+    The trigger lookup as it used to be done for every value update.
+    '''
+    matches = 0
+    for t in triggers:
+        if t.type == "Device value change" and int(t.current_value_id) == int(value_id):
+            matches += 1
+    return matches
+
+
+def main():
+    num_triggers = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    num_updates = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    random.seed(42)
+
+    # Triggers are spread over twice as many values, so half the updates have no triggers
+    num_values = num_triggers * 2
+    handler = EventHandler.__new__(EventHandler)
+    handler.log = NullLog()
+    handler._events = {}
+    handler._windows = {}
+    handler._value_windows = {}
+    handler._stats = {}
+
+    triggers = []
+    events = {}
+    for i in range(num_triggers):
+        t = Trigger("Device value change", i, False)
+        t.current_value_id = unicode(random.randint(1, num_values))
+        t.condition = "gt"
+        t.condition_value = u"1000000"
+        handler._prepare_trigger(t)
+        triggers.append(t)
+
+        events[i] = Event(i)
+        events[i].triggers.append(t)
+
+    handler._set_events(events)
+
+    updates = [random.randint(1, num_values) for i in range(num_updates)]
+
+    start = time.time()
+    for value_id in updates:
+        handler.device_value_changed(value_id, "1")
+    indexed = time.time() - start
+
+    # The linear scan is slow, so only run a sample of the updates
+    sample = updates[:max(num_updates / 100, 1)]
+    start = time.time()
+    for value_id in sample:
+        linear_scan(triggers, value_id)
+    linear = (time.time() - start) * num_updates / len(sample)
+
+    print "%d triggers, %d updates" % (num_triggers, num_updates)
+    print "indexed:     %8.3f s (%6.2f us/update)" % (indexed, indexed * 1e6 / num_updates)
+    print "linear scan: %8.3f s (%6.2f us/update, extrapolated from %d updates)" % (linear, linear * 1e6 / num_updates, len(sample))
+
+
+if __name__ == '__main__':
+    main()
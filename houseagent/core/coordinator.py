@@ -57,8 +57,9 @@ class Broker(ZmqConnection):
         
         @return a Twisted deferred.
         '''
-        d = defer.Deferred()
         message_id = self.get_next_id()
+        # Forget the request when the caller gives up on it (e.g. timeout)
+        d = defer.Deferred(lambda d: self.requests.pop(message_id, None))
         self.requests[message_id] = d
         message = [routing_info, b'', chr(4), message_id, json.dumps(message)]
 
@@ -78,7 +79,11 @@ class Broker(ZmqConnection):
         message_id = payload[0]
         payload = payload[1]
         
-        d = self.requests.pop(message_id)
+        d = self.requests.pop(message_id, None)
+        if d is None:
+            self.coordinator.log.debug("Coordinator::RPC reply for unknown or cancelled request %r" % (message_id))
+            return
+        
         d.callback(json.loads(payload))
     
     def get_next_id(self):
@@ -87,7 +92,8 @@ class Broker(ZmqConnection):
         
         @return: a unique message ID
         '''
-        return 'msg_id_%d' % (self.message_id + 1,)
+        self.message_id += 1
+        return 'msg_id_%d' % (self.message_id,)
 
 class Coordinator(object):
     '''
@@ -108,6 +114,7 @@ class Coordinator(object):
         self.plugins = []
         self.crud_callbacks = []
         self.eventengine = None
+        self.valuecache = None
         
         self.plugin_cmds = { '\x01': self.handle_plugin_ready,
                              '\x02': self.handle_plugin_heartbeat,
@@ -197,6 +204,10 @@ class Coordinator(object):
                                                 plugin.id, 
                                                 message["address"], message["time"])
 
+                    # Update the in-memory value cache
+                    if self.valuecache:
+                        self.valuecache.value_changed(value_id, message["values"][key], message["time"])
+
                     # Notify the eventengine
                     if self.eventengine:
                         self.eventengine.device_value_changed(value_id, message["values"][key])
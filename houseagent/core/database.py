@@ -7,6 +7,38 @@ import os.path, sys
 import shutil
 import sqlite3 # Fix needed for PyInstaller.
 
+def numeric_value(value):
+    '''
+    Get the numeric form of a value, which is stored next to the raw value.
+    @param value: the raw value, as received from the plugin
+
+    @return: the value as float, None when it isn't numeric
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def convert_incremental_vacuum(db_location):
+    '''
+    Switch a database file to incremental auto vacuum. This requires a full VACUUM, which rewrites
+    the whole file and can take minutes on a large history, so it is a maintenance step which
+    is run while HouseAgent is stopped.
+    @param db_location: path of the database file
+
+    @return: True when the database had to be converted
+    '''
+    conn = sqlite3.connect(db_location)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+    finally:
+        conn.close()
+
 class Database():
     """
     HouseAgent database interaction.
@@ -18,16 +50,24 @@ class Database():
 
         self.coordinator = None
         self.histcollector = None
+        self.histagg = None
+        self.valuecache = None
         self._db_location = db_location
 
-        # Note: cp_max=1 is required otherwise undefined behaviour could occur when using yield icw subsequent
-        # runQuery or runOperation statements
         if type == "sqlite":
-            self.dbpool = ConnectionPool("sqlite3", db_location, check_same_thread=False, cp_max=1)
+            self.dbpool = self._create_pool(db_location)
        
         # Check database schema version and upgrade when required
-        self.updatedb('0.4')
+        self.updatedb('0.7')
              
+    def _create_pool(self, db_location):
+        '''
+        Create the connection pool for the database.
+        '''
+        # Note: cp_max=1 is required otherwise undefined behaviour could occur when using yield icw subsequent
+        # runQuery or runOperation statements
+        return ConnectionPool("sqlite3", db_location, check_same_thread=False, cp_max=1)
+
     def updatedb(self, dbversion):
         '''
         Perform a database schema update when required. 
@@ -35,11 +75,13 @@ class Database():
         # Note: runInteraction runs all queries defined within the specified function as part of a transaction.
         return self.dbpool.runInteraction(self._updatedb, dbversion)
 
-    def _updatedb(self, txn, dbversion):
+    def _updatedb(self, txn, dbversion, backup=True):
         '''
         Check whether a database schema update is required and act accordingly.
+        The update steps are run one after another, until the schema is up to date or a step fails.
         '''
         # Note: Although all queries are run as part of a transaction, a create or drop table statement result in an implicit commit
+        # The later steps are run as a single transaction each, see _run_update_step
 
         # Query the version of the current schema
         try:
@@ -65,11 +107,12 @@ class Database():
             self.log.info("Database schema will be updated from %s to %s:" % (version, dbversion))
 
             # Before we start manipulating the database schema, first make a backup copy of the database
-            try:
-                shutil.copy(self._db_location, self._db_location + datetime.datetime.strftime(datetime.datetime.now(), ".%y%m%d-%H%M%S"))
-            except:
-                self.log.error("Cannot make a backup copy of the database (%s)", sys.exc_info()[1])
-                return
+            if backup:
+                try:
+                    shutil.copy(self._db_location, self._db_location + datetime.datetime.strftime(datetime.datetime.now(), ".%y%m%d-%H%M%S"))
+                except:
+                    self.log.error("Cannot make a backup copy of the database (%s)", sys.exc_info()[1])
+                    return
 
             if version == '0.0':
                 try:
@@ -206,6 +249,99 @@ class Database():
                 except: 
                     self.log.error("Database schema upgrade failed (%s)" % sys.exc_info()[1])
 
+            elif version == '0.4':
+                # update DB schema version to '0.5'
+                def step(txn):
+                    # history retention in days per value and per history type, NULL for the default, 0 to keep forever
+                    txn.execute("ALTER TABLE current_values ADD COLUMN history_retention integer DEFAULT NULL;")
+                    txn.execute("ALTER TABLE history_types ADD COLUMN retention_days integer DEFAULT NULL;")
+
+                self._run_update_step(txn, step, '0.5')
+
+            elif version == '0.5':
+                # update DB schema version to '0.6'
+                def step(txn):
+                    # numeric form of the current values, NULL for values which aren't numeric
+                    txn.execute("ALTER TABLE current_values ADD COLUMN value_real real DEFAULT NULL;")
+                    rows = txn.execute("SELECT id, value FROM current_values;").fetchall()
+                    txn.executemany("UPDATE current_values SET value_real=? WHERE id=?;",
+                                    [(numeric_value(value), id) for (id, value) in rows])
+
+                    # history_values table, with seconds since the epoch (UTC) instead of the local date/time as text
+                    txn.execute("CREATE TABLE history_values_0_6 (value_id integer, \
+                                value real, ts integer, \
+                                FOREIGN KEY (value_id) REFERENCES current_values(id));")
+                    txn.execute("INSERT INTO history_values_0_6 \
+                                SELECT value_id, value, CAST(STRFTIME('%s', created_at, 'utc') AS INTEGER) \
+                                FROM history_values WHERE TYPEOF(value) IN ('real', 'integer') ORDER BY rowid;")
+                    self._log_dropped(txn, "history_values_0_6", "which aren't numeric")
+                    txn.execute("DROP TABLE history_values;")
+                    txn.execute("ALTER TABLE history_values_0_6 RENAME TO history_values;")
+
+                    txn.execute("CREATE INDEX 'history_values.idx_history_values_ts1' \
+                                    ON history_values (ts);")
+                    txn.execute("CREATE INDEX 'history_values.idx_history_values_value_id1' \
+                                    ON history_values (value_id);")
+
+                self._run_update_step(txn, step, '0.6')
+
+            elif version == '0.6':
+                # update DB schema version to '0.7'
+                def step(txn):
+                    # history_values table, clustered by value and time instead of a heap with two indexes
+                    txn.execute("CREATE TABLE history_values_0_7 (value_id integer NOT NULL, \
+                                value real, ts integer NOT NULL, \
+                                PRIMARY KEY (value_id, ts), \
+                                FOREIGN KEY (value_id) REFERENCES current_values(id)) WITHOUT ROWID;")
+                    # the first of several samples of a value with the same timestamp is kept
+                    txn.execute("INSERT OR IGNORE INTO history_values_0_7 \
+                                SELECT value_id, value, ts FROM history_values \
+                                WHERE value_id IS NOT NULL AND ts IS NOT NULL ORDER BY rowid;")
+                    self._log_dropped(txn, "history_values_0_7", "without a value id or with a duplicate timestamp")
+                    txn.execute("DROP TABLE history_values;")
+                    txn.execute("ALTER TABLE history_values_0_7 RENAME TO history_values;")
+
+                self._run_update_step(txn, step, '0.7')
+
+            # Continue with the next update step when this one succeeded
+            result = txn.execute("SELECT parm_value FROM common WHERE parm = 'schema_version'").fetchall()
+            if result and result[0][0] != version:
+                return self._updatedb(txn, dbversion, False)
+
+    def _run_update_step(self, txn, step, version):
+        '''
+        Run a schema update step as a single transaction, so a failed step leaves the database as it was.
+        The sqlite3 module commits before every DDL statement, so it is switched to manual transactions meanwhile.
+        @param step: function which runs the statements of the step on the transaction
+        @param version: the schema version after the step, stored as the last statement of the step
+        '''
+        conn = txn.connection
+        conn.commit()
+        isolation_level = conn.isolation_level
+        conn.isolation_level = None
+        try:
+            txn.execute("BEGIN;")
+            try:
+                step(txn)
+                txn.execute("UPDATE common SET parm_value=? WHERE parm='schema_version';", [version])
+                txn.execute("COMMIT;")
+            except:
+                txn.execute("ROLLBACK;")
+                self.log.error("Database schema upgrade failed (%s)" % sys.exc_info()[1])
+                raise
+        finally:
+            conn.isolation_level = isolation_level
+
+        self.log.info("Successfully upgraded database schema to schema version %s" % version)
+
+    def _log_dropped(self, txn, table, reason):
+        '''
+        Log the number of history values which were not copied to the new history_values table.
+        '''
+        dropped = txn.execute("SELECT (SELECT COUNT(*) FROM history_values) - (SELECT COUNT(*) FROM %s);" % table).fetchone()[0]
+        if dropped:
+            self.log.warning("Dropped %d history values %s" % (dropped, reason))
+
     def query_plugin_auth(self, authcode):
         return self.dbpool.runQuery("SELECT authcode, id from plugins WHERE authcode = '%s'" % authcode)
 
@@ -323,6 +459,8 @@ class Database():
         for name, value in trigger["parameters"].iteritems():
             yield self.dbpool.runQuery("INSERT INTO trigger_parameters (name, value, " +
                                        "triggers_id) VALUES (?, ?, ?)", [name, value, trigger_id])
+        
+        returnValue(eventid)
                
     
     def add_trigger(self, trigger_type_id, event_id, value_id, parameters):
@@ -369,6 +507,50 @@ class Database():
         return self.dbpool.runQuery("SELECT actions.id, action_types.name, actions.events_id " + 
                                     "FROM actions INNER JOIN action_types ON (actions.action_types_id = action_types.id)")
 
+    def _query_with_parameters(self, sql, event_column, event_id):
+        if event_id is not None:
+            return self.dbpool.runQuery(sql % ("WHERE %s = ?" % event_column), [event_id])
+        return self.dbpool.runQuery(sql % "")
+
+    def query_triggers_with_parameters(self, event_id=None):
+        '''
+        Query triggers joined with their parameters, one row per parameter.
+        @param event_id: only query the triggers of this event
+        
+        @return: a Twisted deferred which fires with (id, type, event id, conditions, parameter name, parameter value) rows
+        '''
+        return self._query_with_parameters("SELECT triggers.id, trigger_types.name, triggers.events_id, triggers.conditions, " +
+                                           "trigger_parameters.name, trigger_parameters.value FROM triggers " +
+                                           "INNER JOIN trigger_types ON (triggers.trigger_types_id = trigger_types.id) " +
+                                           "LEFT OUTER JOIN trigger_parameters ON (trigger_parameters.triggers_id = triggers.id) " +
+                                           "%s ORDER BY triggers.id", "triggers.events_id", event_id)
+
+    def query_conditions_with_parameters(self, event_id=None):
+        '''
+        Query conditions joined with their parameters, one row per parameter.
+        @param event_id: only query the conditions of this event
+        
+        @return: a Twisted deferred which fires with (id, type, event id, parameter name, parameter value) rows
+        '''
+        return self._query_with_parameters("SELECT conditions.id, condition_types.name, conditions.events_id, " +
+                                           "condition_parameters.name, condition_parameters.value FROM conditions " +
+                                           "INNER JOIN condition_types ON (conditions.condition_types_id = condition_types.id) " +
+                                           "LEFT OUTER JOIN condition_parameters ON (condition_parameters.conditions_id = conditions.id) " +
+                                           "%s ORDER BY conditions.id", "conditions.events_id", event_id)
+
+    def query_actions_with_parameters(self, event_id=None):
+        '''
+        Query actions joined with their parameters, one row per parameter.
+        @param event_id: only query the actions of this event
+        
+        @return: a Twisted deferred which fires with (id, type, event id, parameter name, parameter value) rows
+        '''
+        return self._query_with_parameters("SELECT actions.id, action_types.name, actions.events_id, " +
+                                           "action_parameters.name, action_parameters.value FROM actions " +
+                                           "INNER JOIN action_types ON (actions.action_types_id = action_types.id) " +
+                                           "LEFT OUTER JOIN action_parameters ON (action_parameters.actions_id = actions.id) " +
+                                           "%s ORDER BY actions.id", "actions.events_id", event_id)
+
     def query_trigger_parameters(self, trigger_id):
         return self.dbpool.runQuery("SELECT name, value from trigger_parameters WHERE triggers_id = ?", [trigger_id])
     
@@ -383,6 +565,37 @@ class Database():
                                     "INNER JOIN plugins ON (devices.plugin_id = plugins.id) "
                                     "WHERE devices.id = ?", [device_id])
 
+    def query_devices_routing(self, device_ids=None):
+        '''
+        Query the routing information of several devices at once.
+        @param device_ids: the ids of the devices, None queries all devices
+        
+        @return: a Twisted deferred which fires with (id, address, plugin authcode) rows
+        '''
+        sql = ("SELECT devices.id, devices.address, plugins.authcode FROM devices " +
+               "INNER JOIN plugins ON (devices.plugin_id = plugins.id)")
+        if device_ids is None:
+            return self.dbpool.runQuery(sql)
+        
+        device_ids = list(device_ids)
+        return self.dbpool.runQuery(sql + " WHERE devices.id IN (%s)" % ",".join("?" * len(device_ids)), device_ids)
+
+    def query_values_control(self, value_ids=None):
+        '''
+        Query the name, label and control type of several values at once.
+        @param value_ids: the ids of the values, None queries all values
+        
+        @return: a Twisted deferred which fires with (id, name, label, control type name) rows
+        '''
+        sql = ("SELECT current_values.id, current_values.name, current_values.label, control_types.name FROM current_values " + 
+               "INNER JOIN devices ON (current_values.device_id = devices.id) " +
+               "LEFT OUTER JOIN control_types ON (control_types.id = current_values.control_type_id)")
+        if value_ids is None:
+            return self.dbpool.runQuery(sql)
+        
+        value_ids = list(value_ids)
+        return self.dbpool.runQuery(sql + " WHERE current_values.id IN (%s)" % ",".join("?" * len(value_ids)), value_ids)
+
     def query_value_properties(self, value_id):
         return self.dbpool.runQuery("SELECT current_values.name, devices.address, devices.plugin_id, current_values.label from current_values " + 
                                     "INNER JOIN devices ON (current_values.device_id = devices.id) " + 
@@ -400,7 +613,8 @@ class Database():
         @param label: the predfined label of the value.
         @param device_id: the id of the device.
         '''
-        return self.dbpool.runQuery("INSERT into current_values (name, label, device_id) VALUES (?, ?, ?)", (value_id, label, device_id))
+        return self.dbpool.runQuery("INSERT into current_values (name, label, device_id) VALUES (?, ?, ?)", (value_id, label, device_id)) \
+                          .addCallback(self.cb_value_crud, "reload")
       
     def del_value_by_name_and_device_id(self, name, device_id):
         '''
@@ -408,14 +622,15 @@ class Database():
         @param name: the name of the value
         @param device_id: the device_id
         '''
-        return self.dbpool.runQuery("DELETE from current_values WHERE name=? and device_id=?", (name, device_id))  
+        return self.dbpool.runQuery("DELETE from current_values WHERE name=? and device_id=?", (name, device_id)) \
+                          .addCallback(self.cb_value_crud, "reload")
 
     def del_value(self, id):
         '''
         This function deletes a value by id.
         @param id: the value id
         '''
-        return self.dbpool.runQuery("DELETE from current_values WHERE id=?", [id])  
+        return self.dbpool.runQuery("DELETE from current_values WHERE id=?", [id]).addCallback(self.cb_value_crud, "delete", id)
 
     @inlineCallbacks
     def update_or_add_value(self, name, value, pluginid, address, time=None):
@@ -453,9 +668,9 @@ class Database():
             history_type = current_value[0][2]
             history_period = current_value[0][3]
             
-            yield self.dbpool.runQuery("UPDATE current_values SET value=?, lastupdate=? WHERE id=?", (value, updatetime, value_id))
+            yield self.dbpool.runQuery("UPDATE current_values SET value=?, value_real=?, lastupdate=? WHERE id=?", (value, numeric_value(value), updatetime, value_id))
         else:
-            yield self.dbpool.runQuery("INSERT INTO current_values (name, value, device_id, lastupdate) VALUES (?, ?, (SELECT id FROM devices WHERE address=? AND plugin_id=?),  ?)", (name, value, address, pluginid, updatetime))
+            yield self.dbpool.runQuery("INSERT INTO current_values (name, value, value_real, device_id, lastupdate) VALUES (?, ?, ?, (SELECT id FROM devices WHERE address=? AND plugin_id=?),  ?)", (name, value, numeric_value(value), address, pluginid, updatetime))
             current_value = yield self.dbpool.runQuery("SELECT id FROM current_values WHERE name=? AND device_id=?", (name, device_id))
             value_id = current_value[0][0]
                         
@@ -510,6 +725,28 @@ class Database():
         if self.coordinator:
             self.coordinator.send_crud_update("device", action, parameters)    
 
+    def cb_value_crud(self, result, action, id=None):
+        '''
+        Callback function that get's called when a value, or data shown along with values (e.g. a device name),
+        has been changed in the database. It keeps the in-memory value cache up to date.
+        @param result: the result of the action
+        @param action: the action initiating the callback being update, delete or reload
+        @param id: the id of the value in case of an update or delete
+        '''
+        if not self.valuecache:
+            return result
+
+        if action == "delete":
+            self.valuecache.remove_value(id)
+            return result
+        elif action == "update":
+            d = self.valuecache.refresh_value(id)
+        else:
+            d = self.valuecache.load()
+
+        d.addCallback(lambda _: result)
+        return d
+
     def save_device(self, name, address, plugin_id, location_id, id=None):
         '''
         This functions saves a device in the HouseAgent database.
@@ -525,23 +762,25 @@ class Database():
                                         (name, address, plugin_id, location_id)).addCallback(self.cb_device_crud, "create")
         else:
             return self.dbpool.runQuery("UPDATE devices SET name=?, address=?, plugin_id=?, location_id=? WHERE id=?", \
-                                        (name, address, plugin_id, location_id, id)).addCallback(self.cb_device_crud, "update", id)
+                                        (name, address, plugin_id, location_id, id)).addCallback(self.cb_device_crud, "update", id) \
+                                                                                     .addCallback(self.cb_value_crud, "reload")
 
     def save_value(self, label, history_type, history_period, control_type, id):
         return self.dbpool.runQuery("UPDATE current_values SET label=?, history_type_id=?, history_period_id=?, control_type_id=? WHERE id=?", \
-                                    (label, history_type, history_period, control_type, id))     
+                                    (label, history_type, history_period, control_type, id)).addCallback(self.cb_value_crud, "update", id)
 
     def del_device(self, id):
         
         def delete(result, id):
-            self.dbpool.runQuery("DELETE FROM devices WHERE id=?", [id]).addCallback(self.cb_device_crud, "delete", id, result[0][0], result[0][1], result[0][2], result[0][3])
+            return self.dbpool.runQuery("DELETE FROM devices WHERE id=?", [id]).addCallback(self.cb_device_crud, "delete", id, result[0][0], result[0][1], result[0][2], result[0][3]) \
+                                                                        .addCallback(self.cb_value_crud, "reload")
         
         return self.dbpool.runQuery("SELECT plugins.authcode, devices.address, devices.name, locations.name " +
                                     "FROM devices LEFT JOIN plugins ON devices.plugin_id = plugins.id LEFT JOIN locations ON devices.location_id = locations.id " +
                                     "WHERE devices.id=?", [id]).addCallback(delete, id)
 
     def del_location(self, id):
-        return self.dbpool.runQuery("DELETE FROM locations WHERE id=?", [id])
+        return self.dbpool.runQuery("DELETE FROM locations WHERE id=?", [id]).addCallback(self.cb_value_crud, "reload")
 
     @inlineCallbacks
     def del_event(self, id):
@@ -562,21 +801,30 @@ class Database():
         yield self.dbpool.runQuery("DELETE FROM events where id=?", [id])
 
     def del_plugin(self, id):
-        return self.dbpool.runQuery("DELETE FROM plugins WHERE id=?", [id])
+        return self.dbpool.runQuery("DELETE FROM plugins WHERE id=?", [id]).addCallback(self.cb_value_crud, "reload")
 
     def query_locations(self):
         return self.dbpool.runQuery("select locations.id, locations.name, l2.name from locations " +  
                                     "left join locations as l2 on locations.parent=l2.id")
 
+    _query_values_sql = ("SELECT current_values.name, current_values.value, devices.name, " + 
+                         "current_values.lastupdate, plugins.name, devices.address, locations.name, current_values.id" + 
+                         ", control_types.name, control_types.id, history_types.name, history_periods.name, plugins.id, current_values.label FROM current_values INNER " +
+                         "JOIN devices ON (current_values.device_id = devices.id) INNER JOIN plugins ON (devices.plugin_id = plugins.id) " + 
+                         "LEFT OUTER JOIN locations ON (devices.location_id = locations.id) " + 
+                         "LEFT OUTER JOIN control_types ON (current_values.control_type_id = control_types.id) " +
+                         "LEFT OUTER JOIN history_types ON (current_values.history_type_id = history_types.id) " +
+                         "LEFT OUTER JOIN history_periods ON (current_values.history_period_id = history_periods.id)")
+
     def query_values(self):
-        return self.dbpool.runQuery("SELECT current_values.name, current_values.value, devices.name, " + 
-                               "current_values.lastupdate, plugins.name, devices.address, locations.name, current_values.id" + 
-                               ", control_types.name, control_types.id, history_types.name, history_periods.name, plugins.id, current_values.label FROM current_values INNER " +
-                               "JOIN devices ON (current_values.device_id = devices.id) INNER JOIN plugins ON (devices.plugin_id = plugins.id) " + 
-                               "LEFT OUTER JOIN locations ON (devices.location_id = locations.id) " + 
-                               "LEFT OUTER JOIN control_types ON (current_values.control_type_id = control_types.id) " +
-                               "LEFT OUTER JOIN history_types ON (current_values.history_type_id = history_types.id) " +
-                               "LEFT OUTER JOIN history_periods ON (current_values.history_period_id = history_periods.id)")
+        return self.dbpool.runQuery(self._query_values_sql)
+
+    def query_value(self, value_id):
+        '''
+        This function queries a single value, the output format is equal to query_values().
+        @param value_id: the value id
+        '''
+        return self.dbpool.runQuery(self._query_values_sql + " WHERE current_values.id = ?", [value_id])
 
     def query_values_light(self):
         return self.dbpool.runQuery("SELECT id, IFNULL(label, name), history_period_id, history_type_id FROM current_values;")
@@ -628,15 +876,161 @@ class Database():
     def query_history_periods(self):
         return self.dbpool.runQuery("SELECT id, name, secs, sysflag FROM history_periods;")
 
+    def query_history_enabled(self):
+        '''
+        @return: (id, history type name) rows of all values with history enabled
+        '''
+        return self.dbpool.runQuery("SELECT current_values.id, history_types.name FROM current_values " +
+                                    "INNER JOIN history_periods ON (current_values.history_period_id = history_periods.id) " +
+                                    "LEFT OUTER JOIN history_types ON (current_values.history_type_id = history_types.id) " +
+                                    "WHERE history_periods.secs != 0;")
+
     def query_history_values(self, date_from, date_to):
-        return self.dbpool.runQuery("SELECT value, created_at FROM history_values WHERE created_at >= '%s' AND created_at < '%s';" % (date_from, date_to))
+        return self.dbpool.runQuery("SELECT value, ts FROM history_values WHERE ts >= ? AND ts < ?;", [int(date_from), int(date_to)])
+
+    def query_history_values_by_id(self, value_id, start=None, end=None):
+        """
+        return 'current' historic values for given value id, in time order
+        @param start: start of the range in seconds since the epoch, None for no limit
+        @param end: end of the range in seconds since the epoch, None for no limit
+        """
+        sql = "SELECT value, ts FROM history_values WHERE value_id=?"
+        params = [value_id]
+        if start is not None:
+            sql += " AND ts >= ?"
+            params.append(int(start))
+        if end is not None:
+            sql += " AND ts < ?"
+            params.append(int(end))
+
+        return self.dbpool.runQuery(sql + " ORDER BY ts;", params)
+
+    def query_history_buckets(self, value_ids, start, end, width, functions, offset=0):
+        """
+        aggregate historic values of several values per time bucket, in one grouped query
+        @param value_ids: list of value ids
+        @param start: start of the range in seconds since the epoch
+        @param end: end of the range in seconds since the epoch
+        @param width: bucket width in seconds
+        @param functions: list of SQL aggregate functions, e.g. ['AVG', 'MAX']
+        @param offset: seconds added to the timestamps before they are bucketed, e.g. the UTC offset
+                       of the local time so buckets of a day start at local midnight
+
+        @return: (value_id, bucket, aggregates...) rows, bucket is the start of the bucket in seconds since the epoch
+        """
+        return self.dbpool.runQuery("SELECT value_id, (ts + ?) / ? * ? - ? AS bucket, %s \
+                                     FROM history_values WHERE value_id IN (%s) AND ts >= ? AND ts < ? \
+                                     GROUP BY value_id, bucket ORDER BY bucket;" %
+                                    (", ".join("%s(value)" % f for f in functions), ",".join("?" * len(value_ids))),
+                                    [offset, width, width, offset] + list(value_ids) + [int(start), int(end)])
+
+    def query_history_retention_cutoffs(self, default_days):
+        """
+        get the retention cutoff of every value with history values
+        @param default_days: retention of values without a value or history type retention, 0 to keep forever
+
+        @return: list of (value_id, cutoff) tuples, history values older than the cutoff have expired
+        """
+        return self.dbpool.runInteraction(self._history_retention_cutoffs, default_days)
+
+    def _history_retention_cutoffs(self, txn, default_days):
+        now = txn.execute("SELECT CAST(STRFTIME('%s', 'now') AS INTEGER)").fetchone()[0]
+        days = dict(txn.execute("SELECT current_values.id, COALESCE(current_values.history_retention, history_types.retention_days, ?) " +
+                                "FROM current_values LEFT OUTER JOIN history_types ON (current_values.history_type_id = history_types.id)",
+                                [default_days]).fetchall())
+
+        # walk the value ids of the history, one primary key seek per value, history of removed values
+        # uses the default retention
+        cutoffs = []
+        row = txn.execute("SELECT MIN(value_id) FROM history_values").fetchone()
+        while row and row[0] is not None:
+            value_id = row[0]
+            retention = days.get(value_id, default_days)
+            if retention > 0:
+                cutoffs.append((value_id, now - retention * 86400))
+            row = txn.execute("SELECT value_id FROM history_values WHERE value_id > ? ORDER BY value_id LIMIT 1",
+                              [value_id]).fetchone()
+        return cutoffs
+
+    def purge_history_values(self, value_id, cutoff, limit):
+        """
+        delete the oldest expired history values of a value
+        @param cutoff: history values older than the cutoff (seconds since the epoch) have expired
+        @param limit: the maximum number of rows to delete
+
+        @return: the number of deleted rows
+        """
+        return self.dbpool.runInteraction(self._purge_history_values, value_id, cutoff, limit)
+
+    def _purge_history_values(self, txn, value_id, cutoff, limit):
+        # stop at the ts of the last row within the limit, when more rows have expired
+        txn.execute("DELETE FROM history_values WHERE value_id = ? AND ts < ? AND ts <= COALESCE(" +
+                    "(SELECT ts FROM history_values WHERE value_id = ? AND ts < ? ORDER BY ts LIMIT 1 OFFSET ?), ?)",
+                    [value_id, cutoff, value_id, cutoff, limit - 1, cutoff])
+        return txn.rowcount
+
+    def query_auto_vacuum(self):
+        """
+        @return: the auto vacuum mode of the database, 0 none, 1 full, 2 incremental
+        """
+        return self.dbpool.runQuery("PRAGMA auto_vacuum")
+
+    def incremental_vacuum(self, pages):
+        """
+        release free pages of the database file
+        @param pages: the maximum number of pages to release
 
-    def cleanup_history_values(self):
-        """keep 7 days history of history_values table"""
-        return self.dbpool.runQuery("DELETE FROM history_values WHERE created_at < DATETIME(DATETIME(), 'localtime', '-7 day');")
+        @return: the number of free pages left
+        """
+        return self.dbpool.runWithConnection(self._incremental_vacuum, pages)
+
+    def _incremental_vacuum(self, conn, pages):
+        conn.execute("PRAGMA incremental_vacuum(%d)" % pages).fetchall()
+        return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def collect_history_values(self, value_ids):
+        '''
+        Take a history sample of a list of values, in a single transaction.
+        @param value_ids: list of value ids
+
+        @return: a Twisted deferred with a list of the (value_id, value, ts) samples written
+        '''
+        return self.dbpool.runInteraction(self._collect_history_values, list(value_ids))
+
+    def _collect_history_values(self, txn, value_ids):
+        # All samples of a tick share the same timestamp, in seconds since the epoch
+        ts = txn.execute("SELECT CAST(STRFTIME('%s', 'now') AS INTEGER)").fetchone()[0]
+
+        # Stay below the SQLite limit of 999 host parameters, values which aren't numeric are skipped
+        samples = []
+        for i in range(0, len(value_ids), 500):
+            chunk = value_ids[i:i + 500]
+            samples.extend((value_id, value, ts) for (value_id, value) in
+                           txn.execute("SELECT id, value_real FROM current_values WHERE id IN (%s) AND value_real IS NOT NULL;" %
+                                       ",".join("?" * len(chunk)), chunk).fetchall())
+
+        # A value sampled twice in the same second (e.g. after a clock step back) keeps its stored sample,
+        # the samples of the other values are still written
+        written = []
+        for sample in samples:
+            txn.execute("INSERT OR IGNORE INTO history_values (value_id, value, ts) VALUES (?, ?, ?);", sample)
+            if txn.rowcount:
+                written.append(sample)
+
+        if len(written) < len(samples):
+            self.log.warning("Skipped %d history samples with the timestamp of a stored sample" % (len(samples) - len(written)))
+        return written
+
+    def query_history_samples(self, start, end):
+        '''
+        @param start: start of the range (inclusive) in seconds since the epoch
+        @param end: end of the range (exclusive) in seconds since the epoch
 
-    def collect_history_values(self, value_id):
-        return self.dbpool.runQuery("INSERT INTO history_values SELECT id, value, DATETIME(DATETIME(), 'localtime') FROM current_values WHERE id=?;", [value_id])
+        @return: (value_id, value, ts) rows of all collected samples in the range, in time order
+        '''
+        # a range of the primary key of every value, instead of a scan of the whole table
+        return self.dbpool.runQuery("SELECT value_id, value, ts FROM history_values WHERE value_id IN (SELECT id FROM current_values) " +
+                                    "AND ts >= ? AND ts < ? ORDER BY ts, value_id;", [start, end])
 
     # /history collector stuff
 
@@ -666,6 +1060,16 @@ class Database():
     def query_value_by_valueid(self, value_id):
         return self.dbpool.runQuery("SELECT value,name from current_values WHERE id = ? LIMIT 1", [value_id])
     
+    def query_values_by_valueids(self, value_ids):
+        '''
+        Query the current value of several values at once.
+        @param value_ids: a list of value ids
+        
+        @return: a Twisted deferred which fires with a list of (id, value) rows
+        '''
+        return self.dbpool.runQuery("SELECT id, value FROM current_values WHERE id IN (%s)" % 
+                                    ",".join("?" * len(value_ids)), list(value_ids))
+    
     def query_extra_valueinfo(self, value_id):
         return self.dbpool.runQuery("select devices.name, current_values.name from current_values " +
                                     "inner join devices on (current_values.device_id = devices.id) " + 
@@ -681,16 +1085,17 @@ class Database():
             self.histcollector.cb_register_schedule(int(id), history_period)
 
         d.addCallback(histcollector_refresh, id, history_period)
+        d.addCallback(self.cb_value_crud, "update", id)
         return d
     
     def set_controltype(self, id, control_type):
-        return self.dbpool.runQuery("UPDATE current_values SET control_type_id=? WHERE id=?", [control_type, id])
+        return self.dbpool.runQuery("UPDATE current_values SET control_type_id=? WHERE id=?", [control_type, id]).addCallback(self.cb_value_crud, "update", id)
 
     def update_location(self, id, name, parent):
-        return self.dbpool.runQuery("UPDATE locations SET name=?, parent=? WHERE id=?", [name, parent, id])
+        return self.dbpool.runQuery("UPDATE locations SET name=?, parent=? WHERE id=?", [name, parent, id]).addCallback(self.cb_value_crud, "reload")
     
     def update_plugin(self, id, name, location):
-        return self.dbpool.runQuery("UPDATE plugins SET name=?, location_id=? WHERE id=?", [name, location, id])
+        return self.dbpool.runQuery("UPDATE plugins SET name=?, location_id=? WHERE id=?", [name, location, id]).addCallback(self.cb_value_crud, "reload")
     
     def query_events(self):
         return self.dbpool.runQuery("SELECT id, name, enabled from events")
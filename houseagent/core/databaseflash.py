@@ -5,39 +5,109 @@ Created on Oct 5, 2011
 @author: Daniel Berenguer
 '''
 
-from database import Database
-#from database import Database, DataHistory
+from database import Database, numeric_value
 from twisted.internet import reactor, defer
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import LoopingCall
+from time import mktime
 
 import datetime
+import os
+import struct
 import sys
+import time
+import zlib
+
+
+def record_size(values):
+    '''
+    Get the size of a row in the SQLite record format, which is the payload written to the database file.
+    @param values: the column values of the row
+
+    @return: the size in bytes
+    '''
+    # one byte for the header size and a serial type per column, the body by type
+    size = 1
+    for value in values:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        if isinstance(value, str):
+            size += (1 if len(value) * 2 + 13 < 128 else 2) + len(value)
+        elif isinstance(value, float):
+            size += 1 + 8
+        elif isinstance(value, (int, long)):
+            # 0 and 1 are stored in the serial type
+            size += 1
+            if value not in (0, 1):
+                for (n, bits) in ((1, 7), (2, 15), (3, 23), (4, 31), (6, 47), (8, 63)):
+                    if -(1 << bits) <= value < (1 << bits):
+                        size += n
+                        break
+        else:
+            size += 1
+    return size
 
 
 class DatabaseFlash(Database):
     '''
     HouseAgent database optimized for flash drives.
-    This database subclass caches the value updates in a list by means of a CurrentValueTable
-    object. Then, "in-memory" values are saved back to the current_values table whenever a
-    query is launched from the web or periodically 
+    This database subclass caches the value updates in memory by means of a CurrentValueTable
+    object. Devices and values are resolved from memory as well, so that the database is only
+    touched when a new value is created and when "in-memory" values and history samples are
+    saved back to the database periodically.
+    Optionally, value changes are recorded in an append-only ChangeJournal so that a power
+    failure between two periodic saves loses seconds of data instead of a full interval.
+    Readers such as the web interface get live values from the ValueCache instead.
     '''              
-    def __init__(self, log, db_location, interval):
+    def __init__(self, log, db_location, interval, journal=False, journal_sync_interval=5):
         '''
         Class constructor
         
         @param log: logging object
         @param interval: elapsed seconds between periodic data saves (cache to database)
+        @param journal: keep a journal of value changes between periodic saves
+        @param journal_sync_interval: elapsed seconds between journal syncs (fsync)
         '''
         Database.__init__(self, log, db_location)
-        # Create list of current values
-        self.curr_values = CurrentValueTable(self.dbpool)
+        
+        # Replay the journal of the previous run before the current values are loaded
+        self.journal = None
+        if journal:
+            self.journal = ChangeJournal(db_location + '.journal', log, journal_sync_interval)
+            self.journal.replay(self.dbpool)
+            
+        # Device ids, keyed by (plugin_id, address)
+        self.devices = {}
+        self._load_devices()
+
+        # Create table of current values
+        self.curr_values = CurrentValueTable(self.dbpool, log, self.journal)
 
         # Periodic write of current values in database
         if interval > 0:
             lp = LoopingCall(self.curr_values.save_values_in_db)
             lp.start(interval, False)
 
+        # Write pending values before shutting down
+        reactor.addSystemEventTrigger('before', 'shutdown', self.curr_values.save_values_in_db)
+
+
+    @inlineCallbacks
+    def _load_devices(self, result=None):
+        '''
+        (Re)load the in-memory device lookup table.
+        
+        @param result: result of a preceding action, passed through when used as callback
+        '''
+        rows = yield self.dbpool.runQuery("SELECT id, plugin_id, address FROM devices")
+
+        devices = {}
+        for row in rows:
+            devices[(row[1], row[2])] = row[0]
+        self.devices = devices
+
+        returnValue(result)
+
 
     @inlineCallbacks
     def update_or_add_value(self, name, value, pluginid, address, time=None):
@@ -52,112 +122,139 @@ class DatabaseFlash(Database):
         @param time: the time at which the update has been received, this defaults to now()
         '''
         if not time:
-            updatetime = datetime.datetime.now().isoformat(' ').split('.')[0]
+            now = datetime.datetime.now()
+            updatetime = now.isoformat(' ').split('.')[0]
+            timestamp = int(mktime(now.timetuple()))
         else:
             updatetime = datetime.datetime.fromtimestamp(time).isoformat(' ').split('.')[0]
+            timestamp = int(time)
 
-        # Query device first
-        device = yield self.dbpool.runQuery('select id from devices WHERE plugin_id = ? and address = ? LIMIT 1', (pluginid, address) )
+        if not self.curr_values.loaded:
+            yield self.curr_values.wait_loaded()
 
-        try:
-            device_id = device[0][0]
-        except:
+        # Resolve device first
+        device_id = self.devices.get((pluginid, address))
+        if device_id is None:
             returnValue('') # device does not exist
         
-        current_value = yield self.curr_values.query_static_data(name=name, device_id=device_id)
-    
-        try:
-            value_id = current_value[0][0]
-        except:
-            value_id = None
+        value_id = self.curr_values.get_value_id(device_id, name)
     
-        # If current value found in database
+        # If current value is known
         if value_id:
-            # Get current value from list
-            curr_val = self.curr_values.get_current_value(value_id)
-            if curr_val is not None:
-                # Update value
-                curr_val.value = value
-                curr_val.last_update = updatetime
-
-            # XXX: need to be rewriten
-            # Log value?
-            if current_value[0][2] not in (0, None):
-                DataHistory("data", value_id, value, "GAUGE", 60, int(time))                
+            # Update in-memory value
+            self.curr_values.update_value(value_id, value, updatetime)
+            
+            if self.journal:
+                self.journal.append(value_id, value, timestamp)
         else:
             # Insert new row in current_values
-            yield self.curr_values.insert_value_in_db(name, value, address, pluginid, updatetime)
-            # Query last inserted row
-            current_value = yield self.curr_values.query_static_data(name=name, device_id=device_id)
-            value_id = current_value[0][0]
-            # Add new value to the list
-            curr_val = CurrentValue(value_id, value, updatetime)
+            value_id = yield self.curr_values.insert_value_in_db(name, value, device_id, updatetime)
+            # Add new value to the table
+            curr_val = CurrentValue(value_id, value, updatetime, device_id, name)
             self.curr_values.add_value(curr_val)
                         
         returnValue(value_id)
                
 
-    def query_values(self):
+    def query_value_by_valueid(self, value_id):
         """
-        Query current values
-        Cached values are saved into database each time this method is called
+        Query a given value
         
-        @return List of values
+        @param value_id: Value ID
+        
+        @return Deferred object
         """
-        # Update database from current values in memory
-        self.curr_values.save_values_in_db()
-        # Query database
-        return Database.query_values(self)
-
+        try:
+            curr_val = self.curr_values.get_current_value(int(value_id))
+        except (TypeError, ValueError):
+            curr_val = None
+            
+        if curr_val is not None:
+            return defer.succeed([(curr_val.value, curr_val.name)])
+        
+        return Database.query_value_by_valueid(self, value_id)
 
-    def query_controllable_devices(self):
+    def query_values_by_valueids(self, value_ids):
         """
-        Query controllable values
-        Cached values are saved into database each time this method is called
+        Overriden method
+        Query the current value of several values, served from memory when possible
+        
+        @param value_ids: list of Value IDs
         
-        @return list of values
+        @return Deferred object
         """
-        # Update database from current values in memory
-        self.curr_values.save_values_in_db()
-        # Query database
-        return Database.query_controllable_devices(self)
-
+        rows = []
+        missing = []
+        for value_id in value_ids:
+            curr_val = self.curr_values.get_current_value(value_id)
+            if curr_val is not None:
+                rows.append((value_id, curr_val.value))
+            else:
+                missing.append(value_id)
         
-    def query_value_by_valueid(self, value_id):
+        if not missing:
+            return defer.succeed(rows)
+        
+        return Database.query_values_by_valueids(self, missing).addCallback(lambda result: rows + list(result))
+
+
+    def collect_history_values(self, value_ids):
         """
-        Query a given value
+        Overriden method
+        Take a history sample of a list of values. Samples are buffered in memory and saved in batches.
         
-        @param value_id: Value ID
+        @param value_ids: list of value IDs
         
-        @return Deferred object
+        @return: Deferred object to a list of the (value_id, value, ts) samples taken
         """
-        d = defer.Deferred()
-    
-        @inlineCallbacks
-        def get_result():
-            # Query static data (format of the output: [id, name, history])
-            value = yield self.curr_values.query_static_data(id=value_id)
-            # Get actual current value
+        curr_vals = []
+        for value_id in value_ids:
             curr_val = self.curr_values.get_current_value(value_id)
             if curr_val is not None:
-                result = [(curr_val.value, value[0][0])]
-                d.callback(result)
-       
-        reactor.callLater(0, get_result)               
+                curr_vals.append(curr_val)
+        
+        return defer.succeed(self.curr_values.add_history_samples(curr_vals))
+
+
+    def add_value_with_label(self, value_id, label, device_id):
+        d = Database.add_value_with_label(self, value_id, label, device_id)
+        d.addCallback(self.curr_values.reload)
+        return d
+
+
+    def del_value_by_name_and_device_id(self, name, device_id):
+        d = Database.del_value_by_name_and_device_id(self, name, device_id)
+        d.addCallback(self.curr_values.remove_value_by_name, name, device_id)
+        return d
+
+
+    def del_value(self, id):
+        d = Database.del_value(self, id)
+        d.addCallback(self.curr_values.remove_value, int(id))
         return d
-   
+
+
+    def save_device(self, name, address, plugin_id, location_id, id=None):
+        return Database.save_device(self, name, address, plugin_id, location_id, id).addCallback(self._load_devices)
+
+
+    def del_device(self, id):
+        return Database.del_device(self, id).addCallback(self._load_devices)
+
         
 class CurrentValue:
     """
     Class representation of current value
     """
-    def __init__(self, val_id, value, last_update):
+    def __init__(self, val_id, value, last_update, device_id=None, name=None):
         """
         Class constructor
         
         @param val_id: id of the table row (current_value) within SQLite
         @param value: current value in string format
         @param last_update: last update time
+        @param device_id: id of the device the value belongs to
+        @param name: name of the value
         """
         ## id of the table row within SQLite
         self.id = val_id
@@ -165,23 +262,47 @@ class CurrentValue:
         self.value = value
         ## Last update time
         self.last_update = last_update
+        ## Device id
+        self.device_id = device_id
+        ## Name of the value
+        self.name = name
         
         
 class CurrentValueTable:
     """
     Class representing HouseAgent's current_value table with all the live data (value and time)
-    being stored in an in-memory list
+    being stored in an in-memory dictionary keyed by value id. Modified values are tracked in
+    a dirty set so that only changed rows are written back to the database.
+    History samples are buffered and written back together with the modified values.
     """
-    def __init__(self, conn_pool):
+    ## Number of buffered history samples that forces an early save
+    MAX_HISTORY_SAMPLES = 1000
+    
+    def __init__(self, conn_pool, log, journal=None):
         """
         Class constructor
         
         @param conn_pool: Database connection pool
+        @param log: logging object
+        @param journal: optional ChangeJournal, truncated after each successful save
         """
         ## Connection pool to data base
         self.conn_pool = conn_pool
-        ## List of current values
-        self.lst_curr_values = None
+        ## Logging object
+        self.log = log
+        ## Journal of value changes
+        self.journal = journal
+        ## Current values, keyed by value id
+        self.curr_values = {}
+        ## Value ids, keyed by (device_id, name)
+        self.value_ids = {}
+        ## Ids of the values that have been modified since the last save
+        self.dirty = set()
+        ## Buffered history samples (value_id, value, ts)
+        self.history = []
+        ## Initial load from the database done?
+        self.loaded = False
+        self._waiting = []
         # Query current_values table
         self._query_current_values_table()
     
@@ -189,9 +310,9 @@ class CurrentValueTable:
         """
         Query existing current_values table
         """
-        query_str = "SELECT id, value, lastupdate from current_values"
+        query_str = "SELECT id, value, lastupdate, device_id, name from current_values"
                     
-        self.conn_pool.runQuery(query_str).addCallback(self._cb_query_result, "GETDBDATA")
+        return self.conn_pool.runQuery(query_str).addCallback(self._cb_query_result, "GETDBDATA")
 
     
     def _cb_query_result(self, result, action):
@@ -202,98 +323,422 @@ class CurrentValueTable:
         @param action: Action to be deployed
         """
         if action == "GETDBDATA":
-            # Fill the "in_memory" list of "live" data
-            self.lst_curr_values = []
+            # Fill the "in_memory" dictionary of "live" data, values added in the meantime are more recent
             for row in result:
-                curr_value = CurrentValue(row[0], row[1], row[2])
-                self.add_value(curr_value)
+                if row[0] not in self.curr_values:
+                    curr_value = CurrentValue(row[0], row[1], row[2], row[3], row[4])
+                    self.add_value(curr_value)
+
+            if not self.loaded:
+                self.loaded = True
+                waiting = self._waiting
+                self._waiting = []
+                for d in waiting:
+                    d.callback(None)
+
+
+    def wait_loaded(self):
+        """
+        Wait for the initial load of the table
+        
+        @return Deferred object which fires as soon as the table has been loaded
+        """
+        if self.loaded:
+            return defer.succeed(None)
+        
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+
+    def reload(self, result=None):
+        """
+        Add values that have been created in the database by other means than the update path
+        
+        @param result: result of a preceding action, passed through when used as callback
+        """
+        return self._query_current_values_table().addCallback(lambda _: result)
 
 
     def add_value(self, curr_value):
         """
-        Add new value to the list
+        Add new value to the table
         
         @param curr_value: Current value to be added
         """
-        self.lst_curr_values.append(curr_value)
+        self.curr_values[curr_value.id] = curr_value
+        self.value_ids[(curr_value.device_id, curr_value.name)] = curr_value.id
+
+
+    def remove_value(self, result, val_id):
+        """
+        Remove a value from the table after it has been deleted from the database
+        
+        @param result: result of the delete action, passed through
+        @param val_id: Value ID
+        """
+        curr_val = self.curr_values.pop(val_id, None)
+        if curr_val is not None:
+            self.value_ids.pop((curr_val.device_id, curr_val.name), None)
+        self.dirty.discard(val_id)
+        return result
+
+
+    def remove_value_by_name(self, result, name, device_id):
+        """
+        Remove a value from the table after it has been deleted from the database
+        
+        @param result: result of the delete action, passed through
+        @param name: Name of the value
+        @param device_id: Device ID
+        """
+        val_id = self.value_ids.get((int(device_id), name))
+        if val_id is not None:
+            self.remove_value(None, val_id)
+        return result
         
 
     def get_current_value(self, val_id):
         """
-        Get current value from list
+        Get current value from the table
         
         @param id: Value ID
         
         @return Current value entry or None if no value is found
         """
-        for curr_val in self.lst_curr_values:
-            if curr_val.id == val_id:
-                return curr_val                
-        return None
+        return self.curr_values.get(val_id)
     
     
-    def query_static_data(self, value_id=None, name=None, device_id=None):
+    def get_value_id(self, device_id, name):
         """
-        Query static data about a given value in current_values
+        Get the id of a value by device and name
         
-        @param value_id: Value ID
-        @param name: NAme fo the value
         @param device_id: Device ID
+        @param name: Name of the value
         
-        @return Deferred object to the result of this query. Format of the result:
-        [id, name, history]
+        @return Value ID or None if no value is found
         """
-        if value_id is not None:
-            return self.conn_pool.runQuery("SELECT id, name, history from current_values WHERE id = ? LIMIT 1", [value_id])
-        else:
-            return self.conn_pool.runQuery("select id, name, history from current_values where name=? AND device_id=? LIMIT 1", (name, device_id))
+        return self.value_ids.get((device_id, name))
+    
+    
+    def update_value(self, val_id, value, last_update):
+        """
+        Update a current value and mark it as modified
+        
+        @param val_id: Value ID
+        @param value: Current value
+        @param last_update: Last update time for the current value
+        
+        @return Current value entry or None if no value is found
+        """
+        curr_val = self.curr_values.get(val_id)
+        if curr_val is not None:
+            curr_val.value = value
+            curr_val.last_update = last_update
+            self.dirty.add(val_id)
+        return curr_val
+    
+    
+    def add_history_samples(self, curr_vals):
+        """
+        Buffer history samples of a list of current values, taken at the same time
+        
+        @param curr_vals: list of current value entries
+        
+        @return: list of the (value_id, value, ts) samples taken
+        """
+        # values which aren't numeric are skipped
+        ts = int(time.time())
+        samples = []
+        for curr_val in curr_vals:
+            value = numeric_value(curr_val.value)
+            if value is not None:
+                samples.append((curr_val.id, value, ts))
+        self.history.extend(samples)
+        
+        if len(self.history) >= self.MAX_HISTORY_SAMPLES:
+            self.save_values_in_db()
+        
+        return samples
 
     
-    def insert_value_in_db(self, name, value, address, plugin_id, update_time):
+    def _insert_value(self, txn, name, value, device_id, update_time):
+        txn.execute("INSERT INTO current_values (name, value, value_real, device_id, lastupdate) VALUES (?, ?, ?, ?, ?)",
+                    (name, value, numeric_value(value), device_id, update_time))
+        return txn.lastrowid
+    
+    def insert_value_in_db(self, name, value, device_id, update_time):
         """
         Insert new value row in the table. Get the id of the new inserted row
         
         @param name: Name of the value
         @param value: Current value
-        @param address: Address of the device
-        @param plugin_id: ID of the plugin
+        @param device_id: ID of the device
         @param update_time: Last update time for the current value
         
-        @return deferred object to the result of the query
+        @return deferred object to the id of the new row
         """
         # Insert new value into current_values
-        return self.conn_pool.runQuery("INSERT INTO current_values (name, value, device_id, lastupdate) VALUES (?, ?, (select id from devices where address=? AND plugin_id=?),  ?)", (name, value, address, plugin_id, update_time))
+        return self.conn_pool.runInteraction(self._insert_value, name, value, device_id, update_time)
 
 
-    def _save_table(self, txn):
+    def _save_table(self, txn, rows, samples):
         """
-        Save values in current_values table. Only modified values/timestamps are been written
+        Save modified values in current_values table and buffered samples in history_values table.
         This method has to be run within a runInteraction call
+        
+        @param rows: list of [value, value_real, lastupdate, id] rows to be written
+        @param samples: list of (value_id, value, ts) history samples to be written
+        
+        @return Tuple with the number of rows, the number of history samples and the number of bytes written
         """
-        # Query database first
-        querystr = "SELECT id, value, lastupdate from current_values"
-        values = txn.execute(querystr).fetchall()
-        
-        # Prepare query for updating values and timestamps
-        querystr = "UPDATE current_values SET value=?, lastupdate=? WHERE id=?"
-        for i, curr_val in enumerate(self.lst_curr_values):
-            # Value changed?
-            val_id = values[i][0]
-            oldval = values[i][1]
-            oldtime = values[i][2]
-            
-            # Run update only forthose values that have been updated
-            if (curr_val.id == val_id) and ((curr_val.value != oldval) or (curr_val.last_update != oldtime)):
-                txn.execute(querystr, [curr_val.value, curr_val.last_update, curr_val.id])
+        written = 0
+        size = 0
+        if rows:
+            txn.executemany("UPDATE current_values SET value=?, value_real=?, lastupdate=? WHERE id=?", rows)
+            size += sum(record_size(row[:3]) for row in rows)
+        for sample in samples:
+            # a sample with the timestamp of a stored sample of the same value is skipped, not replaced
+            txn.execute("INSERT OR IGNORE INTO history_values (value_id, value, ts) VALUES (?, ?, ?)", sample)
+            if txn.rowcount:
+                written += 1
+                size += record_size(sample)
+        
+        return (len(rows), written, size)
                 
             
     def save_values_in_db(self):
         """
-        Save values in database
+        Save modified values and buffered history samples in database
+        
+        @return Deferred object to the number of rows, history samples and bytes written
         """
-        try:
-            # Run database operations in a separate thread
-            return self.conn_pool.runInteraction(self._save_table)
-        except:
-            self.log.error("Unable to write current values in database (%s)" % sys.exc_info()[1])
+        if not self.dirty and not self.history:
+            return defer.succeed((0, 0, 0))
+        
+        # Take a snapshot of the modified values, updates received during the save are flushed next time
+        dirty = self.dirty
+        self.dirty = set()
+        samples = self.history
+        self.history = []
+        
+        # Journal records written from now on are not part of this save
+        if self.journal:
+            self.journal.rotate()
+        
+        rows = []
+        for val_id in dirty:
+            curr_val = self.curr_values.get(val_id)
+            if curr_val is not None:
+                rows.append([curr_val.value, numeric_value(curr_val.value), curr_val.last_update, val_id])
+                
+        def saved(result):
+            self.log.debug("Saved %d current values and %d history samples in database (%d bytes)" % result)
+            if result[1] < len(samples):
+                self.log.warning("Skipped %d history samples with the timestamp of a stored sample" % (len(samples) - result[1]))
+            if self.journal:
+                self.journal.flushed()
+            return result
+        
+        def failed(failure):
+            # Keep the values marked as modified and the samples buffered, so they are saved next time
+            self.dirty.update(dirty)
+            self.history[0:0] = samples
+            self.log.error("Unable to write current values in database (%s)" % failure.getErrorMessage())
+            return (0, 0, 0)
+        
+        # Run database operations in a separate thread
+        d = self.conn_pool.runInteraction(self._save_table, rows, samples)
+        d.addCallbacks(saved, failed)
+        return d
+
+
+class ChangeJournal:
+    """
+    Crash-safe, append-only journal of current value changes.
+    Every change is stored as a fixed-size binary record (value id, timestamp, value) and records
+    are written sequentially and fsynced in batches. The journal is rotated when a save of the
+    current values starts, and the rotated part is removed once the save succeeded. On startup
+    any remaining records are replayed over the current_values table.
+    """
+    ## Record layout: value id, timestamp, value length, value (UTF-8), followed by a CRC32 of these fields
+    RECORD = struct.Struct('<IIB51s')
+    CRC = struct.Struct('<I')
+    RECORD_SIZE = RECORD.size + CRC.size
+    MAX_VALUE_LENGTH = 51
     
+    def __init__(self, path, log, sync_interval):
+        """
+        Class constructor
+        
+        @param path: path of the journal file
+        @param log: logging object
+        @param sync_interval: elapsed seconds between journal syncs (fsync)
+        """
+        ## Path of the active journal file
+        self.path = path
+        ## Path of the journal part that is being saved in the database
+        self.flushing_path = path + '.flushing'
+        ## Logging object
+        self.log = log
+        ## Records waiting for the next sync
+        self.pending = []
+        ## File descriptor of the active journal file
+        self.fd = None
+        
+        if sync_interval > 0:
+            lp = LoopingCall(self.sync)
+            lp.start(sync_interval, False)
+            
+        reactor.addSystemEventTrigger('before', 'shutdown', self.sync)
+    
+    def open(self):
+        """
+        Open the active journal file for appending
+        """
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        
+    def append(self, value_id, value, timestamp):
+        """
+        Append a value change to the journal, the record is written on the next sync
+        
+        @param value_id: Value ID
+        @param value: Current value
+        @param timestamp: Update time (seconds since the epoch)
+        """
+        data = unicode(value).encode('utf-8')
+        if len(data) > self.MAX_VALUE_LENGTH:
+            # Too long for a record, the value is written on the next save
+            self.log.debug("Value %s too long for the journal (%d bytes)" % (value_id, len(data)))
+            return
+        
+        record = self.RECORD.pack(value_id, timestamp, len(data), data)
+        self.pending.append(record + self.CRC.pack(zlib.crc32(record) & 0xffffffff))
+        
+    def sync(self):
+        """
+        Write pending records to the journal file and fsync it
+        """
+        if not self.pending or self.fd is None:
+            return
+        
+        try:
+            os.write(self.fd, ''.join(self.pending))
+            os.fsync(self.fd)
+            self.pending = []
+        except (IOError, OSError):
+            self.log.error("Unable to write journal (%s)" % sys.exc_info()[1])
+        
+    def rotate(self):
+        """
+        Move the records written so far to the flushing part of the journal.
+        This method has to be called when a save of the current values starts.
+        """
+        self.sync()
+        if self.fd is None:
+            return
+        
+        try:
+            if os.path.exists(self.flushing_path):
+                # A previous save failed, keep its records and add the new ones
+                f = open(self.path, 'rb')
+                data = f.read()
+                f.close()
+                f = open(self.flushing_path, 'ab')
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+                os.ftruncate(self.fd, 0)
+            else:
+                os.close(self.fd)
+                self.fd = None
+                os.rename(self.path, self.flushing_path)
+                self.open()
+        except (IOError, OSError):
+            self.log.error("Unable to rotate journal (%s)" % sys.exc_info()[1])
+            if self.fd is None:
+                self.open()
+            
+    def flushed(self):
+        """
+        Remove the flushing part of the journal after a successful save of the current values.
+        """
+        try:
+            if os.path.exists(self.flushing_path):
+                os.remove(self.flushing_path)
+        except OSError:
+            self.log.error("Unable to truncate journal (%s)" % sys.exc_info()[1])
+        
+    def read_records(self, path):
+        """
+        Read all valid records from a journal file. Reading stops at the first incomplete
+        or corrupt record, e.g. one that was being written during a power failure.
+        
+        @param path: path of the journal file
+        
+        @return list of (value_id, timestamp, value) tuples
+        """
+        if not os.path.exists(path):
+            return []
+        
+        f = open(path, 'rb')
+        data = f.read()
+        f.close()
+        
+        records = []
+        for offset in xrange(0, len(data) - self.RECORD_SIZE + 1, self.RECORD_SIZE):
+            record = data[offset:offset + self.RECORD.size]
+            crc = self.CRC.unpack_from(data, offset + self.RECORD.size)[0]
+            if zlib.crc32(record) & 0xffffffff != crc:
+                self.log.warning("Corrupt journal record at offset %d in %s, ignoring the remainder" % (offset, path))
+                break
+            
+            value_id, timestamp, length, value = self.RECORD.unpack(record)
+            records.append((value_id, timestamp, value[:length].decode('utf-8')))
+            
+        return records
+        
+    def _replay(self, txn):
+        # The flushing part holds older records than the active journal file
+        latest = {}
+        count = 0
+        for path in (self.flushing_path, self.path):
+            for value_id, timestamp, value in self.read_records(path):
+                latest[value_id] = (value, timestamp)
+                count += 1
+                
+        rows = []
+        for value_id, (value, timestamp) in latest.iteritems():
+            updatetime = datetime.datetime.fromtimestamp(timestamp).isoformat(' ').split('.')[0]
+            rows.append([value, numeric_value(value), updatetime, value_id])
+            
+        if rows:
+            txn.executemany("UPDATE current_values SET value=?, value_real=?, lastupdate=? WHERE id=?", rows)
+            
+        return (count, len(rows))
+        
+    def replay(self, conn_pool):
+        """
+        Replay the journal over the current_values table, truncate it and open it for appending
+        
+        @param conn_pool: Database connection pool
+        
+        @return Deferred object
+        """
+        def replayed(result):
+            if result[0] > 0:
+                self.log.info("Replayed %d journal records for %d values" % result)
+            self.flushed()
+            f = open(self.path, 'wb')
+            f.close()
+            self.open()
+        
+        def failed(failure):
+            # Keep the journal, the records are replayed on the next startup
+            self.log.error("Unable to replay journal (%s)" % failure.getErrorMessage())
+            self.open()
+        
+        d = conn_pool.runInteraction(self._replay)
+        d.addCallbacks(replayed, failed)
+        return d
@@ -0,0 +1,297 @@
+'''
+Database subclass for HouseAgent running the database from RAM
+'''
+
+from database import Database
+from twisted.enterprise.adbapi import ConnectionPool
+from twisted.internet import reactor, defer
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall
+
+import os
+import sqlite3
+import sys
+import time
+
+
+def _quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+class DatabaseMemory(Database):
+    '''
+    HouseAgent database running as an in-memory SQLite database.
+    The database file is loaded into memory at startup, after which all queries run against
+    the in-memory copy. The in-memory database is checkpointed back to disk periodically and
+    at shutdown. Temporary triggers record the key of every changed row, a checkpoint writes
+    only those rows to the database file in one transaction. When the file does not exist or
+    its schema differs, the whole database is copied into a new file in one transaction, which
+    then atomically replaces the database file.
+    '''
+    ## Prefix of the temporary tables and triggers which track changed rows
+    CHANGES_PREFIX = "checkpoint_changes_"
+
+    def __init__(self, log, db_location, interval):
+        '''
+        Class constructor
+
+        @param log: logging object
+        @param db_location: path of the database file
+        @param interval: elapsed seconds between periodic checkpoints (memory to disk)
+        '''
+        self._checkpoint_path = db_location + '.checkpoint'
+        self._checkpoint_lock = defer.DeferredLock()
+
+        Database.__init__(self, log, db_location)
+
+        # Periodic checkpoint of the database to disk
+        if interval > 0:
+            lp = LoopingCall(self.checkpoint)
+            lp.start(interval, False)
+
+        # Checkpoint before shutting down
+        reactor.addSystemEventTrigger('before', 'shutdown', self.checkpoint)
+
+    def _create_pool(self, db_location):
+        '''
+        Overriden method
+        Create the connection pool for the in-memory database, every connection to ":memory:" is a
+        separate database so the pool must hold exactly one connection.
+        '''
+        return ConnectionPool("sqlite3", ":memory:", check_same_thread=False, cp_min=1, cp_max=1,
+                              cp_openfun=self._load_from_disk)
+
+    def _load_from_disk(self, conn):
+        '''
+        Load the database file into the in-memory database, called when the connection is opened.
+        @param conn: the sqlite3 connection to the in-memory database
+        '''
+        if not os.path.exists(self._db_location):
+            return
+
+        start = time.time()
+        conn.execute("ATTACH DATABASE ? AS disk", [self._db_location])
+
+        # Create tables first, then copy data and create indexes, triggers and views afterwards
+        objects = conn.execute("SELECT type, name, sql FROM disk.sqlite_master WHERE sql IS NOT NULL " +
+                               "AND name NOT LIKE 'sqlite_%' ORDER BY type = 'table' DESC").fetchall()
+        for type, name, sql in objects:
+            if type == 'table':
+                conn.execute(sql)
+
+        # Keep the rowids, so checkpoints can write changed rows to the same rows on disk
+        for table, key in self._tables(conn):
+            columns = ", ".join(self._columns(conn, table, key))
+            conn.execute("INSERT INTO main.%s (%s) SELECT %s FROM disk.%s" % (_quote(table), columns, columns, _quote(table)))
+
+        for type, name, sql in objects:
+            if type != 'table':
+                conn.execute(sql)
+
+        if conn.execute("SELECT 1 FROM disk.sqlite_master WHERE name = 'sqlite_sequence'").fetchall():
+            conn.execute("DELETE FROM main.sqlite_sequence")
+            conn.execute("INSERT INTO main.sqlite_sequence SELECT * FROM disk.sqlite_sequence")
+
+        conn.commit()
+        conn.execute("DETACH DATABASE disk")
+
+        self._track_changes(conn)
+        conn.commit()
+
+        self.log.info("Loaded database %s into memory in %.1f ms" % (self._db_location, (time.time() - start) * 1000))
+
+    def _tables(self, cursor):
+        '''
+        Get the tables of the in-memory database with the key used to track changed rows.
+        @param cursor: the sqlite3 connection or transaction to the in-memory database
+
+        @return: list of tuples with the table name and the rowid or primary key columns
+        '''
+        tables = []
+        for (name, ) in cursor.execute("SELECT name FROM main.sqlite_master WHERE type = 'table' " +
+                                       "AND name NOT LIKE 'sqlite_%' ORDER BY name").fetchall():
+            try:
+                cursor.execute("SELECT rowid FROM main.%s LIMIT 0" % _quote(name))
+                tables.append((name, ["rowid"]))
+            except sqlite3.OperationalError:
+                # WITHOUT ROWID table, rows are identified by the primary key
+                columns = cursor.execute("PRAGMA main.table_info(%s)" % _quote(name)).fetchall()
+                tables.append((name, [_quote(c[1]) for c in sorted(columns, key=lambda c: c[5]) if c[5] > 0]))
+        return tables
+
+    def _columns(self, cursor, table, key):
+        '''
+        Get the columns used to copy the rows of a table, including the rowid of a rowid table.
+        '''
+        columns = [_quote(c[1]) for c in cursor.execute("PRAGMA main.table_info(%s)" % _quote(table)).fetchall()]
+        if key == ["rowid"]:
+            columns.insert(0, "rowid")
+        return columns
+
+    def _track_changes(self, cursor):
+        '''
+        (Re)create the temporary triggers which record the key of every inserted, updated or deleted row
+        in a temporary table per table, these rows are written to disk by the next checkpoint.
+        @param cursor: the sqlite3 connection or transaction to the in-memory database
+        '''
+        for (name, ) in cursor.execute("SELECT name FROM temp.sqlite_master WHERE type = 'table'").fetchall():
+            if name.startswith(self.CHANGES_PREFIX):
+                cursor.execute("DROP TABLE temp.%s" % _quote(name))
+
+        for table, key in self._tables(cursor):
+            changes = _quote(self.CHANGES_PREFIX + table)
+            cursor.execute("CREATE TEMP TABLE %s (%s, PRIMARY KEY (%s))" % (changes, ", ".join(key), ", ".join(key)))
+
+            new = ", ".join("NEW.%s" % k for k in key)
+            old = ", ".join("OLD.%s" % k for k in key)
+            for event, values in (("INSERT", [new]), ("UPDATE", [old, new]), ("DELETE", [old])):
+                trigger = _quote("%s%s_%s" % (self.CHANGES_PREFIX, table, event.lower()))
+                cursor.execute("DROP TRIGGER IF EXISTS temp.%s" % trigger)
+                cursor.execute("CREATE TEMP TRIGGER %s AFTER %s ON main.%s BEGIN %s END" %
+                               (trigger, event, _quote(table),
+                                " ".join("INSERT OR IGNORE INTO %s VALUES (%s);" % (changes, v) for v in values)))
+
+    def checkpoint(self):
+        '''
+        Write the in-memory database back to disk, when it has been changed since the last checkpoint.
+
+        @return: a Twisted deferred which fires when the checkpoint is complete
+        '''
+        return self._checkpoint_lock.run(self._checkpoint)
+
+    @inlineCallbacks
+    def _checkpoint(self):
+        start = time.time()
+        rows = 0
+        try:
+            full = yield self.dbpool.runInteraction(self._prepare_checkpoint)
+            if full is not None:
+                rows = yield self.dbpool.runInteraction(self._copy_checkpoint, full)
+
+                # DETACH is not allowed within a transaction, so replace the file in a separate interaction
+                yield self.dbpool.runInteraction(self._replace_database, full)
+        except:
+            self.log.error("Unable to checkpoint database to disk (%s)" % sys.exc_info()[1])
+            yield self.dbpool.runInteraction(self._abort_checkpoint)
+            returnValue(0)
+
+        if full is None:
+            returnValue(0)
+
+        self.log.debug("Checkpointed database to disk, %d rows %s (%.1f ms)" %
+                       (rows, "in a full copy" if full else "changed", (time.time() - start) * 1000))
+        returnValue(rows)
+
+    def _schema(self, cursor, database):
+        '''
+        Get the tables, indexes, triggers and views of a database, to compare the database file with the in-memory database.
+        '''
+        return cursor.execute("SELECT type, name, tbl_name, sql FROM %s.sqlite_master WHERE sql IS NOT NULL " % database +
+                              "AND name NOT LIKE 'sqlite_%' ORDER BY type, name").fetchall()
+
+    def _prepare_checkpoint(self, txn):
+        '''
+        Attach the database file to write the changed rows to it or, when the file does not exist or its
+        schema differs, create a new database file with the current schema and attach it for a full copy.
+
+        @return: True for a full copy, False for a copy of the changed rows, None when nothing changed
+        '''
+        schema = self._schema(txn, "main")
+
+        if os.path.exists(self._db_location):
+            # Use a separate connection, the file is only attached when it is going to be written
+            conn = sqlite3.connect(self._db_location)
+            same = self._schema(conn, "main") == schema
+            conn.close()
+
+            if same:
+                for table, key in self._tables(txn):
+                    if txn.execute("SELECT 1 FROM temp.%s LIMIT 1" % _quote(self.CHANGES_PREFIX + table)).fetchall():
+                        break
+                else:
+                    return None
+
+                txn.execute("ATTACH DATABASE ? AS checkpoint", [self._db_location])
+                return False
+
+        if os.path.exists(self._checkpoint_path):
+            os.remove(self._checkpoint_path)
+
+        # Use a separate connection, so the schema statements can be used as they are.
+        # Tables are created first, the order of indexes, triggers and views doesn't matter.
+        conn = sqlite3.connect(self._checkpoint_path)
+        for type, name, tbl_name, sql in sorted(schema, key=lambda o: o[0] != 'table'):
+            conn.execute(sql)
+        conn.commit()
+        conn.close()
+
+        # Track changes of new or altered tables from now on
+        self._track_changes(txn)
+
+        txn.execute("ATTACH DATABASE ? AS checkpoint", [self._checkpoint_path])
+        return True
+
+    def _copy_checkpoint(self, txn, full):
+        '''
+        Copy all rows, or the rows changed since the last checkpoint, to the checkpoint database.
+        Everything is copied in one transaction, so the checkpoint is a consistent snapshot of the database.
+
+        @return: the number of rows written
+        '''
+        rows = 0
+        for table, key in self._tables(txn):
+            changes = "temp.%s" % _quote(self.CHANGES_PREFIX + table)
+            columns = self._columns(txn, table, key)
+
+            if full:
+                txn.execute("INSERT INTO checkpoint.%s (%s) SELECT %s FROM main.%s" %
+                            (_quote(table), ", ".join(columns), ", ".join(columns), _quote(table)))
+                rows += txn.rowcount
+            else:
+                keys = txn.execute("SELECT * FROM %s" % changes).fetchall()
+                if not keys:
+                    continue
+
+                # Delete the changed rows and write their current version, rows which no longer exist stay deleted.
+                # REPLACE also removes rows which were replaced by an INSERT OR REPLACE on another unique
+                # constraint, such deletes don't fire the triggers.
+                txn.executemany("DELETE FROM checkpoint.%s WHERE %s" %
+                                (_quote(table), " AND ".join("%s = ?" % k for k in key)), keys)
+                source = "main.%s" % _quote(table)
+                txn.execute("INSERT OR REPLACE INTO checkpoint.%s (%s) SELECT %s FROM %s JOIN %s ON %s" %
+                            (_quote(table), ", ".join(columns), ", ".join("%s.%s" % (source, c) for c in columns),
+                             changes, source, " AND ".join("%s.%s = %s.%s" % (source, k, changes, k) for k in key)))
+                rows += len(keys)
+
+            txn.execute("DELETE FROM %s" % changes)
+
+        if txn.execute("SELECT 1 FROM main.sqlite_master WHERE name = 'sqlite_sequence'").fetchall():
+            txn.execute("DELETE FROM checkpoint.sqlite_sequence")
+            txn.execute("INSERT INTO checkpoint.sqlite_sequence SELECT * FROM main.sqlite_sequence")
+
+        return rows
+
+    def _replace_database(self, txn, full):
+        '''
+        Detach the checkpoint database and, after a full copy, atomically replace the database file with it.
+        '''
+        txn.execute("DETACH DATABASE checkpoint")
+        if not full:
+            return
+
+        f = open(self._checkpoint_path, 'rb')
+        os.fsync(f.fileno())
+        f.close()
+
+        if os.name == 'nt':
+            os.remove(self._db_location)
+        os.rename(self._checkpoint_path, self._db_location)
+
+    def _abort_checkpoint(self, txn):
+        try:
+            txn.execute("DETACH DATABASE checkpoint")
+        except sqlite3.Error:
+            pass
+
+        if os.path.exists(self._checkpoint_path):
+            os.remove(self._checkpoint_path)
@@ -1,267 +1,851 @@
+from twisted.internet import defer, reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
+from houseagent.core.scheduler import CronScheduler
+from houseagent.core.windows import SlidingWindow
+import bisect
+import operator
+import time
 
-# Fix to support both twisted.scheduling and txscheduling (new version)
-try:
-    from txscheduling.cron import CronSchedule
-    from txscheduling.task import ScheduledCall      
-except ImportError:
-    from twisted.scheduling.cron import CronSchedule
-    from twisted.scheduling.task import ScheduledCall    
+def _always(value):
+    return True
+
+def _never(value):
+    return False
+
+def _text_predicate(compare, condition_value):
+    condition_value = unicode(condition_value)
+    def predicate(value):
+        return compare(unicode(value), condition_value)
+    return predicate
+
+def _numeric_predicate(compare, condition_value):
+    condition_value = float(condition_value)
+    def predicate(value):
+        try:
+            return compare(float(value), condition_value)
+        except (TypeError, ValueError):
+            return False
+    return predicate
+
+## Trigger comparisons, value <op> condition_value
+_trigger_predicates = {"eq": (_text_predicate, operator.eq),
+                       "ne": (_text_predicate, operator.ne),
+                       "gt": (_numeric_predicate, operator.gt),
+                       "lt": (_numeric_predicate, operator.lt)}
+
+## Condition comparisons, note that gt and lt include the condition value itself
+_condition_predicates = {"eq": (_text_predicate, operator.eq),
+                         "ne": (_text_predicate, operator.ne),
+                         "gt": (_numeric_predicate, operator.ge),
+                         "lt": (_numeric_predicate, operator.le)}
+
+def compile_predicate(condition, condition_value, predicates=_trigger_predicates):
+    '''
+    Compile a condition into a callable which tests a value against it, with the
+    condition value converted once.
+    @param condition: the condition type (eq, ne, gt, lt), None matches any value
+    @param condition_value: the value to compare against
+    @param predicates: the table of comparisons to use
+    
+    @return: a callable which takes a value and returns True when it matches
+    @raise ValueError: when the condition is unknown or the condition value is invalid
+    '''
+    if condition is None:
+        return _always
+    
+    try:
+        (factory, compare) = predicates[condition]
+        return factory(compare, condition_value)
+    except KeyError:
+        raise ValueError("unknown condition '%s'" % condition)
+    except TypeError:
+        raise ValueError("invalid condition value '%s'" % condition_value)
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
 class EventHandler(object):
     
-    def __init__(self, log, coordinator, database):
-        
+    def __init__(self, log, coordinator, database, plugin_concurrency=0, action_timeout=10):
+        '''
+        Initialize the event handler.
+        @param log: a reference to the HouseAgent logger
+        @param coordinator: an instance of the network coordinator
+        @param database: an instance of the HouseAgent database
+        @param plugin_concurrency: max number of actions sent to a single plugin at the same time, 0 for no limit
+        @param action_timeout: seconds to wait for a plugin to confirm an action
+        '''
         self.log = log
         self.db = database
         self._coordinator = coordinator
         
-        self._absolute_time_schedule_calls = []
-        self._triggers = []
-        self._actions = []
-        self._conditions = []
+        self._plugin_concurrency = plugin_concurrency
+        self._action_timeout = action_timeout
+        # Action concurrency limits by plugin id
+        self._plugin_semaphores = {}
+        
+        # Scheduler for the absolute time triggers
+        self._scheduler = CronScheduler(log)
+        
+        # Loaded events by event id
+        self._events = {}
+        # Device value change triggers indexed by value id
+        self._value_triggers = {}
+        # Sliding windows by (value id, seconds) and by value id
+        self._windows = {}
+        self._value_windows = {}
+        # Loads and removals of events are applied one at a time, in the order they were requested
+        self._load_lock = defer.DeferredLock()
+        # Counters and latency histograms by event id, kept when an event is reloaded
+        self._stats = {}
         
         # Start the eventhandler
-        self._load_actions()
-        self._load_conditions()
-        self._load_triggers()
+        self.load()
         
         # let the coordinator know we are here
         coordinator.eventengine = self
     
+    def load(self):
+        '''
+        This function loads all events from the database. The loaded events are 
+        replaced at once, when everything has been loaded.
+        '''
+        return self._load_lock.run(self._load)
+    
     @inlineCallbacks
-    def _load_triggers(self):
-        ''' 
-        This function loads all the triggers from the database.
+    def _load(self):
+        start = time.time()
+        events = yield self._load_events()
+        self._set_events(events)
+        
+        self.log.info("Event engine loaded {0} events ({1} triggers, {2} conditions, {3} actions) in {4:.1f} ms".format(
+                      len(events), sum(len(e.triggers) for e in events.itervalues()), 
+                      sum(len(e.conditions) for e in events.itervalues()), 
+                      sum(len(e.actions) for e in events.itervalues()), (time.time() - start) * 1000))
+    
+    def reload(self):
+        '''
+        This allows an external caller to reload the event engine.
+        All triggers, conditions and actions will be reloaded.
+        '''
+        return self.load()
+    
+    def load_event(self, event_id):
+        '''
+        This function (re)loads a single event from the database, e.g. after it has been saved.
+        The triggers, conditions and actions of the event are replaced at once.
+        @param event_id: the id of the event
+        '''
+        return self._load_lock.run(self._load_event, event_id)
+    
+    @inlineCallbacks
+    def _load_event(self, event_id):
+        events = yield self._load_events(event_id)
+        
+        self._replace_event(event_id, events.get(event_id))
+        if event_id not in events:
+            self._stats.pop(event_id, None)
+    
+    def remove_event(self, event_id):
+        '''
+        This function removes a single event from the event engine, e.g. after it has been deleted.
+        @param event_id: the id of the event
+        '''
+        return self._load_lock.run(self._remove_event, event_id)
+    
+    def _remove_event(self, event_id):
+        self._replace_event(event_id, None)
+        self._stats.pop(event_id, None)
+    
+    @inlineCallbacks
+    def _load_events(self, event_id=None):
+        '''
+        This function loads the triggers, conditions and actions of all events, or of a single event.
+        @param event_id: the id of the event to load, None loads all events
+        
+        @return: a dict of Event objects by event id
+        '''
+        events = {}
+        
+        def event(id):
+            if id not in events:
+                events[id] = Event(id)
+            return events[id]
+        
+        triggers = yield self._load_triggers(event_id)
+        for t in triggers:
+            event(t.event_id).triggers.append(t)
+        
+        conditions = yield self._load_conditions(event_id)
+        for c in conditions:
+            event(c.event_id).conditions.append(c)
+        
+        actions = yield self._load_actions(event_id)
+        for a in actions:
+            event(a.event_id).actions.append(a)
+        
+        returnValue(events)
+    
+    def _set_events(self, events):
+        '''
+        This function replaces all loaded events and indexes the device value change
+        triggers by value id, so a value update only looks at its own triggers.
+        @param events: a dict of Event objects by event id
+        '''
+        value_triggers = {}
+        for event in events.itervalues():
+            for t in event.triggers:
+                if t.value_id is not None:
+                    value_triggers.setdefault(t.value_id, []).append(t)
+        
+        # Start the new events before stopping the old ones, so windows that are still used keep their samples
+        for event in events.itervalues():
+            self._start_event(event)
+        
+        for event in self._events.itervalues():
+            self._stop_event(event)
+        
+        self._events = events
+        self._value_triggers = value_triggers
+        
+        for event_id in self._stats.keys():
+            if event_id not in events:
+                del self._stats[event_id]
+    
+    def _replace_event(self, event_id, event):
+        '''
+        This function replaces or removes a single loaded event.
+        @param event_id: the id of the event
+        @param event: the new Event object, None removes the event
         '''
+        value_triggers = self._value_triggers
         
-        # Stop any outstanding absolute time triggers in case of a reload.
-        for schedule in self._absolute_time_schedule_calls:
-            schedule.stop()
+        old = self._events.pop(event_id, None)
+        if old:
+            # Lists are copied instead of modified, they might be iterated right now
+            for t in old.triggers:
+                if t.value_id in value_triggers:
+                    remaining = [x for x in value_triggers[t.value_id] if x.event_id != event_id]
+                    if remaining:
+                        value_triggers[t.value_id] = remaining
+                    else:
+                        del value_triggers[t.value_id]
+        
+        if event:
+            for t in event.triggers:
+                if t.value_id is not None:
+                    value_triggers[t.value_id] = value_triggers.get(t.value_id, []) + [t]
             
-        self._absolute_time_schedule_calls = []
+            self._events[event_id] = event
+            self._start_event(event)
+        
+        if old:
+            self._stop_event(old)
+    
+    def _start_event(self, event):
+        '''
+        Start the absolute time triggers of an event and attach the sliding windows and statistics of its triggers.
+        '''
+        event.stats = self._stats.get(event.id)
+        if event.stats is None:
+            event.stats = self._stats[event.id] = EventStats()
+        
+        for t in event.triggers:
+            t.stats = event.stats
+            if t.type == "Absolute time":
+                event.schedules.append(self._scheduler.add(t.cron, self._absolute_time_triggered, t.event_id, t.conditions, event.stats))
+            elif t.aggregate:
+                t.window = self._acquire_window(t.value_id, t.window_seconds)
+    
+    def _stop_event(self, event):
+        '''
+        Stop the absolute time triggers and pending debounce timers of an event.
+        '''
+        for s in event.schedules:
+            self._scheduler.remove(s)
+        event.schedules = []
+        
+        for t in event.triggers:
+            if t.debounce_call is not None:
+                t.debounce_call.cancel()
+                t.debounce_call = None
+            
+            if t.window is not None:
+                self._release_window(t.window)
+                t.window = None
+    
+    def _acquire_window(self, value_id, seconds):
+        '''
+        Get the sliding window of a value, windows of the same length are shared between triggers.
+        '''
+        key = (value_id, seconds)
+        window = self._windows.get(key)
+        if window is None:
+            window = self._windows[key] = SlidingWindow(seconds, value_id)
+            self._value_windows[value_id] = self._value_windows.get(value_id, []) + [window]
+        
+        window.refs += 1
+        return window
+    
+    def _release_window(self, window):
+        window.refs -= 1
+        if window.refs > 0:
+            return
+        
+        del self._windows[(window.value_id, window.seconds)]
+        remaining = [w for w in self._value_windows[window.value_id] if w is not window]
+        if remaining:
+            self._value_windows[window.value_id] = remaining
+        else:
+            del self._value_windows[window.value_id]
+    
+    @inlineCallbacks
+    def _load_triggers(self, event_id=None):
+        ''' 
+        This function loads the triggers from the database.
+        @param event_id: only load the triggers of this event
         
-        triggers = yield self.db.query_triggers()
+        @return: a list of valid Trigger objects
+        '''
+        # One row per trigger parameter
+        rows = yield self.db.query_triggers_with_parameters(event_id)
+        triggers = []
+        by_id = {}
         
-        for trigger in triggers:   
-            t = Trigger(trigger[1], trigger[2], trigger[3])
+        for (trigger_id, type, trigger_event_id, conditions, name, value) in rows:
+            t = by_id.get(trigger_id)
+            if t is None:
+                t = by_id[trigger_id] = Trigger(type, trigger_event_id, conditions)
+                triggers.append(t)
             
-            # get trigger parameters
-            trigger_parameters = yield self.db.query_trigger_parameters(trigger[0])
+            if name == "cron":
+                t.cron = value
+            elif name == "current_value_id":
+                t.current_value_id = value
+            elif name == "condition":
+                t.condition = value
+            elif name == "condition_value":
+                t.condition_value = value
+            elif name is not None:
+                t.parameters[name] = value
             
-            for param in trigger_parameters:
-                if param[0] == "cron":
-                    t.cron = param[1]
-                elif param[0] == "current_value_id":
-                    t.current_value_id = param[1]
-                elif param[0] == "condition":
-                    t.condition = param[1]
-                elif param[0] == "condition_value":
-                    t.condition_value = param[1]
+        returnValue([t for t in triggers if self._prepare_trigger(t)])
+    
+    def _prepare_trigger(self, t):
+        '''
+        This function parses the parameters of a trigger, so they don't have to be parsed
+        when the trigger is evaluated.
+        @param t: the Trigger object
+        
+        @return: False when the trigger is malformed, True otherwise
+        '''
+        if t.type == "Absolute time":
+            try:
+                self._scheduler.parse(t.cron)
+            except Exception, e:
+                self.log.error("Rejecting malformed trigger {0}: {1}".format(t, e))
+                return False
             
-            # Handle absolute time directly, and schedule. No need to keep track of this.
-            if trigger[1] == "Absolute time":         
-
-                c = CronSchedule(t.cron)
-                print c.getNextEntry()
-                s = ScheduledCall(f=self._absolute_time_triggered, eventid=trigger[2], conditions=trigger[3])
-                s.start(c)
-                
-                self._absolute_time_schedule_calls.append(s)
-                continue
+        elif t.type == "Device value change":
+            try:
+                t.value_id = int(t.current_value_id)
+            except (TypeError, ValueError):
+                self.log.warning("Ignoring trigger with invalid value id {0}".format(t))
+                return False
             
-            self._triggers.append(t)
+            try:
+                t.predicate = compile_predicate(t.condition, t.condition_value)
+                self._prepare_trigger_modes(t)
+            except ValueError, e:
+                self.log.error("Rejecting malformed trigger {0}: {1}".format(t, e))
+                return False
+        
+        return True
+    
+    def _prepare_trigger_modes(self, t):
+        '''
+        This function parses the optional firing modes of a device value change trigger:
+        edge (only fire when the condition becomes true), hysteresis (like edge, but the value
+        has to move this far back across the threshold before the trigger re-arms), min_interval
+        (minimum seconds between two firings) and debounce (only fire once the condition has
+        held for this many seconds). With aggregate (mean, min, max, delta or rate) and window
+        (seconds) the condition is tested against that aggregate of the value over the window.
+        @param t: the Trigger object
+        
+        @raise ValueError: when a mode parameter is invalid
+        '''
+        def seconds(name):
+            value = float(t.parameters.get(name) or 0)
+            if value < 0:
+                raise ValueError("negative %s" % name)
+            return value
+        
+        aggregate = t.parameters.get("aggregate")
+        if aggregate:
+            if aggregate not in SlidingWindow.AGGREGATES:
+                raise ValueError("unknown aggregate '%s'" % aggregate)
+            
+            t.window_seconds = seconds("window")
+            if not t.window_seconds:
+                raise ValueError("aggregate requires a window")
+            t.aggregate = aggregate
+        
+        t.min_interval = seconds("min_interval")
+        t.debounce = seconds("debounce")
+        hysteresis = seconds("hysteresis")
+        
+        if hysteresis:
+            if t.condition == "gt":
+                t.release = _numeric_predicate(operator.le, float(t.condition_value) - hysteresis)
+            elif t.condition == "lt":
+                t.release = _numeric_predicate(operator.ge, float(t.condition_value) + hysteresis)
+            else:
+                raise ValueError("hysteresis requires a gt or lt condition")
+        elif str(t.parameters.get("edge", "")).lower() in ("1", "true", "yes"):
+            predicate = t.predicate
+            t.release = lambda value: not predicate(value)
+        
+        t.stateful = bool(t.release or t.min_interval or t.debounce or t.aggregate)
     
     @inlineCallbacks
-    def _load_actions(self):
+    def _load_actions(self, event_id=None):
         ''' 
-        This function loads all the actions from the database.
-        '''              
-        actions = yield self.db.query_actions()
+        This function loads the actions from the database.
+        @param event_id: only load the actions of this event
+        
+        @return: a list of Action objects
+        '''
+        # One row per action parameter
+        rows = yield self.db.query_actions_with_parameters(event_id)
+        actions = []
+        by_id = {}
 
-        for action in actions:
-            a = Action(action[1], action[2])
+        for (action_id, type, action_event_id, name, value) in rows:
+            a = by_id.get(action_id)
+            if a is None:
+                a = by_id[action_id] = Action(type, action_event_id)
+                actions.append(a)
             
-            action_parameters = yield self.db.query_action_parameters(action[0])
-            for param in action_parameters:
-                if param[0] == "device":
-                    a.device = param[1]
-                elif param[0] == "control_value":
-                    a.control_value = param[1]
-                elif param[0] == "command":
-                    a.command = param[1]
-                
-            if action[1] == "Device action":
-                # fetch extra device properties
-                device_properties = yield self.db.query_device_routing_by_id(a.device)
-                if len(device_properties) > 0:
-                    a.address = device_properties[0][0]
-                    a.plugin_id = device_properties[0][1]
-                
-                # fetch value properties
-                value_properties = yield self.db.query_value_properties(a.control_value)
-                if len(value_properties) > 0:
-                    a.control_value_id = value_properties[0][0]
-                    a.control_value_name = value_properties[0][3]
-                
-                # fetch control_type
-                control_type = yield self.db.query_controltypename(a.control_value)
-                if len(control_type) > 0:
-                    a.control_type = control_type[0][0]
+            if name == "device":
+                a.device = value
+            elif name == "control_value":
+                a.control_value = value
+            elif name == "command":
+                a.command = value
+        
+        device_actions = [a for a in actions if a.type == "Device action"]
+        if not device_actions:
+            returnValue(actions)
+        
+        # Fetch extra device and value properties of all device actions at once, 
+        # a single event only needs the devices and values it refers to.
+        device_ids = None
+        value_ids = None
+        if event_id is not None:
+            device_ids = set(_to_int(a.device) for a in device_actions) - set([None])
+            value_ids = set(_to_int(a.control_value) for a in device_actions) - set([None])
+        
+        devices = yield self.db.query_devices_routing(device_ids)
+        devices = dict((row[0], row[1:]) for row in devices)
+        
+        values = yield self.db.query_values_control(value_ids)
+        values = dict((row[0], row[1:]) for row in values)
+        
+        for a in device_actions:
+            device_properties = devices.get(_to_int(a.device))
+            if device_properties:
+                (a.address, a.plugin_id) = device_properties
             
-            self._actions.append(a)
+            value_properties = values.get(_to_int(a.control_value))
+            if value_properties:
+                (a.control_value_id, a.control_value_name, a.control_type) = value_properties
+        
+        returnValue(actions)
         
     @inlineCallbacks
-    def _load_conditions(self):
+    def _load_conditions(self, event_id=None):
         ''' 
         This function loads conditions from the database.
+        @param event_id: only load the conditions of this event
+        
+        @return: a list of Condition objects
         '''
-        conditions = yield self.db.query_conditions()
+        # One row per condition parameter
+        rows = yield self.db.query_conditions_with_parameters(event_id)
+        conditions = []
+        by_id = {}
         
-        for condition in conditions:
-            c = Condition(condition[1], condition[2])
-            
-            condition_parameters = yield self.db.query_condition_parameters(condition[0])
+        for (condition_id, type, condition_event_id, name, value) in rows:
+            c = by_id.get(condition_id)
+            if c is None:
+                c = by_id[condition_id] = Condition(type, condition_event_id)
+                conditions.append(c)
             
-            for param in condition_parameters:
-                if param[0] == "condition":
-                    c.condition = param[1]
-                elif param[0] == "condition_value":
-                    c.condition_value = param[1]
-                elif param[0] == "current_values_id":
-                    c.current_values_id = param[1]
+            if name == "condition":
+                c.condition = value
+            elif name == "condition_value":
+                c.condition_value = value
+            elif name == "current_values_id":
+                c.current_values_id = value
 
-            self._conditions.append(c)
+        for c in conditions:
+            if c.type == "Device value":
+                try:
+                    c.value_id = int(c.current_values_id)
+                    c.predicate = compile_predicate(c.condition, c.condition_value, _condition_predicates)
+                except (TypeError, ValueError), e:
+                    # A condition that can't be evaluated never matches, so the event won't fire
+                    self.log.error("Rejecting malformed condition for event {0}: {1}".format(c.event_id, e))
+                    c.predicate = _never
+        
+        returnValue(conditions)
+        
+    def device_value_changed(self, value_id, value):
+        '''
+        Callback from the coordinator when a device value has been changed.
+        '''
+        windows = self._value_windows.get(value_id)
+        if windows:
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                number = None
+            
+            if number is not None:
+                now = reactor.seconds()
+                for w in windows:
+                    w.add(now, number)
+        
+        triggers = self._value_triggers.get(value_id)
+        if not triggers:
+            return
+        
+        start = time.time()
+        for t in triggers:
+            t.stats.evaluations += 1
+            if t.stateful:
+                self._evaluate_trigger_modes(t, value, start)
+            elif t.predicate(value):
+                self.log.debug("Found trigger for this value {0}".format(t))
+                self._trigger_matched(t, start)
+            else:
+                self.log.debug("Trigger does not match")      
 
-    def reload(self):
+    def _evaluate_trigger_modes(self, t, value, start):
         '''
-        This allows an external caller to reload the event engine.
-        All triggers, conditions and actions will be reloaded.
+        This function evaluates a trigger with firing modes (edge, hysteresis, min_interval, debounce) 
+        or a window aggregate.
+        @param start: the time the value change came in
         '''
-        self._triggers = []
-        self._actions = []
-        self.__conditions = []
+        if t.window is not None:
+            value = t.window.aggregate(t.aggregate)
+            if value is None:
+                return
         
-        self._load_conditions()
-        self._load_triggers()
-        self._load_actions()
+        matched = t.predicate(value)
         
-    @inlineCallbacks
-    def device_value_changed(self, value_id, value):
+        if not matched and t.debounce_call is not None:
+            # The condition didn't hold for the debounce period, start over
+            t.debounce_call.cancel()
+            t.debounce_call = None
+            t.active = False
+        
+        if t.release is not None:
+            if t.active:
+                if t.release(value):
+                    t.active = False
+                return
+            
+            if not matched:
+                return
+            t.active = True
+            
+        elif not matched:
+            return
+        
+        if t.debounce:
+            if t.debounce_call is None:
+                t.debounce_call = reactor.callLater(t.debounce, self._debounce_expired, t)
+            return
+        
+        self._fire_trigger(t, start)
+    
+    def _debounce_expired(self, t):
+        t.debounce_call = None
+        self._fire_trigger(t, time.time())
+    
+    def _fire_trigger(self, t, start):
         '''
-        Callback from the coordinator when a device value has been changed.
+        This function fires a trigger, unless it already fired within its minimum interval.
         '''
-        if not value_id:
+        now = reactor.seconds()
+        if t.min_interval and t.last_fired is not None and now - t.last_fired < t.min_interval:
+            self.log.debug("Trigger fired less than {0} seconds ago {1}".format(t.min_interval, t))
             return
         
-        for t in self._triggers:
+        t.last_fired = now
+        self.log.debug("Found trigger for this value {0}".format(t))
+        self._trigger_matched(t, start)
 
-            if t.type == "Device value change" and int(t.current_value_id) == int(value_id):
-                self.log.debug("Found trigger for this value {0}".format(t))
-                
-                matching = True
-                
-                if t.condition == "eq":
-                    if str(value) != str(t.condition_value):
-                        matching = False
-                elif t.condition == "ne":
-                    if str(value) == str(t.condition_value):
-                        matching = False
-                elif t.condition == "gt":
-                    if float(value) <= float(t.condition_value):
-                        matching = False
-                elif t.condition == "lt":
-                    if float(value) >= float(t.condition_value):
-                        matching = False       
-                        
-                if matching:
-                    # check conditions
-                    if t.conditions:           
-                        condition_check = yield self._check_conditions(t.event_id)
-                        
-                        if condition_check:
-                            self._run_actions(t.event_id)
-                        else:
-                            self.log.debug("Conditions do not match")
-                    else:
-                        # no conditions, just run the actions
-                        self._run_actions(t.event_id)
-                else:
-                    self.log.debug("Trigger does not match")      
+    @inlineCallbacks
+    def _trigger_matched(self, t, start):
+        '''
+        This function checks the conditions of a matching trigger and runs the actions
+        associated with its event.
+        @param start: the time the trigger was evaluated, for the latency statistics
+        '''
+        t.stats.matches += 1
+        if t.conditions:           
+            condition_check = yield self._check_conditions(t.event_id)
+            
+            if condition_check:
+                self._run_actions(t.event_id, start)
+            else:
+                t.stats.condition_failures += 1
+                self.log.debug("Conditions do not match")
+        else:
+            # no conditions, just run the actions
+            self._run_actions(t.event_id, start)
 
     @inlineCallbacks
-    def _absolute_time_triggered(self, eventid, conditions):
+    def _absolute_time_triggered(self, eventid, conditions, stats):
         '''
         This function is triggered when a absolute time value has been reached. 
         E.g. this function can be triggered on 10:00 every day. 
         It then checks for any conditions on the trigger and then executes actions
         associated with the event.
         '''
+        start = time.time()
+        stats.evaluations += 1
+        stats.matches += 1
 
         # check conditions
         if conditions:           
             condition_check = yield self._check_conditions(eventid)
             
             if condition_check:
-                self._run_actions(eventid)
+                self._run_actions(eventid, start)
+            else:
+                stats.condition_failures += 1
         else:
             # no conditions, just run the actions
-            self._run_actions(eventid)
+            self._run_actions(eventid, start)
             
-    def _run_actions(self, eventid):
+    def _run_actions(self, eventid, start=None):
         '''
         This runs all the actions associated with a certain eventid.
+        The actions are sent concurrently, optionally limited per plugin.
+        @param start: the time the event was triggered, defaults to now
+        
+        @return: a Twisted deferred which fires with a DeferredList result when all actions are done
         '''
         self.log.debug("Running actions for eventid {0}".format(eventid))
-        for a in self._actions:
-            if a.event_id == eventid:
-                self.log.debug("Executing action {0}".format(a))
-                if a.type == "Device action" and a.control_type == "CONTROL_TYPE_ON_OFF" and int(a.command) == 1:
-                    self._coordinator.send_poweron(a.plugin_id, a.address, a.control_value_id)
-                elif a.type == "Device action" and a.control_type == "CONTROL_TYPE_ON_OFF" and int(a.command) == 0:
-                    self._coordinator.send_poweroff(a.plugin_id, a.address, a.control_value_id)
-                elif a.type == "Device action" and a.control_type == "CONTROL_TYPE_FIRE":
-                    self._coordinator.send_fire(a.plugin_id, a.address, a.control_value_id)
-                elif a.type == "Device action" and a.control_type == "CONTROL_TYPE_THERMOSTAT":
-                    self._coordinator.send_thermostat_setpoint(a.plugin_id, a.address, a.command, a.control_value_id)
-                elif a.type == "Device action" and a.control_type == "CONTROL_TYPE_DIMMER":
-                    self._coordinator.send_dim(a.plugin_id, a.address, a.command, a.control_value_id)
+        event = self._events.get(eventid)
+        if not event or not event.actions:
+            return defer.succeed([])
+        
+        if start is None:
+            start = time.time()
+        
+        dl = defer.DeferredList([self._dispatch_action(a, event.stats, start) for a in event.actions], consumeErrors=True)
+        dl.addCallback(self._actions_done, event, start)
+        return dl
+    
+    def _actions_done(self, results, event, start):
+        elapsed = time.time() - start
+        failed = len([success for (success, result) in results if not success])
+        
+        event.stats.actions_sent += len(results) - failed
+        event.stats.action_errors += failed
+        event.stats.record(event.stats.completion_latency, elapsed)
+        
+        self.log.debug("Actions for eventid {0} done in {1:.1f} ms, {2} of {3} failed".format(event.id, elapsed * 1000, 
+                                                                                           failed, len(results)))
+        return results
+    
+    def stats(self):
+        '''
+        This function returns the counters and latency histograms of all loaded events.
+        
+        @return: a dict of EventStats objects by event id
+        '''
+        return dict(self._stats)
+    
+    def _dispatch_action(self, a, stats, triggered):
+        '''
+        This function sends a single action, waiting for a free slot of its plugin first when
+        the number of concurrent actions per plugin is limited.
+        The latency and failures are kept on the action.
+        @param stats: the EventStats of the event
+        @param triggered: the time the event was triggered
+        '''
+        start = time.time()
+        
+        def send():
+            # the dispatch latency ends when the send actually starts
+            stats.record(stats.dispatch_latency, time.time() - triggered)
+            return self._send_action(a)
+        
+        if self._plugin_concurrency > 0:
+            semaphore = self._plugin_semaphores.get(a.plugin_id)
+            if semaphore is None:
+                semaphore = self._plugin_semaphores[a.plugin_id] = defer.DeferredSemaphore(self._plugin_concurrency)
+            d = semaphore.run(send)
+        else:
+            d = defer.maybeDeferred(send)
+        
+        def done(result):
+            a.latency = time.time() - start
+            a.sent += 1
+            return result
+        
+        def failed(failure):
+            a.failures += 1
+            self.log.warning("Executing action {0} failed: {1}".format(a, failure.getErrorMessage()))
+            return failure
+        
+        # only successful sends count as sent and set the latency
+        d.addCallbacks(done, failed)
+        return d
+    
+    def _send_action(self, a):
+        '''
+        This function sends the command of a single action to its plugin.
+        
+        @return: a Twisted deferred which fires with the plugin's reply, or fails after the action timeout
+        '''
+        self.log.debug("Executing action {0}".format(a))
+        
+        if a.type != "Device action":
+            return defer.succeed(None)
+        
+        try:
+            if a.control_type == "CONTROL_TYPE_ON_OFF" and int(a.command) == 1:
+                d = self._coordinator.send_poweron(a.plugin_id, a.address, a.control_value_id)
+            elif a.control_type == "CONTROL_TYPE_ON_OFF" and int(a.command) == 0:
+                d = self._coordinator.send_poweroff(a.plugin_id, a.address, a.control_value_id)
+            elif a.control_type == "CONTROL_TYPE_FIRE":
+                d = self._coordinator.send_fire(a.plugin_id, a.address, a.control_value_id)
+            elif a.control_type == "CONTROL_TYPE_THERMOSTAT":
+                d = self._coordinator.send_thermostat_setpoint(a.plugin_id, a.address, a.command, a.control_value_id)
+            elif a.control_type == "CONTROL_TYPE_DIMMER":
+                d = self._coordinator.send_dim(a.plugin_id, a.address, a.command, a.control_value_id)
+            else:
+                return defer.succeed(None)
+        except Exception:
+            return defer.fail()
+        
+        if d.called:
+            return d
+        
+        timeout = reactor.callLater(self._action_timeout, d.cancel)
+        
+        def finished(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+        
+        return d.addBoth(finished)
 
-    @inlineCallbacks            
     def _check_conditions(self, eventid):
         '''
         This function checks conditions for a certain eventid.
         By default conditions are AND'ed together, which means that all 
         conditions must return true in order for this function to return true.
+        Current values are taken from the value cache, only values which are not 
+        cached (yet) are fetched from the database, in a single query.
+        
+        @return: a Twisted deferred which fires with True when all conditions match
         '''   
-        matching = True
+        valuecache = self._coordinator.valuecache
+        missing = []
+        
+        event = self._events.get(eventid)
+        conditions = event.conditions if event else ()
         
-        for c in self._conditions:            
-            if c.event_id == eventid:
+        for c in conditions:
+            if c.type == "Device value":
+                cached = valuecache.get(c.value_id) if valuecache and c.value_id is not None else None
                 
-                if c.type == "Device value":
-                    
-                    # query current value
-                    actual_value = yield self.db.query_value_by_valueid(c.current_values_id)
-                    
-                    # check conditions, note that these are actually checked reversed...
-                    if c.condition == "eq":
-                        if actual_value[0][0] != c.condition_value:
-                            matching = False
-                    elif c.condition == "ne":
-                        if actual_value[0][0] == c.condition_value:
-                            matching = False
-                    elif c.condition == "gt":
-                        if float(actual_value[0][0]) < float(c.condition_value):
-                            matching = False
-                    elif c.condition == "lt":
-                        if float(actual_value[0][0]) > float(c.condition_value):
-                            matching = False              
-                            
-            if matching == False:
-                break
-        
-        returnValue(matching)
+                if cached is None:
+                    missing.append(c)
+                elif not c.predicate(cached.value):
+                    return defer.succeed(False)
+        
+        if not missing:
+            return defer.succeed(True)
+        
+        def check_missing(result):
+            values = dict(result)
+            for c in missing:
+                if c.value_id not in values or not c.predicate(values[c.value_id]):
+                    return False
+            return True
+        
+        value_ids = set(c.value_id for c in missing if c.value_id is not None)
+        if len(value_ids) == 0:
+            return defer.succeed(False)
+        
+        return self.db.query_values_by_valueids(value_ids).addCallback(check_missing)
+
+class Event(object):
+    '''
+    This class holds the loaded triggers, conditions and actions of a single event.
+    '''
+    def __init__(self, id):
+        self.id = id
+        self.triggers = []
+        self.conditions = []
+        self.actions = []
+        
+        # Scheduler entries of the absolute time triggers
+        self.schedules = []
+        self.stats = None
+
+class EventStats(object):
+    '''
+    This class holds the counters and latency histograms of a single event.
+    Latencies are counted in logarithmic buckets, the histograms are lists of counts 
+    with one extra bucket for latencies above the last bound.
+    '''
+    ## Upper bounds of the latency buckets in milliseconds
+    LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    
+    def __init__(self):
+        self.evaluations = 0
+        self.matches = 0
+        self.condition_failures = 0
+        self.actions_sent = 0
+        self.action_errors = 0
+        
+        # From trigger evaluation until the send of an action starts, counted per action
+        self.dispatch_latency = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        # From trigger evaluation until all actions have been confirmed or failed
+        self.completion_latency = [0] * (len(self.LATENCY_BUCKETS) + 1)
+    
+    def record(self, histogram, seconds):
+        '''
+        Count a latency in a histogram.
+        @param histogram: dispatch_latency or completion_latency
+        @param seconds: the latency in seconds
+        '''
+        histogram[bisect.bisect_left(self.LATENCY_BUCKETS, seconds * 1000)] += 1
+    
+    def json(self):
+        '''
+        @return: the counters and histograms as a dict, suitable for JSON output
+        '''
+        return {'evaluations': self.evaluations,
+                'matches': self.matches,
+                'condition_failures': self.condition_failures,
+                'actions_sent': self.actions_sent,
+                'action_errors': self.action_errors,
+                'latency_buckets_ms': list(self.LATENCY_BUCKETS),
+                'dispatch_latency': list(self.dispatch_latency),
+                'completion_latency': list(self.completion_latency)}
 
 class Condition(object):
     '''
@@ -273,6 +857,8 @@ class Condition(object):
         self.condition = None
         self.condition_value = None
         self.current_values_id = None
+        self.value_id = None
+        self.predicate = _always
         
         # Only used for web page output
         self.device = None
@@ -288,8 +874,28 @@ class Trigger(object):
         self.conditions = conditions
         self.cron = None
         self.current_value_id = None
+        self.value_id = None
         self.condition = None
         self.condition_value = None
+        self.predicate = _always
+        # Other parameters by name
+        self.parameters = {}
+        
+        # Firing modes
+        self.stateful = False
+        self.release = None
+        self.min_interval = 0
+        self.debounce = 0
+        self.aggregate = None
+        self.window_seconds = None
+        self.window = None
+        
+        # Firing state
+        self.active = False
+        self.last_fired = None
+        self.debounce_call = None
+        # Statistics of the event, set when the event is started
+        self.stats = None
         
         # Only used for web page output
         self.device = None
@@ -314,6 +920,11 @@ class Action(object):
         self.command = None
         self.control_value_name = None
         self.control_value_id = None
+        
+        # Dispatch statistics
+        self.sent = 0
+        self.failures = 0
+        self.latency = None
 
     def __str__(self):
         return "type: [{0}] event_id: [{1}] plugin_id: [{2}] address: [{3}] control_type: [{4}] device: [{5}] control_value: [{6}] command: [{7}] control_value_name: [{8}] control_value_id: [{9}]".format(
@@ -1,38 +1,37 @@
-from twisted.internet import task
+from twisted.internet import reactor, task
 from twisted.internet import defer
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.enterprise.adbapi import ConnectionPool
-from houseagent.utils.config import Config
+from houseagent.core.rollups import Rollup
 from houseagent.plugins import pluginapi
+from houseagent.utils.timeseries import lttb, merge_buckets, align_series
 
-# Fix to support both twisted.scheduling and txscheduling (new version)
-try:
-    from txscheduling.cron import CronSchedule
-    from txscheduling.task import ScheduledCall
-except ImportError:
-    from twisted.scheduling.cron import CronSchedule
-    from twisted.scheduling.task import ScheduledCall
-
+from collections import OrderedDict
+import calendar
 import datetime
+import heapq
 import os
 import sys
 import sqlite3
+import time
 
 # TODO:
 # * better logging
 # * code cleanup (remove debug 'print' statements)
 
 class HistoryCollector():
-    def __init__(self, database, histagg):
+    def __init__(self, database):
         self.db = database
-        self.histagg = histagg
         database.histcollector = self
 
         self.log = pluginapi.Logging("Collector")
 
         self._periods = {}
         self._schedules = {}
+        # one collection task per period length: {secs: {"obj": LoopingCall, "start": DelayedCall, "values": set}}
         self._scheduled_tasks = {}
+        # collection period length by value id
+        self._value_periods = {}
 
         # wait for data from DB
         deferredlist = []
@@ -67,7 +66,6 @@ class HistoryCollector():
             schedule = self._resolve_schedule(id)
             period = self._resolve_period(schedule)
             self._start_schedule(id, schedule, period)
-            self.histagg._start_schedule(id, schedule, period)
 
         # fetch periods and current schedules, something may have changed
         deferredlist = []
@@ -83,7 +81,6 @@ class HistoryCollector():
         self.log.debug("Sheduled tasks: %s" % self._scheduled_tasks)
         try:
             self._stop_schedule(id)
-            self.histagg._stop_schedule(id)
         except KeyError: pass # schedule is not scheduled
 
 
@@ -96,30 +93,55 @@ class HistoryCollector():
         return p
 
     def _start_schedule(self, id, schedule, period):
-        if period["secs"] == 0:
+        if id in self._value_periods:
+            self._stop_schedule(id)
+
+        secs = period["secs"]
+        if secs == 0:
             self.log.info("Collection for value: %s is disabled." % schedule["name"])
-        elif period["secs"] >= 300 and period["secs"] <= 86400:
-            t = task.LoopingCall(self.collect, id, schedule["name"], period["name"])
-            # Start collection after next period run
-            t.start(period["secs"], False)
-            self._scheduled_tasks[id] = {"obj": t}
+        elif secs >= 300 and secs <= 86400:
+            if secs not in self._scheduled_tasks:
+                t = task.LoopingCall(self.collect, secs, period["name"])
+                # Start collection at the next period boundary of the local clock,
+                # e.g. on the quarter for the 15 minute period
+                now = datetime.datetime.now()
+                since_midnight = (now - now.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
+                start = reactor.callLater(secs - since_midnight % secs, t.start, secs)
+                self._scheduled_tasks[secs] = {"obj": t, "start": start, "values": set()}
+
+            self._scheduled_tasks[secs]["values"].add(id)
+            self._value_periods[id] = secs
         else:
-            self.log.warning("Invalid collection period (%s)" % period["secs"])
+            self.log.warning("Invalid collection period (%s)" % secs)
 
 
     def _stop_schedule(self, id):
-        self._scheduled_tasks[id]["obj"].stop()
-        del self._scheduled_tasks[id]
+        secs = self._value_periods.pop(id)
+        scheduled = self._scheduled_tasks[secs]
+        scheduled["values"].discard(id)
 
+        if not scheduled["values"]:
+            if scheduled["start"].active():
+                scheduled["start"].cancel()
+            if scheduled["obj"].running:
+                scheduled["obj"].stop()
+            del self._scheduled_tasks[secs]
 
-    def collect(self, value_id, schedule_name, period_name):
-        self.log.debug("Collecting value for: %s in %s period" % (schedule_name, period_name))
-        self.db.collect_history_values(value_id)
 
+    def collect(self, secs, period_name):
+        value_ids = sorted(self._scheduled_tasks[secs]["values"])
+        self.log.debug("Collecting %d values in %s period" % (len(value_ids), period_name))
+        d = self.db.collect_history_values(value_ids)
+        d.addCallback(self._collected)
+        # keep the collection task running when a tick fails
+        d.addErrback(lambda failure: self.log.error("Collecting values in %s period failed: %s" % (period_name, failure.getErrorMessage())))
+        return d
 
-    def cleanup(self):
-        self.log.debug("Cleaning old values from history_values table.")
-        self.db.cleanup_history_values()
+
+    def _collected(self, samples):
+        # the aggregator rolls up the collected samples
+        if self.db.histagg:
+            self.db.histagg.add_samples(samples)
 
 
     def do(self, result):
@@ -128,185 +150,444 @@ class HistoryCollector():
             period = self._resolve_period(schedule)
             self._start_schedule(val_id, schedule, period)
 
-        # Try to cleanup history_values every 12 hours
+        self.log.debug("Sheduled tasks: %s" % self._scheduled_tasks)
+
+
+
+class HistoryRetention():
+    """
+    Deletes expired history values. Values are kept for the retention of the value, of its
+    history type or the default retention, in days. The oldest rows of a value are deleted in
+    small chunks, each in its own short transaction, so other queries can run in between.
+    """
+    ## Number of rows per delete
+    CHUNK_ROWS = 2000
+    ## Number of pages released per incremental vacuum step
+    VACUUM_PAGES = 256
+
+    def __init__(self, database, retention_days, incremental_vacuum=False, interval=3600):
+        """
+        @param retention_days: default retention in days, 0 keeps history forever
+        @param incremental_vacuum: release the space of deleted rows to the file system
+        @param interval: seconds between cleanups
+        """
+        self.db = database
+        self.retention_days = retention_days
+        self.incremental_vacuum = incremental_vacuum
+        self.log = pluginapi.Logging("Retention")
+
+        self._running = False
+
+        if incremental_vacuum:
+            self.db.query_auto_vacuum().addCallback(self._check_vacuum)
+
         t = task.LoopingCall(self.cleanup)
-        t.start(43200, False)
+        t.start(interval, False)
+
+
+    def _check_vacuum(self, result):
+        # converting the database rewrites the whole file, which is left to the operator
+        if result[0][0] != 2:
+            self.incremental_vacuum = False
+            self.log.warning("Incremental vacuum is disabled, the database has not been converted yet. " +
+                             "Stop HouseAgent and run 'HouseAgent.py --convert-incremental-vacuum' once.")
 
-        self.log.debug("Sheduled tasks: %s" % self._scheduled_tasks)
+
+    def _pause(self):
+        # give queued queries a turn between two chunks
+        return task.deferLater(reactor, 0, lambda: None)
+
+
+    @inlineCallbacks
+    def cleanup(self):
+        if self._running:
+            return
+
+        self._running = True
+        start = time.time()
+        deleted = 0
+        chunks = 0
+        try:
+            cutoffs = yield self.db.query_history_retention_cutoffs(self.retention_days)
+            for (value_id, cutoff) in cutoffs:
+                count = self.CHUNK_ROWS
+                while count == self.CHUNK_ROWS:
+                    count = yield self.db.purge_history_values(value_id, cutoff, self.CHUNK_ROWS)
+                    deleted += count
+                    chunks += 1
+                    yield self._pause()
+
+            if self.incremental_vacuum and deleted:
+                free = yield self.db.incremental_vacuum(self.VACUUM_PAGES)
+                while free > 0:
+                    yield self._pause()
+                    free = yield self.db.incremental_vacuum(self.VACUUM_PAGES)
+
+            self.log.debug("Deleted %d expired history values in %d chunks (%.1f ms)" % (deleted, chunks, (time.time() - start) * 1000))
+        except:
+            self.log.error("Cleaning history values failed (%s)" % sys.exc_info()[1])
+        finally:
+            self._running = False
 
 
 
 class HistoryAggregator():
+    """
+    Aggregates collected history samples into the archive database. The samples of every
+    collection tick are rolled up as they are collected, closed buckets are written to the
+    archive in bulk. At startup the buckets are rebuilt from the collected samples, from the
+    end of the last archived bucket onwards, so a restart doesn't lose or truncate buckets.
+    """
+    ## Archive table and bucket length in hours of every aggregation level
+    LEVELS = (("day", 1), ("month", 6), ("year", 24))
 
-    def __init__(self, database):
-        self.conf = Config()
+    ## Seconds after a bucket boundary before the buckets are closed, for samples taken just before it
+    GRACE = 5
 
+    ## Hours before the open buckets in which buckets missed while not running are archived at startup
+    CATCH_UP = 24
+
+    def __init__(self, database, archive):
         self.db = database
-        self.cur_month = datetime.datetime.strftime(datetime.datetime.now(), "%Y%m")
-        self.dba = DatabaseArchive(self.conf.general.dbpatharchive, \
-                                   self.conf.general.dbfile, [])
+        self.archive = archive
         self.log = pluginapi.Logging("Aggregator")
 
-        self._types = {}
-        self._schedules = {}
-        self._periods = {}
-        self._scheduled_tasks = {}
-        # aggregation periods (ScheduledCalls setup)
-        self._agg_periods = {"day": "1 * * * *",        # every hour
-                             "month": "5 */6 * * *",    # every six hours
-                             "year": "10 0 * * *"}      # every night
+        # open bucket of every aggregation level, with its start as datetime and in seconds since the epoch
+        self._rollups = dict((table, Rollup()) for (table, hours) in self.LEVELS)
+        self._bucket_start = {}
+        self._start_ts = {}
+        # end of the open bucket of the shortest level, samples taken later wait for the next buckets
+        self._end = None
+        self._end_ts = None
+        self._next = []
+        # samples collected while the buckets are rebuilt
+        self._pending = None
+        self._call = None
 
+        # let the history collector know we are here
+        database.histagg = self
 
-        # wait for data from DB
-        deferredlist = []
-        deferredlist.append(self._load_history_types())
-        deferredlist.append(self._load_schedules())
-        deferredlist.append(self._load_periods())
+        self.do()
 
-        d = defer.gatherResults(deferredlist)
-        d.addCallback(self.do)
 
+    def add_samples(self, samples):
+        """
+        Callback from the history collector with the samples of a collection tick.
+        @param samples: list of (value_id, value, ts) tuples
+        """
+        if self._pending is not None:
+            self._pending.extend(samples)
+            return
 
+        for (value_id, value, ts) in samples:
+            self._add(value_id, value, ts)
 
-    @inlineCallbacks
-    def _load_history_types(self):
-        types = yield self.db.query_history_types()
 
-        for type in types:
-            self._types[type[0]] = {"type": type[1]}
+    def _add(self, value_id, value, ts):
+        if ts >= self._end_ts:
+            self._next.append((value_id, value, ts))
+            return
 
+        # a sample of a bucket which was closed already only counts for the levels still open
+        for (table, hours) in self.LEVELS:
+            if ts >= self._start_ts[table]:
+                self._rollups[table].add(value_id, value)
 
-    @inlineCallbacks
-    def _load_schedules(self):
-        schedules = yield self.db.query_history_schedules()
 
-        for schedule in schedules:
-            self._schedules[schedule[0]] = {"name": schedule[1],\
-                                            "period_id": schedule[2],\
-                                            "type_id": schedule[3]}
+    def _set_buckets(self):
+        for (table, hours) in self.LEVELS:
+            self._start_ts[table] = int(time.mktime(self._bucket_start[table].timetuple()))
+        (table, hours) = self.LEVELS[0]
+        self._end = self._bucket_start[table] + datetime.timedelta(hours=hours)
+        self._end_ts = int(time.mktime(self._end.timetuple()))
+
+        # samples taken after the previous buckets ended
+        samples = self._next
+        self._next = []
+        for sample in samples:
+            self._add(*sample)
+
+
+    def _schedule(self):
+        """
+        Schedule the next bucket boundary, on the next hour of the local clock.
+        """
+        now = datetime.datetime.now()
+        boundary = now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+        self._call = reactor.callLater((boundary - now).total_seconds() + self.GRACE, self._close_buckets, boundary)
+
+
+    def _close(self, boundary):
+        """
+        Close the buckets of all levels which end at this boundary and start the next ones.
+
+        @return: a list of (table, bucket start, buckets) tuples of the closed levels
+        """
+        closed = []
+        for (table, hours) in self.LEVELS:
+            if boundary.hour % hours == 0 and self._bucket_start[table] < boundary:
+                closed.append((table, self._bucket_start[table], self._rollups[table].close()))
+                self._bucket_start[table] = boundary
+        self._set_buckets()
+        return closed
+
+
+    def _close_buckets(self, boundary):
+        """
+        Close the buckets which end at this boundary and write them to the archive.
+        """
+        self._schedule()
+        return self._archive(boundary, self._close(boundary))
 
 
     @inlineCallbacks
-    def _load_periods(self):
-        periods = yield self.db.query_history_periods()
+    def _archive(self, boundary, closed):
+        """
+        Write the buckets closed at a boundary to the archive.
+        """
+        if any(buckets for (table, date_from, buckets) in closed):
+            start = time.time()
+            try:
+                # only values with history enabled are archived
+                types = yield self.db.query_history_enabled()
+                types = dict(types)
+
+                rows = {}
+                ts_to = int(time.mktime(boundary.timetuple()))
+                for (table, date_from, buckets) in closed:
+                    ts_from = int(time.mktime(date_from.timetuple()))
+                    rows[table] = [(value_id, round(last, 2), round(minimum, 2), round(total / count, 2), round(maximum, 2),
+                                    types[value_id], ts_from, ts_to)
+                                   for (value_id, count, total, minimum, maximum, first, last) in buckets if value_id in types]
+
+                # all buckets closed at this boundary started in the same month
+                month = (boundary - datetime.timedelta(hours=1)).strftime("%Y_%m")
+                yield self.archive.run(month, "insert_aggregates", rows)
+                self.log.debug("Archived %s in %.1f ms" % (", ".join("%d %s rows" % (len(rows[table]), table) for table in rows),
+                                                           (time.time() - start) * 1000))
+            except:
+                self.log.error("Archiving aggregates failed (%s)" % sys.exc_info()[1])
 
-        for period in periods:
-            self._periods[period[0]] = {"name": period[1],\
-                                        "secs": period[2],\
-                                        "sysflag": period[3]}
 
+    @inlineCallbacks
+    def do(self):
+        # samples collected in the meantime are added when the buckets are rebuilt
+        self._pending = []
+        start = time.time()
+
+        # the open buckets start at the current hour, six hours and day of the local clock,
+        # or at the end of the last archived bucket within the catch up period
+        now = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+        for (table, hours) in self.LEVELS:
+            self._bucket_start[table] = now - datetime.timedelta(hours=now.hour % hours)
+            earliest = self._bucket_start[table] - datetime.timedelta(hours=self.CATCH_UP)
+            try:
+                last = yield self.archive.query_last_bucket_end(table, earliest, self._bucket_start[table])
+                if last is not None:
+                    self._bucket_start[table] = max(datetime.datetime.fromtimestamp(last), earliest)
+            except:
+                self.log.error("Reading the last archived %s bucket failed (%s)" % (table, sys.exc_info()[1]))
+        self._set_buckets()
 
-    def _resolve_schedule(self, id):
-        s = self._schedules[id]
-        return s
+        try:
+            samples = yield self.db.query_history_samples(min(self._start_ts.values()), int(time.time()) + 1)
+        except:
+            samples = []
+            self.log.error("Reading history samples failed (%s)" % sys.exc_info()[1])
 
-    def _resolve_period(self, schedule):
-        p = self._periods[schedule["period_id"]]
-        return p
+        # replay the samples in time order, archiving the buckets which have ended
+        closed = 0
+        last = {}
+        for (value_id, value, ts) in samples:
+            while ts >= self._end_ts:
+                boundary = self._end
+                yield self._archive(boundary, self._close(boundary))
+                closed += 1
+            self._add(value_id, value, ts)
+            last[value_id] = ts
 
-    def _resolve_type(self, schedule):
-        t = self._types[schedule["type_id"]]["type"]
-        return t
+        while self._end_ts + self.GRACE <= time.time():
+            boundary = self._end
+            yield self._archive(boundary, self._close(boundary))
+            closed += 1
 
+        self._schedule()
 
-    def _start_schedule(self, id, schedule, period):
-            # check if the schedule is disabled or not
-            if period["secs"] != 0:
-                if not self._scheduled_tasks.has_key(id):
-                    self._scheduled_tasks[id] = []
-                val_type = self._resolve_type(schedule)
-
-                for p in self._agg_periods:
-                    cron = CronSchedule(self._agg_periods[p])
-                    if p == "day":
-                        t = ScheduledCall(self._aggregate_day, id, val_type)
-                        t.start(cron)
-                        self._scheduled_tasks[id].append(t)
-                    elif p == "month":
-                        t = ScheduledCall(self._aggregate_month, id)
-                        t.start(cron)
-                        self._scheduled_tasks[id].append(t)
-                    elif p == "year":
-                        t = ScheduledCall(self._aggregate_year, id)
-                        t.start(cron)
-                        self._scheduled_tasks[id].append(t)
-                    else:
-                        self.log.warning("Unsupported period (%s)" % p)
-
-            self.log.debug("Scheduled tasks: %s" % self._scheduled_tasks)
+        pending = self._pending
+        self._pending = None
+        # skip samples which were stored already when they were replayed
+        self.add_samples([sample for sample in pending if sample[2] > last.get(sample[0], -1)])
 
+        self.log.debug("Rebuilt buckets from %d samples, archived %d missed boundaries (%.1f ms)" %
+                       (len(samples), closed, (time.time() - start) * 1000))
 
-    def _stop_schedule(self, id):
-        for t in self._scheduled_tasks[id]:
-            t.stop()
 
-        del self._scheduled_tasks[id]
+            
 
+class ArchiveService():
+    """
+    Long-lived access to the monthly archive databases, shared by the aggregator and the web
+    interface. Every archive file has its own connection pool, which stays open between queries.
+    At most max_open pools are kept, the least recently used idle pools are closed first.
+    """
 
-    def _aggregate_day(self, val_id, val_type):
-        self.dba.aggregate_day(val_id, val_type)
+    def __init__(self, archive_db_location, max_open=13):
+        """
+        @param archive_db_location: directory which contains archive db files
+        @param max_open: number of archive files to keep open, by default enough for a year
+        """
+        self.archive_db_location = archive_db_location
+        self.max_open = max_open
 
-    def _aggregate_month(self, val_id):
-        self.dba.aggregate_month(val_id)
+        # open archives by YYYY_MM, least recently used first
+        self._archives = OrderedDict()
 
-    def _aggregate_year(self, val_id):
-        self.dba.aggregate_year(val_id)
 
-        # check if the new month come
-        next_month = datetime.datetime.strftime(datetime.datetime.now(), "%Y%m")
-        if next_month > self.cur_month:
-            self.dba.close() # close old DB
-            self.dba = DatabaseArchive(conf.general.dbpatharchive, \
-                                       conf.general.dbfile, [])
-            # increase current month value
-            self.cur_month = next_month
+    def run(self, month, method, *args, **kwargs):
+        """
+        Run a query on an archive database, the archive is not closed while the query runs.
+        @param month: YYYY_MM of the archive, None for the current month
+        @param method: name of the DatabaseArchive method to call
 
+        @return: a Twisted deferred with the result of the method
+        """
+        if month is None:
+            month = datetime.datetime.strftime(datetime.datetime.now(), "%Y_%m")
 
-    def do(self, result):
-        for val_id in self._schedules:
-            schedule = self._resolve_schedule(val_id)
-            period = self._resolve_period(schedule)
+        dba = self._archives.pop(month, None)
+        if dba is None:
+            dba = DatabaseArchive(self.archive_db_location, month)
+        self._archives[month] = dba
 
-            # start enabled shedules
-            self._start_schedule(val_id, schedule, period)
+        dba.users += 1
+        self._evict()
+
+        d = getattr(dba, method)(*args, **kwargs)
+        d.addBoth(self._release, dba)
+        return d
+
+
+    def _release(self, result, dba):
+        dba.users -= 1
+        self._evict()
+        return result
+
+
+    def _evict(self):
+        """
+        Close least recently used archives which are not in use, until at most max_open are left.
+        """
+        excess = len(self._archives) - self.max_open
+        for month in self._archives.keys():
+            if excess <= 0:
+                break
+
+            dba = self._archives[month]
+            if dba.users == 0:
+                del self._archives[month]
+                dba.close()
+                excess -= 1
+
+
+    def months(self, start, end):
+        """
+        Get the archives which hold data of a time range.
+        @param start: start of the range as datetime
+        @param end: end of the range as datetime
+
+        @return: a list of YYYY_MM of the existing archives in the range
+        """
+        months = []
+        (year, month) = (start.year, start.month)
+
+        while (year, month) <= (end.year, end.month):
+            name = "%04d_%02d" % (year, month)
+            if name in self._archives or os.path.exists(os.path.join(self.archive_db_location, "archive_%s.db" % name)):
+                months.append(name)
+
+            month += 1
+            if month > 12:
+                (year, month) = (year + 1, 1)
+
+        return months
+
+
+    @inlineCallbacks
+    def query_range(self, table, val_id, start, end):
+        """
+        Query the archived rows of a value within a time range, which may span several archives.
+        The archives are read in parallel, each one on the thread of its own connection pool.
+        @param table: day, month or year
+        @param start: start of the range (inclusive) in seconds since the epoch
+        @param end: end of the range (exclusive) in seconds since the epoch
+
+        @return: a Twisted deferred with (value, min, avg, max, ts) rows in time order
+        """
+        # archives are by month of the local time
+        months = self.months(datetime.datetime.fromtimestamp(start), datetime.datetime.fromtimestamp(end))
+        results = yield defer.gatherResults([self.run(month, "query_archive_data", table, val_id, int(start), int(end))
+                                             for month in months])
+
+        # every archive is sorted already, merge them on the timestamp
+        merged = heapq.merge(*[((row[4], row) for row in rows) for rows in results])
+        returnValue([row for (ts, row) in merged])
+
+
+    @inlineCallbacks
+    def query_last_bucket_end(self, table, start, end):
+        """
+        Get the end of the last archived bucket of an aggregation level, in the archives of a time range.
+        @param table: day, month or year
+        @param start: start of the range as datetime
+        @param end: end of the range as datetime
+
+        @return: a Twisted deferred with the end in seconds since the epoch, None when nothing is archived
+        """
+        results = yield defer.gatherResults([self.run(month, "query_last_bucket_end", table)
+                                             for month in self.months(start, end)])
+        results = [ts for ts in results if ts is not None]
+        returnValue(max(results) if results else None)
+
+
+    def close(self):
+        for dba in self._archives.itervalues():
+            dba.close()
+        self._archives.clear()
 
 
-            
 
 class DatabaseArchive():
     """
     Class for manipulating with archive databases, eg. creating, reading..
     """
+    ## Layout of the archive tables, stored as user_version in the archive db file.
+    ## 0: date_from and date_to as date/time text, 1: ts_from and ts_to in seconds since the epoch
+    VERSION = 1
+
+    ## Aggregate tables
+    TABLES = ("day", "month", "year")
 
-    def __init__(self, archive_db_location, main_db, db_array=[]):
+    def __init__(self, archive_db_location, month=None):
         """
-        @param db_location: directory which contains archive db files
-        @param db_array: array with YYYY_MM values used to create a pointers to the databases
+        @param archive_db_location: directory which contains archive db files
+        @param month: YYYY_MM of the archive, defaults to the current month
         """
-        self.log = pluginapi.Logging("Test")
+        self.log = pluginapi.Logging("Archive")
 
         self.type = "sqlite3"
 
-        self.attached_dbs = 0
-        self.max_attached_dbs = 7
-
-        self.main_db = main_db
         self.archive_db_location = archive_db_location
-        self.cur_date = datetime.datetime.strftime(datetime.datetime.now(), "%Y_%m")
+        if month is None:
+            month = datetime.datetime.strftime(datetime.datetime.now(), "%Y_%m")
+        self.cur_date = month
 
-        if len(db_array) == 0:
-            # not a specific archive(s) lookup, use the db for current month
-            self.db_name = "archive_%s.db" % self.cur_date
-            self.db_path = os.path.join(self.archive_db_location, self.db_name)
-        else:
-            # XXX: need to rewrite this part
-            # code for opening more than one archive db file
-            # attach_archive_db(YYYY_MM)
-            # attach_archive_db(YYYY_MM)
-            pass
+        self.db_name = "archive_%s.db" % self.cur_date
+        self.db_path = os.path.join(self.archive_db_location, self.db_name)
+
+        # number of running queries, see ArchiveService
+        self.users = 0
 
         self.check_archive_db()
-        self.attach_main_db(self.main_db)
 
 
     def check_archive_db(self):
@@ -324,6 +605,8 @@ class DatabaseArchive():
                 os._exit(1)
             self.prepare_archive_db()
 
+        self.dbpool.runInteraction(self._upgrade_archive_db)
+
 
     def create_archive_db(self):
         _db_name = "archive_%s.db" % self.cur_date
@@ -344,83 +627,76 @@ class DatabaseArchive():
     def _prepare_archive_db(self, txn):
         self.log.debug("Creating new archive db.")
         try:
-            txn.execute("CREATE TABLE day (id INTEGER, value REAL DEFAULT 0.00, min REAL DEFAULT 0.00, avg REAL DEFAULT 0.00, max REAL DEFAULT 0.00, type VARCHAR(50), date_from DATETIME, date_to DATETIME);")
-            txn.execute("CREATE TABLE month (id INTEGER, value REAL DEFAULT 0.00, min REAL DEFAULT 0.00, avg REAL DEFAULT 0.00, max REAL DEFAULT 0.00, type VARCHAR(50), date_from DATETIME, date_to DATETIME);")
-            txn.execute("CREATE TABLE year (id INTEGER, value REAL DEFAULT 0.00, min REAL DEFAULT 0.00, avg REAL DEFAULT 0.00, max REAL DEFAULT 0.00, type VARCHAR(50), date_from DATETIME, date_to DATETIME);")
+            for table in self.TABLES:
+                self._create_table(txn, table)
+            txn.execute("PRAGMA user_version = %d;" % self.VERSION)
         except:
             self.log.error("Database schema upgrade failed (%s)" % sys.exc_info()[1])
 
+    def _create_table(self, txn, table):
+        # ts_from and ts_to are in seconds since the epoch
+        txn.execute("CREATE TABLE %s (id INTEGER, value REAL DEFAULT 0.00, min REAL DEFAULT 0.00, avg REAL DEFAULT 0.00, max REAL DEFAULT 0.00, type VARCHAR(50), ts_from INTEGER, ts_to INTEGER);" % table)
 
-    def attach_main_db(self, main_db):
+    def _upgrade_archive_db(self, txn):
         """
-        Attach main houseagent database for queries on history_values table (day aggregations)
+        Convert an archive created by an older version to the current layout.
         """
-        self.attached_dbs = 1
-        return self.dbpool.runQuery("ATTACH DATABASE '%s' AS houseagent;" % main_db)
-
-
-    def attach_archive_db(self, db_path):
-        # CAUTION: SQLITE_LIMIT_ATTACHED is set to max 7 DB!!
-        # take care of this
-        pass 
+        version = txn.execute("PRAGMA user_version;").fetchone()[0]
+        if version < 1:
+            self.log.info("Converting archive db %s to version %d" % (self.db_name, self.VERSION))
+            try:
+                for table in self.TABLES:
+                    txn.execute("ALTER TABLE %s RENAME TO %s_tmp;" % (table, table))
+                    self._create_table(txn, table)
+                    txn.execute("INSERT INTO %s SELECT id, value, min, avg, max, type, \
+                                 CAST(STRFTIME('%%s', date_from, 'utc') AS INTEGER), CAST(STRFTIME('%%s', date_to, 'utc') AS INTEGER) \
+                                 FROM %s_tmp ORDER BY rowid;" % (table, table))
+                    txn.execute("DROP TABLE %s_tmp;" % table)
+                txn.execute("PRAGMA user_version = %d;" % self.VERSION)
+            except:
+                self.log.error("Archive db conversion failed (%s)" % sys.exc_info()[1])
+
+        # range queries by value id, also for archives created without indexes
+        for table in self.TABLES:
+            txn.execute("CREATE INDEX IF NOT EXISTS %s_id_ts_from ON %s (id, ts_from);" % (table, table))
 
     def close(self):
         self.dbpool.close()
 
-    def aggregate_day(self, val_id, val_type):
-        date_to = datetime.datetime.strftime(datetime.datetime.now(), "%Y-%m-%d %H:00:00")
-        date_from = datetime.datetime.strftime(datetime.datetime.now() - datetime.timedelta(hours=1), "%Y-%m-%d %H:00:00")
-        return self.dbpool.runQuery("INSERT INTO \
-                        day(id, value, min, avg, \
-                           max, type, date_from, date_to) \
-                        SELECT value_id AS id, ROUND(value,2) AS value, \
-                               ROUND(MIN(value),2) AS min, \
-                               ROUND(AVG(value), 2) AS avg, \
-                               ROUND(MAX(value),2) AS max, \
-                               '%s', '%s', '%s'\
-                        FROM houseagent.history_values \
-                        WHERE value_id='%s' AND created_at >= '%s' AND created_at < '%s';" \
-                        % (val_type, date_from, date_to, val_id, date_from, date_to))
-
-
-    def aggregate_month(self, val_id):
-        date_to = datetime.datetime.strftime(datetime.datetime.now(), "%Y-%m-%d %H:00:00")
-        date_from = datetime.datetime.strftime(datetime.datetime.now() - datetime.timedelta(hours=6), "%Y-%m-%d %H:00:00")
-        return self.dbpool.runQuery("INSERT INTO \
-                        month(id, value, min, avg, \
-                           max, type, date_from, date_to) \
-                        SELECT id, ROUND(value,2) AS value, \
-                               ROUND(MIN(value),2) AS min, \
-                               ROUND(AVG(value), 2) AS avg, \
-                               ROUND(MAX(value),2) AS max, \
-                               type, '%s', '%s'\
-                        FROM day \
-                        WHERE id='%s' AND date_from >= '%s' AND date_to < '%s';" \
-                        % (date_from, date_to, val_id, date_from, date_to))
-
-
-    def aggregate_year(self, val_id):
-        date_to = datetime.datetime.strftime(datetime.datetime.now(), "%Y-%m-%d %H:00:00")
-        date_from = datetime.datetime.strftime(datetime.datetime.now() - datetime.timedelta(hours=24), "%Y-%m-%d %H:00:00")
-        return self.dbpool.runQuery("INSERT INTO \
-                        year(id, value, min, avg, \
-                           max, type, date_from, date_to) \
-                        SELECT id, ROUND(value,2) AS value, \
-                               ROUND(MIN(value),2) AS min, \
-                               ROUND(AVG(value), 2) AS avg, \
-                               ROUND(MAX(value),2) AS max, \
-                               type, '%s', '%s'\
-                        FROM month \
-                        WHERE id='%s' AND date_from >= '%s' AND date_to < '%s';" \
-                        % (date_from, date_to, val_id, date_from, date_to))
-
-
-    def query_history_values(self, val_id):
-        """return all 'current' historic values for given value id"""
-        return self.dbpool.runQuery("SELECT value, STRFTIME('%s', created_at) AS ts FROM history_values WHERE value_id=?;", [val_id])
-
-    def query_archive_daily_data(self, val_id):
-        return self.dbpool.runQuery("SELECT value, min, avg, max, STRFTIME('%s', date_from) AS ts FROM day WHERE id=?;", [val_id])
+    def insert_aggregates(self, rows):
+        """
+        Write aggregated rows to the archive, in a single transaction.
+        @param rows: dict with lists of (id, value, min, avg, max, type, ts_from, ts_to) tuples by table (day, month or year)
+        """
+        return self.dbpool.runInteraction(self._insert_aggregates, rows)
+
+    def _insert_aggregates(self, txn, rows):
+        for table in rows:
+            txn.executemany("INSERT INTO %s (id, value, min, avg, max, type, ts_from, ts_to) \
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?);" % table, rows[table])
+
+
+    def query_last_bucket_end(self, table):
+        """
+        @param table: day, month or year
+
+        @return: the latest ts_to of the table, None when it is empty
+        """
+        d = self.dbpool.runQuery("SELECT MAX(ts_to) FROM %s;" % table)
+        d.addCallback(lambda rows: rows[0][0])
+        return d
+
+    def query_archive_data(self, table, val_id, ts_from, ts_to):
+        """
+        @param table: day, month or year
+        @param ts_from: start of the range (inclusive) in seconds since the epoch
+        @param ts_to: end of the range (exclusive) in seconds since the epoch
+
+        @return: (value, min, avg, max, ts) rows in time order
+        """
+        return self.dbpool.runQuery("SELECT value, min, avg, max, ts_from FROM %s \
+                                     WHERE id=? AND ts_from >= ? AND ts_from < ? ORDER BY ts_from;" % table,
+                                    [val_id, ts_from, ts_to])
 
 
 class HistoryViewer():
@@ -428,24 +704,67 @@ class HistoryViewer():
     Bridge between the Web/REST interface and history/archive DB
     """
 
-    def __init__(self, database):
-        self.conf = Config()
-
+    def __init__(self, database, archive):
         self.db = database
-        self.cur_month = datetime.datetime.strftime(datetime.datetime.now(), "%Y%m")
-        self.dba = DatabaseArchive(self.conf.general.dbpatharchive, \
-                                   self.conf.general.dbfile, [])
+        self.archive = archive
 
     @inlineCallbacks
-    def get_latest_data(self, value_id):
-        data = yield self.dba.query_history_values(value_id)
-        if len(data) > 0:
-            returnValue(data)
-        else: returnValue([])
+    def get_latest_data(self, value_id, start=None, end=None, max_points=None):
+        """
+        @param start: start of the range in seconds since the epoch, None for all history
+        @param end: end of the range in seconds since the epoch, None for all history
+        @param max_points: downsample to at most this number of points (LTTB), None for all points
+
+        @return: a list of (value, ts) tuples
+        """
+        data = yield self.db.query_history_values_by_id(value_id, start, end)
+
+        if max_points:
+            data = [(value, ts) for (ts, value) in lttb([(ts, value) for (value, ts) in data], max_points)]
+
+        returnValue(data)
+
+    ## Aggregate functions for get_series and their SQL function
+    SERIES_FUNCTIONS = {"avg": "AVG", "min": "MIN", "max": "MAX", "sum": "SUM", "count": "COUNT"}
 
     @inlineCallbacks
-    def get_daily_data(self, value_id):
-        data = yield self.dba.query_archive_daily_data(value_id)
-        if len(data) > 0:
-            returnValue(data)
-        else: returnValue([])
+    def get_series(self, value_ids, start, end, width, functions=("avg",), fill=None):
+        """
+        Aggregate the history of several values on a shared time axis.
+        @param value_ids: list of value ids
+        @param start: start of the range in seconds since the epoch
+        @param end: end of the range in seconds since the epoch
+        @param width: bucket width in seconds
+        @param functions: aggregates per bucket, see SERIES_FUNCTIONS
+        @param fill: gap fill, None, "previous" or "zero"
+
+        @return: a tuple of (axis, series) as returned by align_series(), with series by value id.
+                 Buckets are aligned to the local time at the start of the range, so hourly and
+                 daily buckets start at the full hour and midnight
+        """
+        offset = calendar.timegm(time.localtime(start)) - int(start)
+        rows = yield self.db.query_history_buckets(value_ids, start, end, width,
+                                                   [self.SERIES_FUNCTIONS[f] for f in functions], offset)
+        returnValue(align_series(rows, value_ids, functions, start, end, width, fill, offset))
+
+    @inlineCallbacks
+    def get_daily_data(self, value_id, start=None, end=None, max_points=None):
+        """
+        @param start: start of the range in seconds since the epoch, defaults to the start of the current month
+        @param end: end of the range in seconds since the epoch, defaults to now
+        @param max_points: downsample to at most this number of rows (min/max per bucket), None for all rows
+
+        @return: a list of (value, min, avg, max, ts) tuples
+        """
+        if end is None:
+            end = time.time()
+
+        if start is None:
+            start = datetime.datetime.fromtimestamp(end).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            start = time.mktime(start.timetuple())
+
+        data = yield self.archive.query_range("day", value_id, start, end)
+        if max_points:
+            data = merge_buckets(data, max_points)
+
+        returnValue(data)
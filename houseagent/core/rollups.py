@@ -0,0 +1,70 @@
+'''
+Streaming rollups of device values, used by the history aggregator.
+'''
+
+from array import array
+
+class Rollup(object):
+    '''
+    This class keeps the running count, sum, minimum, maximum, first and last value of
+    every value within the open bucket. The statistics are stored in arrays of doubles
+    indexed by a slot per value, so adding a sample doesn't allocate any objects.
+    '''
+    def __init__(self):
+        # Slot by value id and value id by slot
+        self._slots = {}
+        self._ids = []
+
+        self._count = array('l')
+        self._sum = array('d')
+        self._min = array('d')
+        self._max = array('d')
+        self._first = array('d')
+        self._last = array('d')
+
+    def __len__(self):
+        '''
+        @return: the number of values with samples in the open bucket
+        '''
+        return len([c for c in self._count if c])
+
+    def add(self, value_id, value):
+        '''
+        Add a sample to the open bucket.
+        @param value_id: the id of the value
+        @param value: the numeric value of the sample
+        '''
+        slot = self._slots.get(value_id)
+        if slot is None:
+            slot = self._slots[value_id] = len(self._ids)
+            self._ids.append(value_id)
+            for a in (self._count, self._sum, self._min, self._max, self._first, self._last):
+                a.append(0)
+
+        if self._count[slot] == 0:
+            self._first[slot] = self._min[slot] = self._max[slot] = value
+            self._sum[slot] = 0.0
+        elif value < self._min[slot]:
+            self._min[slot] = value
+        elif value > self._max[slot]:
+            self._max[slot] = value
+
+        self._count[slot] += 1
+        self._sum[slot] += value
+        self._last[slot] = value
+
+    def close(self):
+        '''
+        Close the open bucket and start a new one.
+
+        @return: a list of (value_id, count, sum, min, max, first, last) tuples, one for every
+                 value with samples in the bucket
+        '''
+        rows = []
+        for slot, count in enumerate(self._count):
+            if count:
+                rows.append((self._ids[slot], count, self._sum[slot], self._min[slot],
+                             self._max[slot], self._first[slot], self._last[slot]))
+
+        self._count = array('l', [0]) * len(self._ids)
+        return rows
@@ -0,0 +1,171 @@
+'''
+Central scheduler for cron based (absolute time) calls.
+'''
+
+from twisted.internet import defer
+import datetime
+import heapq
+import itertools
+import time
+
+# Fix to support both twisted.scheduling and txscheduling (new version)
+try:
+    from txscheduling.cron import CronSchedule
+except ImportError:
+    from twisted.scheduling.cron import CronSchedule
+
+class ScheduleEntry(object):
+    '''
+    This class represents a single scheduled call, it is the handle returned by CronScheduler.add().
+    '''
+    def __init__(self, cron, f, a, kw):
+        self.cron = cron
+        self.f = f
+        self.a = a
+        self.kw = kw
+        self.next = None
+        self.cancelled = False
+
+    def __repr__(self):
+        return "<ScheduleEntry cron: [{0}] next: [{1}]>".format(self.cron, self.next)
+
+class CronScheduler(object):
+    '''
+    This class keeps all cron schedules in a single priority queue of next fire times,
+    so any number of schedules only needs one reactor timer. Due entries are fired in
+    one batch, removed entries are dropped lazily when they come up.
+    '''
+    def __init__(self, log, clock=None):
+        '''
+        Initialize the scheduler.
+        @param log: a reference to the HouseAgent logger
+        @param clock: the clock to schedule on, defaults to the reactor
+        '''
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+
+        self.log = log
+        self._clock = clock
+
+        # (fire time, sequence, entry)
+        self._queue = []
+        self._sequence = itertools.count()
+        self._cancelled = 0
+        self._call = None
+
+        # Parsed cron lines
+        self._schedules = {}
+
+    def parse(self, cron):
+        '''
+        Parse a cron line, parsed lines are cached.
+        @param cron: the cron line, e.g. "0 7 * * 1-5"
+
+        @return: a CronSchedule object
+        @raise Exception: when the cron line is invalid
+        '''
+        schedule = self._schedules.get(cron)
+        if schedule is None:
+            schedule = self._schedules[cron] = CronSchedule(cron)
+        return schedule
+
+    def add(self, cron, f, *a, **kw):
+        '''
+        Schedule a function to be called according to a cron line.
+        @param cron: the cron line
+        @param f: the function to call, it may return a deferred
+
+        @return: a ScheduleEntry, which can be passed to remove()
+        '''
+        entry = ScheduleEntry(cron, f, a, kw)
+        entry.next = self._next_time(cron, self._clock.seconds(), {})
+        heapq.heappush(self._queue, (entry.next, next(self._sequence), entry))
+
+        self._reschedule()
+        return entry
+
+    def remove(self, entry):
+        '''
+        Remove a scheduled call.
+        @param entry: the ScheduleEntry returned by add()
+        '''
+        if entry.cancelled:
+            return
+
+        entry.cancelled = True
+        self._cancelled += 1
+
+        # Compact the queue when it consists mostly of removed entries
+        if self._cancelled > len(self._queue) / 2:
+            self._queue = [item for item in self._queue if not item[2].cancelled]
+            heapq.heapify(self._queue)
+            self._cancelled = 0
+
+        self._reschedule()
+
+    def __len__(self):
+        return len(self._queue) - self._cancelled
+
+    def _next_time(self, cron, after, cache):
+        '''
+        Get the next fire time of a cron line after a given time.
+        @param cache: dict to share results between entries with the same cron line
+        '''
+        key = (cron, after)
+        if key not in cache:
+            entry = self.parse(cron).getNextEntry(datetime.datetime.fromtimestamp(after))
+            cache[key] = time.mktime(entry.timetuple())
+        return cache[key]
+
+    def _reschedule(self):
+        '''
+        Make sure the single timer fires at the first fire time in the queue.
+        '''
+        while self._queue and self._queue[0][2].cancelled:
+            heapq.heappop(self._queue)
+            self._cancelled -= 1
+
+        if not self._queue:
+            if self._call and self._call.active():
+                self._call.cancel()
+            self._call = None
+            return
+
+        first = self._queue[0][0]
+        if self._call and self._call.active():
+            if self._call.getTime() == first:
+                return
+            self._call.cancel()
+
+        self._call = self._clock.callLater(max(first - self._clock.seconds(), 0), self._fire)
+
+    def _fire(self):
+        '''
+        Fire all due entries in one batch and queue their next fire times.
+        '''
+        self._call = None
+        now = self._clock.seconds()
+        due = []
+        cache = {}
+
+        while self._queue and self._queue[0][0] <= now:
+            (fire_time, sequence, entry) = heapq.heappop(self._queue)
+            if entry.cancelled:
+                self._cancelled -= 1
+                continue
+
+            due.append(entry)
+
+            # Next fire time after now, a late timer doesn't fire missed runs in a burst
+            entry.next = self._next_time(entry.cron, now, cache)
+            heapq.heappush(self._queue, (entry.next, next(self._sequence), entry))
+
+        for entry in due:
+            d = defer.maybeDeferred(entry.f, *entry.a, **entry.kw)
+            d.addErrback(self._failed, entry)
+
+        self._reschedule()
+
+    def _failed(self, failure, entry):
+        self.log.error("Scheduled call {0} failed: {1}".format(entry, failure.getErrorMessage()))
@@ -0,0 +1,224 @@
+'''
+In-memory model of HouseAgent's current values.
+
+The value cache materializes the (expensive) current_values join once at
+startup and keeps it up to date from the coordinator (value updates) and the
+database layer (CRUD operations). Readers such as the web interface and the
+event engine query the cache instead of the database.
+'''
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+import datetime
+
+class CachedValue(object):
+    '''
+    This class represents a single current value including its static properties.
+    '''
+    def __init__(self, row):
+        '''
+        Initialize a new CachedValue from a row as returned by Database.query_values().
+        @param row: the row to initialize from
+        '''
+        self.name = row[0]
+        self.value = row[1]
+        self.device = row[2]
+        self.lastupdate = row[3]
+        self.plugin = row[4]
+        self.device_address = row[5]
+        self.location = row[6]
+        self.id = row[7]
+        self.control_type = row[8]
+        self.control_type_id = row[9]
+        self.history_type = row[10]
+        self.history_period = row[11]
+        self.plugin_id = row[12]
+        self.label = row[13]
+
+    def json(self):
+        return {'id': self.id, 'name': self.name, 'value': self.value, 'device': self.device, 'device_address': self.device_address,
+                'location': self.location, 'plugin': self.plugin, 'lastupdate': self.lastupdate, 'history_type': self.history_type,
+                'control_type': self.control_type, 'history_period': self.history_period, 'plugin_id': self.plugin_id, 'label': self.label}
+
+    def __str__(self):
+        return "id: [{0}] name: [{1}] value: [{2}] device: [{3}] lastupdate: [{4}]".format(self.id, self.name, self.value,
+                                                                                        self.device, self.lastupdate)
+
+class ValueCache(object):
+    '''
+    This class keeps a materialized, in-memory copy of all current values.
+    '''
+    def __init__(self, log, database, coordinator):
+        '''
+        Initialize the value cache.
+        @param log: a reference to the HouseAgent logger
+        @param database: an instance of the HouseAgent database
+        @param coordinator: an instance of the network coordinator
+        '''
+        self.log = log
+        self.db = database
+
+        self.loaded = False
+        self._loading = False
+        # Incremented on every change, allows readers to cache derived output
+        self.version = 0
+
+        self._values = {}
+        self._waiting = []
+        self._pending = {}
+
+        self.load()
+
+        # let the coordinator and database layer know we are here
+        coordinator.valuecache = self
+        database.valuecache = self
+
+    @inlineCallbacks
+    def load(self):
+        '''
+        (Re)load all current values from the database.
+        '''
+        self._loading = True
+        try:
+            rows = yield self.db.query_values()
+        finally:
+            self._loading = False
+
+        values = {}
+        for row in rows:
+            v = CachedValue(row)
+
+            # Keep the live value, the database might lag behind (flash mode)
+            old = self._values.get(v.id)
+            if old:
+                v.value = old.value
+                v.lastupdate = old.lastupdate
+
+            values[v.id] = v
+
+        # Updates for values that were unknown so far are more recent than the database
+        pending = self._pending
+        self._pending = {}
+        for value_id, (value, lastupdate) in pending.iteritems():
+            if value_id in values:
+                values[value_id].value = value
+                values[value_id].lastupdate = lastupdate
+            else:
+                self._pending[value_id] = (value, lastupdate)
+
+        self._values = values
+        self.version += 1
+
+        for value_id in self._pending.keys():
+            self.refresh_value(value_id)
+
+        if not self.loaded:
+            self.loaded = True
+            self.log.debug("Value cache loaded with %d values" % len(values))
+
+            waiting = self._waiting
+            self._waiting = []
+            for d in waiting:
+                d.callback(self)
+
+    def wait_loaded(self):
+        '''
+        Returns a Twisted deferred which fires as soon as the cache has been loaded.
+        '''
+        if self.loaded:
+            return defer.succeed(self)
+
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def get(self, value_id):
+        '''
+        Get a cached value by id.
+        @param value_id: the id of the value
+
+        @return: None if nothing is found, otherwise CachedValue()
+        '''
+        try:
+            return self._values.get(int(value_id))
+        except (TypeError, ValueError):
+            return None
+
+    def values(self):
+        '''
+        Returns a list of all cached values, ordered by id.
+        '''
+        return [self._values[id] for id in sorted(self._values)]
+
+    def controllable_values(self):
+        '''
+        Returns all controllable values in the same format as Database.query_controllable_values().
+        '''
+        return [(v.id, v.device, v.label, v.value, v.control_type) for v in self.values()
+                if v.control_type_id and v.control_type is not None]
+
+    def value_changed(self, value_id, value, time=None):
+        '''
+        Callback from the coordinator when a device value has been changed.
+        @param value_id: the id of the value
+        @param value: the new value
+        @param time: the time at which the update has been received, this defaults to now()
+        '''
+        if not value_id:
+            return
+
+        if not time:
+            lastupdate = datetime.datetime.now().isoformat(' ').split('.')[0]
+        else:
+            lastupdate = datetime.datetime.fromtimestamp(time).isoformat(' ').split('.')[0]
+
+        v = self._values.get(value_id)
+        if v:
+            v.value = value
+            v.lastupdate = lastupdate
+            self.version += 1
+
+        else:
+            # New value: remember the update until the static properties have been fetched
+            fetch = value_id not in self._pending
+            self._pending[value_id] = (value, lastupdate)
+            if fetch and self.loaded and not self._loading:
+                self.refresh_value(value_id)
+
+    @inlineCallbacks
+    def refresh_value(self, value_id):
+        '''
+        Reload a single value from the database, e.g. after it has been created or edited.
+        @param value_id: the id of the value
+        '''
+        value_id = int(value_id)
+        rows = yield self.db.query_value(value_id)
+
+        if len(rows) > 0:
+            v = CachedValue(rows[0])
+
+            try:
+                v.value, v.lastupdate = self._pending.pop(value_id)
+            except KeyError:
+                # Keep the live value, the database might lag behind (flash mode)
+                old = self._values.get(value_id)
+                if old:
+                    v.value = old.value
+                    v.lastupdate = old.lastupdate
+
+            self._values[value_id] = v
+        else:
+            self._values.pop(value_id, None)
+            self._pending.pop(value_id, None)
+
+        self.version += 1
+        returnValue(self._values.get(value_id))
+
+    def remove_value(self, value_id):
+        '''
+        Remove a value from the cache after it has been deleted.
+        @param value_id: the id of the value
+        '''
+        self._values.pop(int(value_id), None)
+        self.version += 1
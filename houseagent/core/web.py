@@ -4,6 +4,7 @@ import datetime
 import json
 import os.path
 import imp
+import time
 from twisted.internet import reactor
 from twisted.web.server import Site
 from twisted.web.static import File
@@ -24,13 +25,15 @@ class Web(object):
     All management functions to control HouseAgent take place from here.
     '''
     
-    def __init__(self, log, host, port, backlog, coordinator, eventengine, database):
+    def __init__(self, log, host, port, backlog, coordinator, eventengine, database, valuecache, archive):
         '''
         Initialize the web interface.
         @param port: the port on which the web server should listen
         @param coordinator: an instance of the network coordinator in order to interact with it
         @param eventengine: an instance of the event engine in order to interact with it
         @param database: an instance of the database layer in order to interact with it
+        @param valuecache: an instance of the in-memory value cache
+        @param archive: an instance of the archive service
         '''
         self.host = host # web server interface
         self.port = port # web server listening port
@@ -38,6 +41,8 @@ class Web(object):
         self.coordinator = coordinator
         self.eventengine = eventengine
         self.db = database
+        self.valuecache = valuecache
+        self.histview = HistoryViewer(database, archive)
         
         self.log = log
 
@@ -60,10 +65,10 @@ class Web(object):
         root.putChild('devices_view', Devices_view())
         
         # Device control
-        root.putChild("control", Control(self.db))
+        root.putChild("control", Control(self.valuecache))
 
         # Value management
-        root.putChild('values', Values(self.db, self.coordinator))
+        root.putChild('values', Values(self.db, self.coordinator, self.valuecache))
         root.putChild('values_view', Values_view())
         root.putChild('history_types', HistoryTypes(self.db)) 
         root.putChild('history_periods', HistoryPeriods(self.db))
@@ -72,17 +77,19 @@ class Web(object):
         # Events
         root.putChild("event_create", Event_create(self.db))
         root.putChild("event_value_by_id", Event_value_by_id(self.db))
-        root.putChild("event_getvalue", Event_getvalue(self.db))
+        root.putChild("event_getvalue", Event_getvalue(self.db, self.valuecache))
         root.putChild("event_save", Event_save(self.eventengine, self.db))
         root.putChild("event_control_values_by_id", Event_control_values_by_id(self.db))
         root.putChild("event_control_types_by_id", Event_control_types_by_id(self.db))
         root.putChild("events", Events(self.db))
+        root.putChild("event_stats", Event_stats(self.eventengine, self.db))
         root.putChild("event_del", Event_del(self.eventengine, self.db))
 
         # Graphing
         root.putChild("create_graph", CreateGraph(self.db))
-        root.putChild("graph_latest", GraphLatest(self.db))
-        root.putChild("graph_daily", GraphDaily(self.db))
+        root.putChild("graph_latest", GraphLatest(self.histview))
+        root.putChild("graph_daily", GraphDaily(self.histview))
+        root.putChild("graph_series", GraphSeries(self.histview))
 
         # Static files
         root.putChild("css", File(os.path.join(houseagent.template_dir, 'css')))
@@ -477,52 +484,50 @@ class ValueActionResult(Resource):
         return NOT_DONE_YET
     
 class Values(HouseAgentREST):
-
-    def __init__(self, db, coordinator):
-        HouseAgentREST.__init__(self, db)
+    '''
+    Values are served from the in-memory value cache, the database is only used for editing.
+    '''
+    def __init__(self, db, coordinator, valuecache):
+        Resource.__init__(self)
+        self.db = db
         self.coordinator = coordinator
+        self.valuecache = valuecache
+        
+        # JSON output is only rebuilt when the value cache has changed
+        self._output_version = None
+        self._output = None
 
     def render_GET(self, request):
-        self._objects = []
-        self._load().addCallback(self.done)
-
-        self.request = request
+        self.valuecache.wait_loaded().addCallback(self.done, request)
 
         return NOT_DONE_YET
     
-    def done(self, result):
-    
-        output = []
-        for obj in self._objects:
-            output.append(obj.json())
+    def done(self, result, request):
+        if self._output_version != self.valuecache.version:
+            output = []
+            for obj in self.valuecache.values():
+                output.append(obj.json())
+            
+            self._output = json.dumps(output)
+            self._output_version = self.valuecache.version
 
-        self.request.write(json.dumps(output))
-        self.request.finish()
+        request.write(self._output)
+        request.finish()
     
-    @inlineCallbacks            
-    def _load(self):
-        '''
-        Load values from the database.
-        '''
-        self._objects = []
-        value_query = yield self.db.query_values()
-        
-        for value in value_query:
-            val = Value(value[7], value[0], value[1], value[2], value[5], value[6], value[4], value[3], value[10], value[11], value[8], value[12], value[13], self)
-            self._objects.append(val)
+    def _value_resource(self, v):
+        return Value(v.id, v.name, v.value, v.device, v.device_address, v.location, v.plugin, v.lastupdate, 
+                     v.history_type, v.history_period, v.control_type, v.plugin_id, v.label, self)
     
     @inlineCallbacks
     def _edit(self, parameters):       
         yield self.db.save_value(parameters['label'][0], parameters['history_type'][0], parameters['history_period'][0], 
                                   parameters['control_type'][0], parameters['id'][0])
 
-        self._reload()
         self._done()
     
     @inlineCallbacks
     def delete(self, obj):
         yield self.db.del_value(int(obj.id))
-        self._objects.remove(obj)
         obj.request.finish()
     
     def getChild(self, name, request):
@@ -532,29 +537,29 @@ class Values(HouseAgentREST):
         except KeyError:
             action = None
         
+        obj = self.valuecache.get(name)
+        
         if not action:
             
-            for obj in self._objects:
-                if name == str(obj.id):
-                    return obj
+            if obj:
+                return self._value_resource(obj)
                 
             return NoResource(message="The resource %s was not found" % request.URLPath())
         
         else:
 
-            for obj in self._objects: 
-                if name == str(obj.id): 
-                    device_address = obj.device_address 
-                    plugin_id = obj.plugin_id
-                    
-                    if action == 'poweron' or action == 'poweroff' or action == 'fire':   
-                        return ValueActionResult(plugin_id, device_address, obj.name, self.coordinator, action, {})
-                    elif action == 'dim':
-                        params = {'level': request.args['level'][0]}
-                        return ValueActionResult(plugin_id, device_address, obj.name, self.coordinator, action, params)
-                    elif action == 'thermostat_setpoint':
-                        params = {'temp': request.args['temp'][0]}
-                        return ValueActionResult(plugin_id, device_address, obj.name, self.coordinator, action, params)
+            if obj: 
+                device_address = obj.device_address 
+                plugin_id = obj.plugin_id
+                
+                if action == 'poweron' or action == 'poweroff' or action == 'fire':   
+                    return ValueActionResult(plugin_id, device_address, obj.name, self.coordinator, action, {})
+                elif action == 'dim':
+                    params = {'level': request.args['level'][0]}
+                    return ValueActionResult(plugin_id, device_address, obj.name, self.coordinator, action, params)
+                elif action == 'thermostat_setpoint':
+                    params = {'temp': request.args['temp'][0]}
+                    return ValueActionResult(plugin_id, device_address, obj.name, self.coordinator, action, params)
         
 class Values_view(Resource):
     
@@ -786,9 +791,10 @@ class Event_getvalue(Resource):
     """
     Get's a value's current value by value id (no I'm not drunk at the moment :-) )
     """
-    def __init__(self, database):
+    def __init__(self, database, valuecache):
         Resource.__init__(self)
         self.db = database 
+        self.valuecache = valuecache
         
     def valueResult(self, result):
         self.request.write(str(result[0][0]))
@@ -797,6 +803,11 @@ class Event_getvalue(Resource):
     def render_GET(self, request):
         self.request = request
         valueid = request.args['valueid'][0]
+        
+        v = self.valuecache.get(valueid)
+        if v:
+            return str(v.value)
+        
         self.db.query_value_by_valueid(valueid).addCallback(self.valueResult)
         return NOT_DONE_YET
  
@@ -810,7 +821,7 @@ class Event_save(Resource):
         self.db = database
     
     def finished(self, result):
-        self.eventengine.reload()
+        self.eventengine.load_event(result)
         self.request.write(str(result))
         self.request.finish()
     
@@ -883,13 +894,43 @@ class GraphValue(Resource):
         return json.dumps(self.json())
 
 
+def _graph_args(request):
+    '''
+    Parse the range and size arguments of a graph request.
+    start and end are in seconds since the epoch (UTC), max_points limits the number of points.
+    
+    @return: a tuple of (start, end, max_points), None for missing arguments
+    @raise ValueError: when an argument is invalid
+    '''
+    args = []
+    for (name, type) in (("start", float), ("end", float), ("max_points", int)):
+        if name in request.args and request.args[name][0]:
+            try:
+                value = type(request.args[name][0])
+            except ValueError:
+                raise ValueError("invalid %s" % name)
+            if value != value or abs(value) == float("inf"):
+                raise ValueError("invalid %s" % name)
+            args.append(value)
+        else:
+            args.append(None)
+    
+    if args[2] is not None and args[2] <= 2:
+        raise ValueError("invalid max_points, at least 3 points are required")
+    
+    return tuple(args)
+
+
 class GraphLatest(HouseAgentREST):
     '''
     This class implements a basic REST interface.
     '''
-    def __init__(self, db):
+    ## Default maximum number of points returned
+    MAX_POINTS = 1000
+
+    def __init__(self, histview):
         Resource.__init__(self)
-        self.db = db
+        self.histview = histview
         self._objects = []
 
     def render_GET(self, request):
@@ -897,11 +938,14 @@ class GraphLatest(HouseAgentREST):
 
         self.request = request
 
-        val_id = request.args["val_id"][0]
-        #type = request.args["type"][0]
-        ##period = request.args["period"][0]
+        try:
+            val_id = request.args["val_id"][0]
+            (start, end, max_points) = _graph_args(request)
+        except (KeyError, ValueError), e:
+            request.setResponseCode(http.BAD_REQUEST)
+            return json.dumps({"error": str(e)})
         
-        self._load(val_id).addCallback(self.done)
+        self._load(val_id, start, end, max_points or self.MAX_POINTS).addCallback(self.done)
 
         return NOT_DONE_YET
     
@@ -915,16 +959,15 @@ class GraphLatest(HouseAgentREST):
         self.request.finish()
     
     @inlineCallbacks            
-    def _load(self, params):
+    def _load(self, params, start, end, max_points):
         '''
-        Load plugins from the database.
+        Load the graph values from the database.
         '''
-        self.histview = HistoryViewer(self.db)
         self._objects = []
-        value_query = yield self.histview.get_latest_data(params)
+        value_query = yield self.histview.get_latest_data(params, start, end, max_points)
         
         for value in value_query:
-            val = GraphValue(float(value[0]), float(value[1]))
+            val = GraphValue(value[0], value[1])
             self._objects.append(val)
 
 
@@ -932,9 +975,12 @@ class GraphDaily(HouseAgentREST):
     '''
     This class implements a basic REST interface.
     '''
-    def __init__(self, db):
+    ## Default maximum number of points returned
+    MAX_POINTS = 1000
+
+    def __init__(self, histview):
         Resource.__init__(self)
-        self.db = db
+        self.histview = histview
         self._objects = []
 
     def render_GET(self, request):
@@ -942,11 +988,14 @@ class GraphDaily(HouseAgentREST):
 
         self.request = request
 
-        val_id = request.args["val_id"][0]
-        #type = request.args["type"][0]
-        ##period = request.args["period"][0]
+        try:
+            val_id = request.args["val_id"][0]
+            (start, end, max_points) = _graph_args(request)
+        except (KeyError, ValueError), e:
+            request.setResponseCode(http.BAD_REQUEST)
+            return json.dumps({"error": str(e)})
         
-        self._load(val_id).addCallback(self.done)
+        self._load(val_id, start, end, max_points or self.MAX_POINTS).addCallback(self.done)
 
         return NOT_DONE_YET
     
@@ -975,23 +1024,77 @@ class GraphDaily(HouseAgentREST):
         self.request.finish()
     
     @inlineCallbacks            
-    def _load(self, params):
+    def _load(self, params, start, end, max_points):
         '''
-        Load plugins from the database.
+        Load the graph values from the database.
         '''
-        self.histview = HistoryViewer(self.db)
         self._objects = []
-        value_query = yield self.histview.get_daily_data(params)
+        value_query = yield self.histview.get_daily_data(params, start, end, max_points)
         
         for value in value_query:
-            val = GraphValue(float(value[0]), float(value[4]))
-            min = GraphValue(float(value[1]), float(value[4]))
-            avg = GraphValue(float(value[2]), float(value[4]))
-            max = GraphValue(float(value[3]), float(value[4]))
+            val = GraphValue(value[0], value[4])
+            min = GraphValue(value[1], value[4])
+            avg = GraphValue(value[2], value[4])
+            max = GraphValue(value[3], value[4])
             _tmp = {"val": val, "min": min, "avg": avg, "max": max}
             self._objects.append(_tmp)
 
 
+class GraphSeries(Resource):
+    '''
+    This class returns the aggregated history of several values on a shared time axis, as columns.
+    Arguments: val_id (repeated or comma separated), start and end (seconds since the epoch (UTC),
+    defaults to the last day), width (bucket width in seconds, buckets are aligned to the local time
+    of the server), functions (comma separated avg, min, max, sum, count, defaults to avg) and fill
+    (previous or zero, no gap fill by default).
+    '''
+    ## Maximum number of buckets of a single response
+    MAX_BUCKETS = 10000
+
+    def __init__(self, histview):
+        Resource.__init__(self)
+        self.histview = histview
+
+    def render_GET(self, request):
+        try:
+            value_ids = [int(v) for arg in request.args["val_id"] for v in arg.split(",") if v]
+            (start, end) = _graph_args(request)[:2]
+            if end is None:
+                end = int(time.time()) + 1
+            if start is None:
+                start = end - 86400
+
+            width = int(request.args.get("width", ["300"])[0])
+            functions = request.args.get("functions", ["avg"])[0].split(",")
+            fill = request.args.get("fill", [None])[0] or None
+
+            if not value_ids:
+                raise ValueError("no val_id")
+            if width <= 0 or (end - start) / width > self.MAX_BUCKETS:
+                raise ValueError("invalid width, at most %d buckets are allowed" % self.MAX_BUCKETS)
+            for f in functions:
+                if f not in self.histview.SERIES_FUNCTIONS:
+                    raise ValueError("unknown function %s" % f)
+            if fill not in (None, "previous", "zero"):
+                raise ValueError("unknown fill %s" % fill)
+        except (KeyError, ValueError), e:
+            request.setResponseCode(http.BAD_REQUEST)
+            return json.dumps({"error": str(e)})
+
+        self.histview.get_series(value_ids, start, end, width, functions, fill).addCallback(self.result, request)
+        return NOT_DONE_YET
+
+    def result(self, result, request):
+        (axis, series) = result
+        # timestamps in milliseconds due to the JS
+        output = {"ts": [ts * 1000 for ts in axis],
+                  "series": dict((str(value_id), columns) for (value_id, columns) in series.iteritems())}
+
+        request.setHeader('Content-Type', 'application/json')
+        request.write(json.dumps(output))
+        request.finish()
+
+
 class CreateGraph(Resource):
     """
     Template for creating a graph.
@@ -1044,20 +1147,19 @@ class Control(Resource):
     """
     Class that manages device control.
     """
-    def __init__(self, database):
+    def __init__(self, valuecache):
         Resource.__init__(self)
-        self.db = database 
+        self.valuecache = valuecache
     
-    def valueProcessor(self, result):
+    def valueProcessor(self, result, request):
         lookup = TemplateLookup(directories=[houseagent.template_dir])
         template = lookup.get_template('control.html')
         
-        self.request.write(str(template.render(result=result))) 
-        self.request.finish()          
+        request.write(str(template.render(result=self.valuecache.controllable_values()))) 
+        request.finish()          
     
     def render_GET(self, request):
-        self.request = request
-        self.db.query_controllable_values().addCallback(self.valueProcessor)
+        self.valuecache.wait_loaded().addCallback(self.valueProcessor, request)
         return NOT_DONE_YET
     
 class Event(object):
@@ -1202,6 +1304,33 @@ class Events(Resource):
         self.db.query_events().addCallback(self.result)
         return NOT_DONE_YET
     
+class Event_stats(Resource):
+    '''
+    Class that returns the counters and latency histograms of the loaded events as JSON.
+    '''
+    def __init__(self, eventengine, database):
+        Resource.__init__(self)
+        self.eventengine = eventengine
+        self.db = database
+    
+    def result(self, result, request):
+        stats = self.eventengine.stats()
+        output = []
+        
+        for (id, name, enabled) in result:
+            if id in stats:
+                e = stats[id].json()
+                e.update({'id': id, 'name': name, 'enabled': bool(enabled)})
+                output.append(e)
+        
+        request.setHeader('Content-Type', 'application/json')
+        request.write(json.dumps(output))
+        request.finish()
+    
+    def render_GET(self, request):
+        self.db.query_events().addCallback(self.result, request)
+        return NOT_DONE_YET
+
 class Event_del(Resource):
     '''
     Class that handles deletion of events from the database.
@@ -1211,8 +1340,8 @@ class Event_del(Resource):
         self.eventengine = eventengine
         self.db = database
     
-    def event_deleted(self, result):
-        self.eventengine.reload()
+    def event_deleted(self, result, id):
+        self.eventengine.remove_event(id)
         self.request.write(str("done!"))
         self.request.finish()
     
@@ -1220,5 +1349,5 @@ class Event_del(Resource):
         self.request = request              
         id = request.args["id"][0]
         
-        self.db.del_event(int(id)).addCallback(self.event_deleted)
+        self.db.del_event(int(id)).addCallback(self.event_deleted, int(id))
         return NOT_DONE_YET
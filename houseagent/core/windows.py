@@ -0,0 +1,129 @@
+'''
+Sliding window aggregates over device values, used by the event engine.
+'''
+
+from array import array
+from collections import deque
+
+class SlidingWindow(object):
+    '''
+    This class keeps the samples of a value over the last N seconds.
+    Samples are stored in a ring buffer of doubles, together with the running sum and
+    monotonic queues for the minimum and maximum. Adding a sample is amortized O(1),
+    every aggregate is O(1).
+    '''
+    ## Supported aggregates
+    AGGREGATES = ("mean", "min", "max", "delta", "rate")
+
+    def __init__(self, seconds, value_id=None, capacity=64):
+        '''
+        Initialize a new window.
+        @param seconds: the length of the window in seconds
+        @param value_id: the id of the value the window belongs to
+        @param capacity: the initial number of samples the ring buffer can hold, it grows when needed
+        '''
+        self.seconds = seconds
+        self.value_id = value_id
+
+        self._times = array('d', [0.0]) * capacity
+        self._values = array('d', [0.0]) * capacity
+        self._head = 0
+        self._count = 0
+        self._sum = 0.0
+
+        # (time, value) pairs with increasing values for min, decreasing values for max
+        self._min = deque()
+        self._max = deque()
+
+        # Number of triggers using this window
+        self.refs = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, time, value):
+        '''
+        Add a sample, samples older than the window are dropped.
+        @param time: the time of the sample in seconds, samples must be added in time order
+        @param value: the value of the sample
+        '''
+        self._expire(time - self.seconds)
+
+        if self._count == len(self._times):
+            self._grow()
+
+        i = (self._head + self._count) % len(self._times)
+        self._times[i] = time
+        self._values[i] = value
+        self._count += 1
+        self._sum += value
+
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((time, value))
+
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((time, value))
+
+    def aggregate(self, name):
+        '''
+        Get an aggregate over the samples in the window.
+        @param name: mean, min, max, delta (newest minus oldest value) or rate (delta per second)
+
+        @return: the aggregate, or None when there are not enough samples
+        '''
+        if not self._count:
+            return None
+
+        if name == "mean":
+            return self._sum / self._count
+        elif name == "min":
+            return self._min[0][1]
+        elif name == "max":
+            return self._max[0][1]
+
+        if self._count < 2:
+            return None
+
+        size = len(self._times)
+        newest = (self._head + self._count - 1) % size
+        delta = self._values[newest] - self._values[self._head]
+
+        if name == "delta":
+            return delta
+        elif name == "rate":
+            span = self._times[newest] - self._times[self._head]
+            if span > 0:
+                return delta / span
+
+        return None
+
+    def _expire(self, cutoff):
+        size = len(self._times)
+        while self._count and self._times[self._head] < cutoff:
+            self._sum -= self._values[self._head]
+            self._head = (self._head + 1) % size
+            self._count -= 1
+
+        if not self._count:
+            # Reset the running sum to avoid accumulating rounding errors
+            self._sum = 0.0
+
+        while self._min and self._min[0][0] < cutoff:
+            self._min.popleft()
+        while self._max and self._max[0][0] < cutoff:
+            self._max.popleft()
+
+    def _grow(self):
+        size = len(self._times)
+        order = [(self._head + i) % size for i in range(self._count)]
+
+        times = array('d', [self._times[i] for i in order])
+        values = array('d', [self._values[i] for i in order])
+        times.extend(array('d', [0.0]) * size)
+        values.extend(array('d', [0.0]) * size)
+
+        self._times = times
+        self._values = values
+        self._head = 0
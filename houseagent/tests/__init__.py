@@ -0,0 +1,34 @@
+'''
+Unit tests for HouseAgent, run with: trial houseagent.tests
+'''
+
+class Log(object):
+    '''
+    Stand-in for the HouseAgent logger, which keeps the logged messages by level.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.messages = []
+
+    def _log(self, level, message, *args):
+        self.messages.append((level, message % args if args else message))
+
+    def debug(self, message, *args):
+        self._log("debug", message, *args)
+
+    def info(self, message, *args):
+        self._log("info", message, *args)
+
+    def warning(self, message, *args):
+        self._log("warning", message, *args)
+
+    def error(self, message, *args):
+        self._log("error", message, *args)
+
+    def critical(self, message, *args):
+        self._log("critical", message, *args)
+
+    def logged(self, level):
+        '''
+        @return: the messages logged at a level
+        '''
+        return [message for (l, message) in self.messages if l == level]
@@ -0,0 +1,121 @@
+import calendar
+import os
+import shutil
+import sqlite3
+import time
+
+from twisted.trial import unittest
+
+import houseagent
+from houseagent.core import database
+from houseagent.core.database import Database
+from houseagent.tests import Log
+
+
+## The empty database shipped with HouseAgent, at schema version 0.4
+DATABASE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(houseagent.__file__))), "houseagent.db")
+
+
+class UpdateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # history values are stored as local date/time until schema version 0.6
+        tz = os.environ.get("TZ")
+        os.environ["TZ"] = "Europe/Amsterdam"
+        time.tzset()
+        self.addCleanup(self.restore_tz, tz)
+
+        self.path = os.path.join(self.mktemp(), "houseagent.db")
+        os.makedirs(os.path.dirname(self.path))
+        shutil.copy(DATABASE, self.path)
+
+        conn = sqlite3.connect(self.path)
+        conn.executemany("INSERT INTO current_values (id, name, value, device_id) VALUES (?, ?, ?, 1);",
+                         [(1, "temperature", "21.5"), (2, "switch", "on")])
+        conn.executemany("INSERT INTO history_values (value_id, value, created_at) VALUES (?, ?, ?);",
+                         [(1, 20.5, "2026-01-01 10:00:00"),
+                          (1, 21.0, "2026-07-01 10:00:00"),
+                          # a sample which isn't numeric
+                          (2, "on", "2026-01-01 10:00:00"),
+                          # a second sample of a value with the same timestamp
+                          (1, 99.0, "2026-01-01 10:00:00"),
+                          # a sample without a value
+                          (None, 1.0, "2026-01-01 11:00:00"),
+                          (2, 1, "2026-01-01 11:00:00")])
+        conn.commit()
+        conn.close()
+
+        self.log = Log()
+
+    def restore_tz(self, tz):
+        if tz is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = tz
+        time.tzset()
+
+    def open(self):
+        '''
+        Open the database, the schema is updated when the connection pool starts.
+        @return: the database and the deferred of the schema update
+        '''
+        updates = []
+        update = Database.updatedb
+        self.patch(Database, "updatedb", lambda db, version: updates.append(update(db, version)))
+
+        db = Database(self.log, self.path)
+        self.addCleanup(db.dbpool.close)
+        return (db, updates[0])
+
+    def query(self, sql):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def test_update(self):
+        (db, d) = self.open()
+
+        def updated(result):
+            self.assertEqual(self.query("SELECT parm_value FROM common WHERE parm = 'schema_version';"), [(u'0.7', )])
+            self.assertEqual(self.log.logged("info")[-1], "Successfully upgraded database schema to schema version 0.7")
+
+            # a WITHOUT ROWID table with the samples of a value in time order
+            (sql, ) = self.query("SELECT sql FROM sqlite_master WHERE name = 'history_values';")[0]
+            self.assertIn("WITHOUT ROWID", sql)
+            columns = self.query("PRAGMA table_info(history_values);")
+            self.assertEqual([c[1] for c in sorted(columns, key=lambda c: c[5]) if c[5]], [u'value_id', u'ts'])
+
+            # the local date/time is converted to seconds since the epoch, the first duplicate is kept
+            self.assertEqual(self.query("SELECT value_id, value, ts FROM history_values;"),
+                             [(1, 20.5, calendar.timegm((2026, 1, 1, 9, 0, 0))),
+                              (1, 21.0, calendar.timegm((2026, 7, 1, 8, 0, 0))),
+                              (2, 1.0, calendar.timegm((2026, 1, 1, 10, 0, 0)))])
+            self.assertEqual(self.query("SELECT id, value_real FROM current_values ORDER BY id;"), [(1, 21.5), (2, None)])
+
+            self.assertEqual(self.log.logged("warning"),
+                             ["Dropped 1 history values which aren't numeric",
+                              "Dropped 2 history values without a value id or with a duplicate timestamp"])
+        d.addCallback(updated)
+        return d
+
+    def test_failedStepIsRolledBack(self):
+        # the 0.5 to 0.6 step fails half way, after it created the new history table
+        def numeric_value(value):
+            raise ValueError("broken")
+        self.patch(database, "numeric_value", numeric_value)
+        (db, d) = self.open()
+
+        def failed(result):
+            self.assertEqual(self.query("SELECT parm_value FROM common WHERE parm = 'schema_version';"), [(u'0.5', )])
+            self.assertEqual(self.log.logged("error"), ["Database schema upgrade failed (broken)"])
+
+            # the original history table is left as it was
+            self.assertEqual(self.query("SELECT name FROM sqlite_master WHERE name LIKE 'history_values%' AND type = 'table';"),
+                             [(u'history_values', )])
+            self.assertEqual(self.query("SELECT COUNT(*) FROM history_values WHERE created_at IS NOT NULL;"), [(6, )])
+            self.assertEqual([c[1] for c in self.query("PRAGMA table_info(current_values);")][-1], u'history_retention')
+        d = self.assertFailure(d, ValueError)
+        d.addCallback(failed)
+        return d
@@ -0,0 +1,175 @@
+import os
+import sqlite3
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from houseagent.core.databaseflash import ChangeJournal
+from houseagent.tests import Log
+
+
+class ConnectionPool(object):
+    '''
+    Stand-in for the adbapi connection pool, which runs interactions right away.
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+
+    def runInteraction(self, interaction, *args):
+        d = defer.maybeDeferred(interaction, self.conn.cursor(), *args)
+        d.addCallback(self._commit)
+        return d
+
+    def _commit(self, result):
+        self.conn.commit()
+        return result
+
+
+class ChangeJournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.log = Log()
+        self.journal = self.open()
+
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute("CREATE TABLE current_values (id INTEGER PRIMARY KEY, value VARCHAR(255), " +
+                          "value_real REAL, lastupdate DATETIME);")
+        self.conn.executemany("INSERT INTO current_values (id, value) VALUES (?, '0');", [(1, ), (2, )])
+        self.pool = ConnectionPool(self.conn)
+
+    def tearDown(self):
+        if self.journal.fd is not None:
+            os.close(self.journal.fd)
+        self.conn.close()
+
+    def open(self):
+        journal = ChangeJournal(self.path, self.log, 0)
+        journal.open()
+        return journal
+
+    def restart(self):
+        # at startup the journal is opened by the replay
+        os.close(self.journal.fd)
+        self.journal = ChangeJournal(self.path, self.log, 0)
+        return self.journal.replay(self.pool)
+
+    def write(self, *changes):
+        for (value_id, value, timestamp) in changes:
+            self.journal.append(value_id, value, timestamp)
+        self.journal.sync()
+
+    def values(self):
+        return self.conn.execute("SELECT id, value, value_real FROM current_values ORDER BY id;").fetchall()
+
+    def test_records(self):
+        self.write((1, 21.5, 1000), (2, u'\xe9t\xe9', 1001), (1, "on", 1002))
+        self.assertEqual(self.journal.read_records(self.path),
+                         [(1, 1000, u'21.5'), (2, 1001, u'\xe9t\xe9'), (1, 1002, u'on')])
+        self.assertEqual(os.path.getsize(self.path), 3 * ChangeJournal.RECORD_SIZE)
+
+    def test_syncWritesPending(self):
+        self.journal.append(1, 1, 1000)
+        self.assertEqual(self.journal.read_records(self.path), [])
+        self.journal.sync()
+        self.assertEqual(self.journal.pending, [])
+        self.assertEqual(len(self.journal.read_records(self.path)), 1)
+
+    def test_valueTooLong(self):
+        self.write((1, "x" * (ChangeJournal.MAX_VALUE_LENGTH + 1), 1000),
+                   (2, "x" * ChangeJournal.MAX_VALUE_LENGTH, 1000))
+        self.assertEqual([r[0] for r in self.journal.read_records(self.path)], [2])
+        self.assertEqual(len(self.log.logged("debug")), 1)
+
+    def test_truncatedTail(self):
+        # a record which was partly written when the power failed is skipped
+        self.write((1, 1, 1000), (2, 2, 1000))
+        f = open(self.path, 'r+b')
+        f.truncate(2 * ChangeJournal.RECORD_SIZE - 10)
+        f.close()
+        self.assertEqual(self.journal.read_records(self.path), [(1, 1000, u'1')])
+
+    def test_corruptTail(self):
+        self.write((1, 1, 1000), (2, 2, 1000))
+        f = open(self.path, 'r+b')
+        f.seek(ChangeJournal.RECORD_SIZE + 8)
+        f.write('\xff')
+        f.close()
+        self.assertEqual(self.journal.read_records(self.path), [(1, 1000, u'1')])
+        self.assertEqual(len(self.log.logged("warning")), 1)
+
+    def test_corruptRecordEndsReading(self):
+        # records after a corrupt record are not trusted either
+        self.write((1, 1, 1000), (2, 2, 1000), (1, 3, 1001))
+        f = open(self.path, 'r+b')
+        f.seek(ChangeJournal.RECORD_SIZE)
+        f.write('\xff')
+        f.close()
+        self.assertEqual(self.journal.read_records(self.path), [(1, 1000, u'1')])
+
+    @defer.inlineCallbacks
+    def test_replaySkipsCorruptTail(self):
+        self.write((1, 5, 1000), (2, 6, 1000), (1, 7, 1001))
+        f = open(self.path, 'r+b')
+        f.truncate(3 * ChangeJournal.RECORD_SIZE - 1)
+        f.close()
+
+        yield self.restart()
+        self.assertEqual(self.values(), [(1, u'5', 5.0), (2, u'6', 6.0)])
+
+    @defer.inlineCallbacks
+    def test_replayAfterRotate(self):
+        # the records moved to the flushing part by a save which didn't finish are applied once,
+        # before the newer records of the active journal
+        self.write((1, 1, 1000), (2, 2, 1000))
+        self.journal.rotate()
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.write((1, 3, 1001))
+
+        yield self.restart()
+        self.assertEqual(self.values(), [(1, u'3', 3.0), (2, u'2', 2.0)])
+        self.assertEqual(self.log.logged("info"), ["Replayed 3 journal records for 2 values"])
+
+        # the replayed records are gone
+        self.assertFalse(os.path.exists(self.journal.flushing_path))
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.conn.execute("UPDATE current_values SET value='9' WHERE id=1;")
+        yield self.restart()
+        self.assertEqual(self.values()[0][1], u'9')
+        self.assertEqual(len(self.log.logged("info")), 1)
+
+    @defer.inlineCallbacks
+    def test_rotateAfterFailedSave(self):
+        # a save failed, the next rotate adds the new records to the flushing part
+        self.write((1, 1, 1000))
+        self.journal.rotate()
+        self.write((1, 2, 1001), (2, 3, 1001))
+        self.journal.rotate()
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertEqual([r[2] for r in self.journal.read_records(self.journal.flushing_path)], [u'1', u'2', u'3'])
+
+        # records written after the rotate still go to the active journal
+        self.write((2, 4, 1002))
+        self.assertEqual(self.journal.read_records(self.path), [(2, 1002, u'4')])
+
+        yield self.restart()
+        self.assertEqual(self.values(), [(1, u'2', 2.0), (2, u'4', 4.0)])
+        self.assertEqual(self.log.logged("info"), ["Replayed 4 journal records for 2 values"])
+
+    def test_flushed(self):
+        self.write((1, 1, 1000))
+        self.journal.rotate()
+        self.journal.flushed()
+        self.assertFalse(os.path.exists(self.journal.flushing_path))
+        self.assertEqual(self.journal.read_records(self.path), [])
+
+    @defer.inlineCallbacks
+    def test_replayFailureKeepsJournal(self):
+        self.write((1, 1, 1000))
+        self.conn.execute("DROP TABLE current_values;")
+        self.conn.execute("CREATE TABLE current_values (id INTEGER PRIMARY KEY);")
+
+        yield self.restart()
+        self.assertEqual(len(self.log.logged("error")), 1)
+        self.assertEqual(len(self.journal.read_records(self.path)), 1)
+        self.assertNotIdentical(self.journal.fd, None)
@@ -0,0 +1,110 @@
+import os
+import shutil
+import sqlite3
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import houseagent
+from houseagent.core import databasememory
+from houseagent.core.databasememory import DatabaseMemory
+from houseagent.tests import Log
+
+
+## The empty database shipped with HouseAgent
+DATABASE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(houseagent.__file__))), "houseagent.db")
+
+
+class Reactor(object):
+    '''
+    Stand-in for the reactor, which keeps the system event triggers instead of adding them.
+    '''
+    def __init__(self):
+        self.triggers = []
+
+    def addSystemEventTrigger(self, phase, event, callable, *args):
+        self.triggers.append((phase, event, callable))
+
+
+class DatabaseMemoryTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.path = os.path.join(self.mktemp(), "houseagent.db")
+        os.makedirs(os.path.dirname(self.path))
+        shutil.copy(DATABASE, self.path)
+
+        conn = sqlite3.connect(self.path)
+        conn.executemany("INSERT INTO current_values (id, name, value, device_id) VALUES (?, ?, '0', 1);",
+                         [(1, "temperature"), (2, "humidity"), (3, "pressure")])
+        conn.commit()
+        conn.close()
+
+        # don't checkpoint when the test run shuts down
+        self.reactor = Reactor()
+        self.patch(databasememory, "reactor", self.reactor)
+
+        self.log = Log()
+        self.db = DatabaseMemory(self.log, self.path, 0)
+        self.addCleanup(self.db.dbpool.close)
+        # the schema is updated in memory, so the first checkpoint writes a full copy
+        yield self.db.dbpool.runQuery("SELECT 1;")
+        yield self.db.checkpoint()
+
+    def disk(self, query):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute(query).fetchall()
+        finally:
+            conn.close()
+
+    def changes(self):
+        return self.db.dbpool.runQuery("SELECT (SELECT COUNT(*) FROM temp.checkpoint_changes_current_values) + " +
+                                       "(SELECT COUNT(*) FROM temp.checkpoint_changes_history_values);")
+
+    @defer.inlineCallbacks
+    def test_fullCopy(self):
+        self.assertEqual(self.reactor.triggers, [("before", "shutdown", self.db.checkpoint)])
+        self.assertIn("rows in a full copy", self.log.logged("debug")[-1])
+        self.assertEqual(self.disk("SELECT parm_value FROM common WHERE parm = 'schema_version';"), [(u'0.7', )])
+        self.assertEqual(self.disk("SELECT id, value FROM current_values ORDER BY id;"),
+                         [(1, u'0'), (2, u'0'), (3, u'0')])
+        self.assertFalse(os.path.exists(self.path + ".checkpoint"))
+        self.assertEqual((yield self.changes()), [(0, )])
+
+    @defer.inlineCallbacks
+    def test_nothingChanged(self):
+        rows = yield self.db.checkpoint()
+        self.assertEqual(rows, 0)
+
+    @defer.inlineCallbacks
+    def test_incremental(self):
+        # a row changed on disk only shows which rows the checkpoint writes
+        conn = sqlite3.connect(self.path)
+        conn.execute("UPDATE current_values SET value = 'disk' WHERE id IN (2, 3);")
+        conn.commit()
+        conn.close()
+
+        yield self.db.dbpool.runOperation("UPDATE current_values SET value = '21.5' WHERE id = 1;")
+        yield self.db.dbpool.runOperation("DELETE FROM current_values WHERE id = 2;")
+        yield self.db.dbpool.runOperation("INSERT INTO history_values (value_id, value, ts) VALUES (1, 21.5, 1000);")
+        self.assertEqual((yield self.changes()), [(3, )])
+
+        rows = yield self.db.checkpoint()
+        self.assertEqual(rows, 3)
+        self.assertEqual(self.disk("SELECT id, value FROM current_values ORDER BY id;"), [(1, u'21.5'), (3, u'disk')])
+        self.assertEqual(self.disk("SELECT value_id, value, ts FROM history_values;"), [(1, 21.5, 1000)])
+
+        # the changed rows were cleared, the next checkpoint has nothing to write
+        self.assertEqual((yield self.changes()), [(0, )])
+        rows = yield self.db.checkpoint()
+        self.assertEqual(rows, 0)
+
+    @defer.inlineCallbacks
+    def test_replacedRow(self):
+        # a row replaced by another one with the same key is written once
+        yield self.db.dbpool.runOperation("INSERT INTO history_values (value_id, value, ts) VALUES (1, 1.0, 1000);")
+        yield self.db.dbpool.runOperation("INSERT OR REPLACE INTO history_values (value_id, value, ts) VALUES (1, 2.0, 1000);")
+        rows = yield self.db.checkpoint()
+        self.assertEqual(rows, 1)
+        self.assertEqual(self.disk("SELECT value_id, value, ts FROM history_values;"), [(1, 2.0, 1000)])
@@ -0,0 +1,170 @@
+import datetime
+import time
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from houseagent.core import history
+from houseagent.tests import Log
+
+
+def ts(date):
+    return int(time.mktime(date.timetuple()))
+
+
+class Database(object):
+    '''
+    Stand-in for the database, with the collected samples of two float values.
+    '''
+    def __init__(self, samples=None):
+        self.histagg = None
+        self.samples = samples or []
+        self.queries = []
+
+    def query_history_samples(self, start, end):
+        self.queries.append((start, end))
+        if isinstance(self.samples, defer.Deferred):
+            return self.samples
+        return defer.succeed([s for s in self.samples if start <= s[2] < end])
+
+    def query_history_enabled(self):
+        return defer.succeed([(1, "float"), (2, "float")])
+
+
+class Archive(object):
+    '''
+    Stand-in for the archive service, which keeps the written aggregates.
+    '''
+    def __init__(self, last=None):
+        self.last = last or {}
+        self.runs = []
+
+    def query_last_bucket_end(self, table, start, end):
+        return defer.succeed(self.last.get(table))
+
+    def run(self, month, method, rows):
+        self.runs.append((month, method, rows))
+        return defer.succeed(None)
+
+
+class HistoryAggregatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(history.pluginapi, "Logging", Log)
+        self.hour = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+
+    def aggregator(self, database, archive):
+        aggregator = history.HistoryAggregator(database, archive)
+        self.addCleanup(self.cancel, aggregator)
+        return aggregator
+
+    def cancel(self, aggregator):
+        if aggregator._call is not None and aggregator._call.active():
+            aggregator._call.cancel()
+
+    def set_buckets(self, aggregator, day, month, year):
+        aggregator._bucket_start = {"day": day, "month": month, "year": year}
+        aggregator._set_buckets()
+
+    def test_registers(self):
+        database = Database()
+        aggregator = self.aggregator(database, Archive())
+        self.assertIdentical(database.histagg, aggregator)
+        self.assertEqual(aggregator._bucket_start["day"], self.hour)
+        self.assertEqual(aggregator._end, self.hour + datetime.timedelta(hours=1))
+
+    def test_catchUp(self):
+        # the day buckets of the last three hours were never archived
+        start = self.hour - datetime.timedelta(hours=3)
+        database = Database([(1, 1.0, ts(start) + 10),
+                             (2, 4.0, ts(start) + 20),
+                             (1, 2.0, ts(start) + 3610),
+                             (1, 3.0, ts(start) + 3620)])
+        archive = Archive({"day": ts(start)})
+        self.aggregator(database, archive)
+
+        # buckets without samples are not written
+        day = [(month, method, rows["day"]) for (month, method, rows) in archive.runs]
+        end = start + datetime.timedelta(hours=1)
+        self.assertEqual(day[:2], [
+            (start.strftime("%Y_%m"), "insert_aggregates",
+             [(1, 1.0, 1.0, 1.0, 1.0, "float", ts(start), ts(end)),
+              (2, 4.0, 4.0, 4.0, 4.0, "float", ts(start), ts(end))]),
+            (end.strftime("%Y_%m"), "insert_aggregates",
+             [(1, 3.0, 2.0, 2.5, 3.0, "float", ts(end), ts(end) + 3600)])])
+        self.assertEqual(len(archive.runs), 2)
+
+    def test_catchUpLimit(self):
+        # buckets are caught up for at most CATCH_UP hours
+        archive = Archive({"day": ts(self.hour) - 7 * 24 * 3600})
+        database = Database()
+        aggregator = self.aggregator(database, archive)
+        earliest = self.hour - datetime.timedelta(hours=history.HistoryAggregator.CATCH_UP)
+        self.assertEqual(database.queries[0][0], ts(earliest))
+        self.assertEqual(aggregator._bucket_start["day"], self.hour)
+        self.assertEqual(archive.runs, [])
+
+    def test_lateSamples(self):
+        aggregator = self.aggregator(Database(), Archive())
+        self.set_buckets(aggregator, datetime.datetime(2026, 1, 1, 11), datetime.datetime(2026, 1, 1, 6),
+                         datetime.datetime(2026, 1, 1, 0))
+
+        aggregator.add_samples([
+            (1, 1.0, ts(datetime.datetime(2026, 1, 1, 11, 30))),
+            # a late sample of a closed day bucket only counts for the month and year
+            (2, 2.0, ts(datetime.datetime(2026, 1, 1, 10, 30))),
+            # a sample of a closed year bucket is not counted at all
+            (3, 3.0, ts(datetime.datetime(2025, 12, 31, 23, 30)))])
+        self.assertEqual(len(aggregator._rollups["day"]), 1)
+        self.assertEqual(len(aggregator._rollups["month"]), 2)
+        self.assertEqual(len(aggregator._rollups["year"]), 2)
+
+    def test_graceKeepsNextSamples(self):
+        archive = Archive()
+        aggregator = self.aggregator(Database(), archive)
+        self.set_buckets(aggregator, datetime.datetime(2026, 1, 1, 11), datetime.datetime(2026, 1, 1, 6),
+                         datetime.datetime(2026, 1, 1, 0))
+        boundary = datetime.datetime(2026, 1, 1, 12)
+
+        # samples taken at the boundary, collected before the buckets are closed, are held back
+        aggregator.add_samples([(1, 1.0, ts(boundary) - 1), (1, 5.0, ts(boundary))])
+        self.assertEqual(aggregator._next, [(1, 5.0, ts(boundary))])
+
+        self.cancel(aggregator)
+        aggregator._close_buckets(boundary)
+        (month, method, rows) = archive.runs[0]
+        # the day and month buckets end at 12:00, the year bucket stays open
+        self.assertEqual(sorted(rows.keys()), ["day", "month"])
+        self.assertEqual(rows["day"], [(1, 1.0, 1.0, 1.0, 1.0, "float", ts(boundary) - 3600, ts(boundary))])
+        self.assertEqual(rows["month"], [(1, 1.0, 1.0, 1.0, 1.0, "float", ts(boundary) - 6 * 3600, ts(boundary))])
+
+        # the held back sample is in the next buckets
+        self.assertEqual(aggregator._next, [])
+        self.assertEqual(aggregator._bucket_start["day"], boundary)
+        self.assertEqual(aggregator._rollups["day"].close(), [(1, 1, 5.0, 5.0, 5.0, 5.0, 5.0)])
+        self.assertEqual(aggregator._rollups["year"].close(), [(1, 2, 6.0, 1.0, 5.0, 1.0, 5.0)])
+
+    def test_pendingSamples(self):
+        # samples collected while the buckets are rebuilt are added once
+        samples = defer.Deferred()
+        aggregator = self.aggregator(Database(samples), Archive())
+        start = ts(self.hour)
+        aggregator.add_samples([(1, 2.0, start + 1), (1, 3.0, start + 2), (2, 4.0, start + 1)])
+        self.assertEqual(len(aggregator._rollups["day"]), 0)
+
+        samples.callback([(1, 1.0, start), (1, 2.0, start + 1)])
+        self.assertIdentical(aggregator._pending, None)
+        self.assertEqual(aggregator._rollups["day"].close(), [(1, 3, 6.0, 1.0, 3.0, 1.0, 3.0),
+                                                             (2, 1, 4.0, 4.0, 4.0, 4.0, 4.0)])
+
+    def test_archiveFailureIsLogged(self):
+        archive = Archive()
+        archive.run = lambda *args: defer.fail(IOError("disk full"))
+        aggregator = self.aggregator(Database(), archive)
+        self.set_buckets(aggregator, datetime.datetime(2026, 1, 1, 11), datetime.datetime(2026, 1, 1, 6),
+                         datetime.datetime(2026, 1, 1, 0))
+        aggregator.add_samples([(1, 1.0, ts(datetime.datetime(2026, 1, 1, 11, 30)))])
+
+        d = aggregator._archive(datetime.datetime(2026, 1, 1, 12), aggregator._close(datetime.datetime(2026, 1, 1, 12)))
+        self.successResultOf(d)
+        self.assertEqual(len(aggregator.log.logged("error")), 1)
@@ -0,0 +1,42 @@
+from twisted.trial import unittest
+
+from houseagent.core.rollups import Rollup
+
+
+class RollupTestCase(unittest.TestCase):
+
+    def test_empty(self):
+        rollup = Rollup()
+        self.assertEqual(len(rollup), 0)
+        self.assertEqual(rollup.close(), [])
+
+    def test_statistics(self):
+        rollup = Rollup()
+        for value in (3.0, 1.0, 5.0, 2.0):
+            rollup.add(7, value)
+        rollup.add(8, -1.0)
+        self.assertEqual(len(rollup), 2)
+        # (value_id, count, sum, min, max, first, last)
+        self.assertEqual(rollup.close(), [(7, 4, 11.0, 1.0, 5.0, 3.0, 2.0),
+                                          (8, 1, -1.0, -1.0, -1.0, -1.0, -1.0)])
+
+    def test_closeStartsNewBucket(self):
+        rollup = Rollup()
+        rollup.add(7, 3.0)
+        rollup.add(8, 4.0)
+        rollup.close()
+        self.assertEqual(len(rollup), 0)
+        self.assertEqual(rollup.close(), [])
+
+        # the slots are reused, the statistics of the previous bucket are gone
+        rollup.add(8, 10.0)
+        rollup.add(8, 9.0)
+        self.assertEqual(len(rollup), 1)
+        self.assertEqual(rollup.close(), [(8, 2, 19.0, 9.0, 10.0, 10.0, 9.0)])
+        self.assertEqual(len(rollup._ids), 2)
+
+    def test_constantValue(self):
+        rollup = Rollup()
+        for i in range(3):
+            rollup.add(1, 0.0)
+        self.assertEqual(rollup.close(), [(1, 3, 0.0, 0.0, 0.0, 0.0, 0.0)])
@@ -0,0 +1,108 @@
+import datetime
+import time
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from houseagent.core.scheduler import CronScheduler
+from houseagent.tests import Log
+
+
+def local(*args):
+    return time.mktime(datetime.datetime(*args).timetuple())
+
+
+class CronSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(local(2026, 1, 1, 10, 0, 30))
+        self.log = Log()
+        self.scheduler = CronScheduler(self.log, self.clock)
+        self.calls = []
+
+    def call(self, name):
+        self.calls.append((name, self.clock.seconds()))
+
+    def test_firesAtNextMinute(self):
+        entry = self.scheduler.add("* * * * *", self.call, "a")
+        self.assertEqual(entry.next, local(2026, 1, 1, 10, 1))
+
+        self.clock.advance(29)
+        self.assertEqual(self.calls, [])
+        self.clock.advance(1)
+        self.assertEqual(self.calls, [("a", local(2026, 1, 1, 10, 1))])
+        self.assertEqual(entry.next, local(2026, 1, 1, 10, 2))
+
+    def test_singleTimer(self):
+        self.scheduler.add("* * * * *", self.call, "a")
+        self.scheduler.add("* * * * *", self.call, "b")
+        self.scheduler.add("0 7 * * *", self.call, "c")
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertEqual(len(self.scheduler), 3)
+
+        # due entries fire in one batch, in the order they were added
+        self.clock.advance(30)
+        self.assertEqual([name for (name, t) in self.calls], ["a", "b"])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_lateTimerFiresOnce(self):
+        # a timer which fires minutes late doesn't fire the missed runs in a burst
+        entry = self.scheduler.add("* * * * *", self.call, "a")
+        self.clock.advance(300)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(entry.next, local(2026, 1, 1, 10, 6))
+
+    def test_remove(self):
+        a = self.scheduler.add("* * * * *", self.call, "a")
+        b = self.scheduler.add("* * * * *", self.call, "b")
+        self.scheduler.remove(a)
+        self.scheduler.remove(a)
+        self.assertEqual(len(self.scheduler), 1)
+
+        self.clock.advance(30)
+        self.assertEqual([name for (name, t) in self.calls], ["b"])
+
+        # no timer is left when all entries are removed
+        self.scheduler.remove(b)
+        self.assertEqual(len(self.scheduler), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_removeFirstReschedules(self):
+        first = self.scheduler.add("* * * * *", self.call, "a")
+        self.scheduler.add("0 11 * * *", self.call, "b")
+        self.scheduler.remove(first)
+
+        (call, ) = self.clock.getDelayedCalls()
+        self.assertEqual(call.getTime(), local(2026, 1, 1, 11, 0))
+
+    def test_compaction(self):
+        entries = [self.scheduler.add("* * * * *", self.call, i) for i in range(4)]
+        for entry in entries[:3]:
+            self.scheduler.remove(entry)
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertEqual(len(self.scheduler._queue), 1)
+
+        self.clock.advance(30)
+        self.assertEqual([name for (name, t) in self.calls], [3])
+
+    def test_failedCallIsLogged(self):
+        def fail():
+            raise ValueError("broken")
+        self.scheduler.add("* * * * *", fail)
+        self.scheduler.add("* * * * *", lambda: defer.fail(ValueError("deferred")))
+        self.scheduler.add("* * * * *", self.call, "a")
+
+        self.clock.advance(30)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(len(self.log.logged("error")), 2)
+
+        # the failing entries stay scheduled
+        self.clock.advance(60)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(len(self.log.logged("error")), 4)
+
+    def test_invalidCron(self):
+        self.assertRaises(Exception, self.scheduler.add, "not a cron line", self.call, "a")
+        self.assertEqual(len(self.scheduler), 0)
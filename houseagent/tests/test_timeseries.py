@@ -0,0 +1,112 @@
+from twisted.trial import unittest
+
+from houseagent.utils.timeseries import lttb, merge_buckets, align_series
+
+
+class LttbTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.points = [(x, float(x % 7)) for x in range(100)]
+
+    def test_belowThreshold(self):
+        # n <= threshold returns all points, as a new list
+        for threshold in (100, 101):
+            sampled = lttb(self.points, threshold)
+            self.assertEqual(sampled, self.points)
+            self.assertNotIdentical(sampled, self.points)
+
+    def test_noThreshold(self):
+        self.assertEqual(lttb(self.points, 0), self.points)
+        self.assertEqual(lttb(self.points, -1), self.points)
+
+    def test_empty(self):
+        self.assertEqual(lttb([], 10), [])
+
+    def test_thresholdBelowThree(self):
+        self.assertEqual(lttb(self.points, 1), [self.points[0]])
+        self.assertEqual(lttb(self.points, 2), [self.points[0], self.points[-1]])
+
+    def test_keepsPeak(self):
+        points = [(x, 0.0) for x in range(10)]
+        points[5] = (5, 10.0)
+        self.assertEqual(lttb(points, 3), [points[0], points[5], points[-1]])
+
+    def test_subsetInOrder(self):
+        for threshold in (3, 10, 99):
+            sampled = lttb(self.points, threshold)
+            self.assertEqual(len(sampled), threshold)
+            self.assertEqual(sampled[0], self.points[0])
+            self.assertEqual(sampled[-1], self.points[-1])
+            self.assertEqual(sampled, sorted(sampled))
+            for point in sampled:
+                self.assertIn(point, self.points)
+
+
+class MergeBucketsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # (value, min, avg, max, ts)
+        self.rows = [(1.0, 0.0, 1.0, 2.0, 0),
+                     (2.0, 1.0, 2.0, 3.0, 3600),
+                     (3.0, -1.0, 3.0, 4.0, 7200),
+                     (4.0, 3.0, 4.0, 9.0, 10800)]
+
+    def test_belowThreshold(self):
+        self.assertEqual(merge_buckets(self.rows, 4), self.rows)
+        self.assertEqual(merge_buckets(self.rows, 10), self.rows)
+        self.assertEqual(merge_buckets(self.rows, 0), self.rows)
+        self.assertEqual(merge_buckets([], 3), [])
+
+    def test_merge(self):
+        self.assertEqual(merge_buckets(self.rows, 2),
+                         [(2.0, 0.0, 1.5, 3.0, 0), (4.0, -1.0, 3.5, 9.0, 7200)])
+        self.assertEqual(merge_buckets(self.rows, 1), [(4.0, -1.0, 2.5, 9.0, 0)])
+
+    def test_unevenBuckets(self):
+        rows = self.rows + [(5.0, 5.0, 5.0, 5.0, 14400)]
+        merged = merge_buckets(rows, 2)
+        self.assertEqual(merged, [(2.0, 0.0, 1.5, 3.0, 0), (5.0, -1.0, 4.0, 9.0, 7200)])
+
+    def test_acrossGaps(self):
+        # rows are merged by position, a bucket spanning a gap starts at its first row
+        rows = [(1.0, 1.0, 1.0, 1.0, 0),
+                (2.0, 2.0, 2.0, 2.0, 3600),
+                (3.0, 3.0, 3.0, 3.0, 86400),
+                (4.0, 4.0, 4.0, 4.0, 90000)]
+        merged = merge_buckets(rows, 3)
+        self.assertEqual([row[4] for row in merged], [0, 3600, 86400])
+        self.assertEqual(merged[2], (4.0, 3.0, 3.5, 4.0, 86400))
+
+
+class AlignSeriesTestCase(unittest.TestCase):
+
+    def test_axis(self):
+        (axis, series) = align_series([], [1], ["avg"], 130, 400, 100)
+        # the start is rounded down to the start of its bucket, the end is exclusive
+        self.assertEqual(axis, [100, 200, 300])
+        self.assertEqual(series, {1: {"avg": [None, None, None]}})
+
+    def test_offset(self):
+        (axis, series) = align_series([], [1], ["avg"], 130, 400, 100, offset=30)
+        self.assertEqual(axis, [70, 170, 270, 370])
+
+    def test_rows(self):
+        rows = [(1, 100, 1.0, 2),
+                (2, 300, 5.0, 1),
+                (1, 250, 9.0, 9),   # not on a bucket start
+                (1, 600, 9.0, 9),   # outside of the axis
+                (3, 100, 9.0, 9)]   # not a requested series
+        (axis, series) = align_series(rows, [1, 2], ["avg", "count"], 100, 400, 100)
+        self.assertEqual(series, {1: {"avg": [1.0, None, None], "count": [2, None, None]},
+                                  2: {"avg": [None, None, 5.0], "count": [None, None, 1]}})
+
+    def test_fillZero(self):
+        rows = [(1, 200, 3.0)]
+        (axis, series) = align_series(rows, [1], ["avg"], 100, 500, 100, fill="zero")
+        self.assertEqual(series[1]["avg"], [0, 3.0, 0, 0])
+
+    def test_fillPrevious(self):
+        # buckets before the first value stay empty
+        rows = [(1, 200, 3.0), (1, 400, 4.0)]
+        (axis, series) = align_series(rows, [1], ["avg"], 100, 600, 100, fill="previous")
+        self.assertEqual(series[1]["avg"], [None, 3.0, 3.0, 4.0, 4.0])
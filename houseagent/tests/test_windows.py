@@ -0,0 +1,98 @@
+from twisted.trial import unittest
+
+from houseagent.core.windows import SlidingWindow
+
+
+class SlidingWindowTestCase(unittest.TestCase):
+
+    def test_empty(self):
+        window = SlidingWindow(10)
+        self.assertEqual(len(window), 0)
+        for name in SlidingWindow.AGGREGATES:
+            self.assertIdentical(window.aggregate(name), None)
+
+    def test_singleSample(self):
+        window = SlidingWindow(10)
+        window.add(0, 4.0)
+        self.assertEqual(window.aggregate("mean"), 4.0)
+        self.assertEqual(window.aggregate("min"), 4.0)
+        self.assertEqual(window.aggregate("max"), 4.0)
+        self.assertIdentical(window.aggregate("delta"), None)
+        self.assertIdentical(window.aggregate("rate"), None)
+
+    def test_sampleAtCutoffIsKept(self):
+        # a sample exactly window seconds old is still in the window
+        window = SlidingWindow(10)
+        window.add(0, 1.0)
+        window.add(10, 3.0)
+        self.assertEqual(len(window), 2)
+        self.assertEqual(window.aggregate("mean"), 2.0)
+        self.assertEqual(window.aggregate("min"), 1.0)
+        self.assertEqual(window.aggregate("delta"), 2.0)
+        self.assertEqual(window.aggregate("rate"), 0.2)
+
+        window.add(10.5, 5.0)
+        self.assertEqual(len(window), 2)
+        self.assertEqual(window.aggregate("min"), 3.0)
+        self.assertEqual(window.aggregate("mean"), 4.0)
+
+    def test_equalTimestamps(self):
+        window = SlidingWindow(10)
+        for value in (1.0, 2.0, 0.0, 2.0):
+            window.add(5, value)
+        self.assertEqual(len(window), 4)
+        self.assertEqual(window.aggregate("min"), 0.0)
+        self.assertEqual(window.aggregate("max"), 2.0)
+        self.assertEqual(window.aggregate("delta"), 1.0)
+        # no time between the oldest and newest sample
+        self.assertIdentical(window.aggregate("rate"), None)
+
+        # all samples with the same timestamp expire together
+        window.add(15.5, 7.0)
+        self.assertEqual(len(window), 1)
+        self.assertEqual(window.aggregate("min"), 7.0)
+        self.assertEqual(window.aggregate("max"), 7.0)
+
+    def test_minMaxAfterExpiry(self):
+        window = SlidingWindow(1.5)
+        window.add(0, 5.0)
+        window.add(1, 1.0)
+        window.add(2, 4.0)
+        self.assertEqual(window.aggregate("min"), 1.0)
+        self.assertEqual(window.aggregate("max"), 4.0)
+
+        window.add(3, 2.0)
+        self.assertEqual(len(window), 2)
+        self.assertEqual(window.aggregate("min"), 2.0)
+        self.assertEqual(window.aggregate("max"), 4.0)
+
+    def test_growAfterWrap(self):
+        # the ring buffer wraps around and then grows while its head is not at the start
+        window = SlidingWindow(3, capacity=2)
+        for t in range(6):
+            window.add(t, float(t))
+        self.assertEqual(len(window), 4)
+        self.assertEqual(window.aggregate("mean"), 3.5)
+        self.assertEqual(window.aggregate("min"), 2.0)
+        self.assertEqual(window.aggregate("max"), 5.0)
+        self.assertEqual(window.aggregate("delta"), 3.0)
+        self.assertEqual(window.aggregate("rate"), 1.0)
+
+        for t in range(6, 40):
+            window.add(t, float(t))
+        self.assertEqual(len(window), 4)
+        self.assertEqual(window.aggregate("mean"), 37.5)
+
+    def test_sumResetWhenEmpty(self):
+        window = SlidingWindow(10)
+        window.add(0, 0.1)
+        window.add(0, 0.2)
+        window.add(100, 1.0)
+        self.assertEqual(len(window), 1)
+        self.assertEqual(window.aggregate("mean"), 1.0)
+
+    def test_unknownAggregate(self):
+        window = SlidingWindow(10)
+        window.add(0, 1.0)
+        window.add(1, 2.0)
+        self.assertIdentical(window.aggregate("median"), None)
@@ -7,7 +7,7 @@ def _getOpt(get, section, option, default = None):
     res = default
     try:
         res = get(section, option)
-    except ConfigParser.NoOptionError:
+    except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
         if res == None:
             raise error.ConfigError, ("[%s]::%s" % (section,option))
 
@@ -44,6 +44,8 @@ class Config:
         self.webserver = _ConfigWebserver(parser)
         self.zmq = _ConfigZMQ(parser)
         self.embedded = _ConfigEmbedded(parser)
+        self.events = _ConfigEvents(parser)
+        self.history = _ConfigHistory(parser)
 
 class _ConfigGeneral:
 
@@ -150,5 +152,27 @@ class _ConfigEmbedded:
     def __init__(self, parser):
         self.enabled = _getOpt(
                 parser.getboolean, "embedded", "enabled", False)
+        self.mode = _getOpt(
+                parser.get, "embedded", "mode", "flash")
         self.db_save_interval = _getOpt(
                 parser.getint, "embedded", "dbsaveinterval", 0)
+        self.journal = _getOpt(
+                parser.getboolean, "embedded", "journal", False)
+        self.journal_sync_interval = _getOpt(
+                parser.getint, "embedded", "journalsyncinterval", 5)
+
+class _ConfigEvents:
+    
+    def __init__(self, parser):
+        self.plugin_concurrency = _getOpt(
+                parser.getint, "events", "pluginconcurrency", 0)
+        self.action_timeout = _getOpt(
+                parser.getint, "events", "actiontimeout", 10)
+
+class _ConfigHistory:
+    
+    def __init__(self, parser):
+        self.retention_days = _getOpt(
+                parser.getint, "history", "retention", 7)
+        self.incremental_vacuum = _getOpt(
+                parser.getboolean, "history", "incrementalvacuum", False)
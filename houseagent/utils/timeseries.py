@@ -0,0 +1,125 @@
+'''
+Downsampling of time series for graphs.
+'''
+
+def lttb(points, threshold):
+    '''
+    Downsample a series with the Largest-Triangle-Three-Buckets algorithm, which keeps the
+    visual shape of the series (peaks and dips) with a fraction of the points.
+    @param points: list of (x, y) tuples, sorted by x
+    @param threshold: the maximum number of points to return
+
+    @return: a list of at most threshold points, taken from the original points
+    '''
+    n = len(points)
+    if threshold >= n or threshold <= 0:
+        return list(points)
+    if threshold < 3:
+        return [points[0], points[-1]][:threshold]
+
+    sampled = [points[0]]
+    # the first and last point are always kept, the others are divided over the buckets
+    every = float(n - 2) / (threshold - 2)
+    a = 0
+
+    for i in xrange(threshold - 2):
+        # average point of the next bucket
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_x = 0.0
+        avg_y = 0.0
+        for j in xrange(avg_start, avg_end):
+            avg_x += points[j][0]
+            avg_y += points[j][1]
+        avg_x /= avg_end - avg_start
+        avg_y /= avg_end - avg_start
+
+        # point of this bucket with the largest triangle with the previous point and the average
+        (ax, ay) = (points[a][0], points[a][1])
+        max_area = -1.0
+        for j in xrange(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                selected = j
+
+        sampled.append(points[selected])
+        a = selected
+
+    sampled.append(points[-1])
+    return sampled
+
+def merge_buckets(rows, threshold):
+    '''
+    Downsample aggregated rows by merging consecutive rows into buckets, keeping the minimum
+    and maximum of every bucket.
+    @param rows: list of (value, min, avg, max, ts) tuples, sorted by ts
+    @param threshold: the maximum number of rows to return
+
+    @return: a list of at most threshold (value, min, avg, max, ts) tuples, value is the last
+             value of the bucket, avg the average of the averages and ts the first timestamp
+    '''
+    n = len(rows)
+    if threshold >= n or threshold <= 0:
+        return list(rows)
+
+    merged = []
+    every = float(n) / threshold
+    for i in xrange(threshold):
+        bucket = rows[int(i * every):int((i + 1) * every)]
+        if not bucket:
+            continue
+
+        merged.append((bucket[-1][0],
+                       min(row[1] for row in bucket),
+                       sum(row[2] for row in bucket) / float(len(bucket)),
+                       max(row[3] for row in bucket),
+                       bucket[0][4]))
+    return merged
+
+def align_series(rows, keys, columns, start, end, width, fill=None, offset=0):
+    '''
+    Put bucketed rows of several series on one shared time axis.
+    @param rows: list of (key, bucket, column values...) tuples, bucket is the start time of the bucket
+    @param keys: the keys of the series to return, in order
+    @param columns: the names of the column values in the rows
+    @param start: start of the time axis, rounded down to the start of its bucket
+    @param end: end of the time axis (exclusive)
+    @param width: the width of the buckets
+    @param fill: how to fill buckets without data, None leaves them empty (None),
+                 "previous" repeats the previous value and "zero" fills in 0
+    @param offset: buckets start at multiples of width minus offset
+
+    @return: a tuple of (axis, series), axis is the list of bucket times, series a dict by key
+             of dicts by column name with a list of values along the axis
+    '''
+    first = int((start + offset) // width) * width - offset
+    axis = range(first, int(end), width)
+    index = dict((bucket, i) for (i, bucket) in enumerate(axis))
+
+    series = {}
+    for key in keys:
+        series[key] = dict((column, [None] * len(axis)) for column in columns)
+
+    for row in rows:
+        i = index.get(row[1])
+        if i is None or row[0] not in series:
+            continue
+
+        for (c, column) in enumerate(columns):
+            series[row[0]][column][i] = row[2 + c]
+
+    if fill == "zero":
+        for data in series.itervalues():
+            for values in data.itervalues():
+                for i in xrange(len(values)):
+                    if values[i] is None:
+                        values[i] = 0
+    elif fill == "previous":
+        for data in series.itervalues():
+            for values in data.itervalues():
+                for i in xrange(1, len(values)):
+                    if values[i] is None:
+                        values[i] = values[i - 1]
+
+    return (axis, series)